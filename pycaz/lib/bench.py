@@ -0,0 +1,346 @@
+# Copyright (c) 2018 Javier M. Mellid <jmunhoz@igalia.com>
+#
+# Permission is hereby granted, free of charge, to any person obtaining a copy
+# of this software and associated documentation files (the "Software"), to deal
+# in the Software without restriction, including without limitation the rights
+# to use, copy, modify, merge, publish, distribute, sublicense, and/or sell
+# copies of the Software, and to permit persons to whom the Software is
+# furnished to do so, subject to the following conditions:
+#
+# The above copyright notice and this permission notice shall be included in all
+# copies or substantial portions of the Software.
+#
+# THE SOFTWARE IS PROVIDED "AS IS", WITHOUT WARRANTY OF ANY KIND, EXPRESS OR
+# IMPLIED, INCLUDING BUT NOT LIMITED TO THE WARRANTIES OF MERCHANTABILITY,
+# FITNESS FOR A PARTICULAR PURPOSE AND NONINFRINGEMENT. IN NO EVENT SHALL THE
+# AUTHORS OR COPYRIGHT HOLDERS BE LIABLE FOR ANY CLAIM, DAMAGES OR OTHER
+# LIABILITY, WHETHER IN AN ACTION OF CONTRACT, TORT OR OTHERWISE, ARISING FROM,
+# OUT OF OR IN CONNECTION WITH THE SOFTWARE OR THE USE OR OTHER DEALINGS IN THE
+# SOFTWARE.
+
+# Times caz against a synthetic catalog served by the mock RGW, and prints
+# the results as JSON, comparable between commits:
+#
+#   python3 -m pycaz.lib.bench --versions 1000000 --out before.json
+#   python3 -m pycaz.lib.bench --versions 1000000 --compare before.json
+
+import argparse
+import contextlib
+import datetime
+import json
+import multiprocessing
+import os
+import platform
+import sqlite3
+import subprocess
+import sys
+import tempfile
+import time
+
+from .mock_rgw import MockRGW, MockStore
+from .s3_commands import S3CommandFactory
+from .db import SQLiteAccess, get_default_db, close_default_db
+from .timestamps import to_epoch_us
+from . import config
+
+BENCH_FORMAT = 1
+BENCH_BUCKET = 'bench'
+RECOVER_BUCKET = 'bench-recover'
+# synthetic versions are one second apart from this date
+BASE_DATE = datetime.datetime(2020, 1, 1)
+OWNER = {'ID': 'testuser1', 'DisplayName': 'Test User'}
+
+class SyntheticKeys:
+
+    # sorted sequence of keys computed from their index, spread over dirs
+    # top level prefixes
+    def __init__(self, keys, dirs):
+        self.keys = keys
+        self.keys_per_dir = -(-keys // max(1, min(dirs, keys)))
+
+    def __len__(self):
+        return self.keys
+
+    def __getitem__(self, i):
+        if i < 0 or i >= self.keys:
+            raise IndexError(i)
+        return 'd{:05d}/k{:09d}'.format(i // self.keys_per_dir, i)
+
+    def index(self, key):
+        return int(key[-9:])
+
+class SyntheticCatalog:
+
+    # versions_per_key versions of every key; generation g of every key is
+    # written before generation g + 1 of any, a deterministic share of them
+    # are delete markers
+    def __init__(self, versions, versions_per_key, delete_marker_ratio, dirs):
+        self.versions_per_key = versions_per_key
+        self.keys = SyntheticKeys(max(1, versions // versions_per_key), dirs)
+        self.delete_markers = int(delete_marker_ratio * 1000)
+
+    def size(self):
+        return len(self.keys) * self.versions_per_key
+
+    def date_at(self, fraction):
+        # date at fraction of the catalog history, as LAST_MODIFIED_US
+        return to_epoch_us((BASE_DATE + datetime.timedelta(seconds=int(self.size() * fraction))).isoformat())
+
+    def versions(self, key):
+        # newest first, as stored by the mock
+        i = self.keys.index(key)
+        versions = []
+        for g in reversed(range(self.versions_per_key)):
+            tdate = BASE_DATE + datetime.timedelta(seconds=g * len(self.keys) + i)
+            v = {'Key': key,
+                 'VersionId': '{:09x}{:04x}'.format(i, g),
+                 'LastModified': tdate.strftime('%Y-%m-%dT%H:%M:%S.000Z'),
+                 'Created': 0,
+                 'Owner': OWNER,
+                 'IsDeleteMarker': (i * 7919 + g * 104729) % 1000 < self.delete_markers}
+            if not v['IsDeleteMarker']:
+                v['ETag'] = '"{:032x}"'.format(i * self.versions_per_key + g)
+                v['Size'] = (i * 31 + g) % 65536
+                v['StorageClass'] = 'STANDARD'
+            versions.append(v)
+        return versions
+
+class BenchStore(MockStore):
+
+    # mock store serving synthetic catalogs, computed on demand instead of
+    # kept in memory
+    def __init__(self):
+        MockStore.__init__(self)
+        self.catalogs = {}
+
+    def add_catalog(self, bucket, catalog):
+        with self.lock:
+            self.buckets[bucket] = {}
+            self.catalogs[bucket] = catalog
+
+    def _sorted_keys(self, bucket):
+        if bucket in self.catalogs:
+            return self.catalogs[bucket].keys
+        return MockStore._sorted_keys(self, bucket)
+
+    def _key_versions(self, bucket, key):
+        if bucket in self.catalogs:
+            return self.catalogs[bucket].versions(key)
+        return MockStore._key_versions(self, bucket, key)
+
+def _serve(catalog, recover_keys, conn):
+    # master and archive zones sharing the synthetic catalog, served by a
+    # process of their own so they do not compete with caz for the GIL
+    store = BenchStore()
+    store.add_catalog(BENCH_BUCKET, catalog)
+    store.create_bucket(RECOVER_BUCKET)
+    for i in range(recover_keys):
+        for n in range(2):
+            store.put(RECOVER_BUCKET, 'r{:06d}'.format(i), b'v%d' % n, OWNER)
+    with MockRGW(store) as master, MockRGW(store) as archive:
+        conn.send((master.endpoint, archive.endpoint))
+        # until the benchmarks are done
+        conn.recv()
+
+@contextlib.contextmanager
+def _quiet():
+    # command output, pretty or --output, goes to /dev/null
+    with open(os.devnull, 'w') as devnull:
+        with contextlib.redirect_stdout(devnull):
+            yield
+
+def _count(rows):
+    n = 0
+    for r in rows:
+        n += 1
+    return n
+
+def _git_commit():
+    try:
+        r = subprocess.run(['git', 'rev-parse', 'HEAD'], capture_output=True, text=True,
+                           cwd=os.path.dirname(os.path.abspath(__file__)))
+    except OSError:
+        return None
+    return r.stdout.strip() if r.returncode == 0 else None
+
+class Bench:
+
+    def __init__(self, args):
+        self.args = args
+        self.catalog = SyntheticCatalog(args.versions, args.versions_per_key,
+                                        args.delete_marker_ratio, args.dirs)
+        self.results = {}
+
+    def _time(self, name, f, rows=None):
+        start = time.perf_counter()
+        n = f()
+        seconds = time.perf_counter() - start
+        if rows is None:
+            rows = n
+        self.results[name] = {'seconds': round(seconds, 6),
+                              'rows': rows,
+                              'rows_per_second': round(rows / seconds) if rows and seconds else None}
+        print('{:<24} {:>10.3f}s {:>10} rows'.format(name, seconds, rows if rows is not None else '-'),
+              file=sys.stderr)
+        return n
+
+    def _command(self, name, params=None, **modifiers):
+        c = S3CommandFactory.createS3Command(name)
+        c.set_params(params)
+        c.set_modifiers(modifiers)
+        with _quiet():
+            c.execute()
+            c.show_output()
+        return c
+
+    def _fetch(self):
+        self._command('fetch-bucket', [BENCH_BUCKET], split=self.args.split,
+                      jobs=self.args.jobs, page_size=self.args.page_size)
+
+    def _trim_plan(self, xid, tdate):
+        # trim-objects --plan aggregates, versions and delete markers counted
+        return sum(r[3] for r in get_default_db().get_trim_plan(xid, tdate))
+
+    def _by_key(self, xid):
+        # every key of an evenly spaced sample
+        db = get_default_db()
+        keys = self.catalog.keys
+        step = max(1, len(keys) // self.args.sample_keys)
+        return sum(_count(db.get_objects_by_key_and_last_modified(xid, keys[i], 'desc'))
+                   for i in range(0, len(keys), step))
+
+    def _recover_and_trim(self):
+        # recover the previous version of every key of a small bucket, then
+        # trim the bucket
+        self._command('fetch-bucket', [RECOVER_BUCKET])
+        db = get_default_db()
+        pairs = os.path.join(self.work_dir, 'pairs')
+        with open(pairs, 'w') as f:
+            for s3o in db.get_objects_by_last_modified(db.get_bucket_xid(RECOVER_BUCKET)):
+                if not s3o.is_latest:
+                    f.write('{}\t{}\n'.format(s3o.key, s3o.version_id))
+        self._time('recover-objects',
+                   lambda: self._command('recover-objects', [pairs], bucket=RECOVER_BUCKET,
+                                         jobs=self.args.jobs).recovered)
+        tdate = (datetime.datetime.utcnow() + datetime.timedelta(days=1)).strftime('%Y-%m-%d')
+        self._time('trim-objects',
+                   lambda: self._command('trim-objects', [tdate], bucket=RECOVER_BUCKET,
+                                         jobs=self.args.jobs, batch_size=1000).deleted)
+
+    def run(self, work_dir):
+        self.work_dir = work_dir
+        SQLiteAccess.db_name = os.path.join(work_dir, 'caz.db')
+        (conn, child_conn) = multiprocessing.Pipe()
+        server = multiprocessing.Process(target=_serve, args=(self.catalog, self.args.recover_keys, child_conn),
+                                         daemon=True)
+        server.start()
+        try:
+            (config.MASTER_GATEWAY, config.ARCHIVE_GATEWAY) = conn.recv()
+            config.DATA_SOURCE = 'native'
+            config.AWS_ACCESS_KEY_ID = config.AWS_ACCESS_KEY_ID or 'ak'
+            config.AWS_SECRET_ACCESS_KEY = config.AWS_SECRET_ACCESS_KEY or 'sk'
+            config.DEBUG_FLAG = False
+            try:
+                self._command('init-db')
+                size = self.catalog.size()
+                self._time('fetch-bucket', self._fetch, size)
+                db = get_default_db()
+                xid = db.get_bucket_xid(BENCH_BUCKET)
+                rows = self._time('list-objects', lambda: _count(db.get_objects_by_last_modified(xid)))
+                self._time('list-objects-pretty',
+                           lambda: self._command('list-objects', bucket=BENCH_BUCKET), rows)
+                for output in ('jsonl', 'csv', 'tsv', 'null'):
+                    self._time('list-objects-' + output,
+                               lambda: self._command('list-objects', bucket=BENCH_BUCKET, output=output), rows)
+                prefix = self.catalog.keys[0].split('/')[0] + '/'
+                self._time('list-objects-prefix',
+                           lambda: _count(db.get_objects_by_last_modified(xid, filters={'prefix': prefix})))
+                self._time('list-objects-since',
+                           lambda: _count(db.get_objects_by_last_modified(xid, filters={'since': self.catalog.date_at(0.9)})))
+                self._time('list-objects-latest',
+                           lambda: _count(db.get_objects_by_last_modified(xid, filters={'latest_only': True})))
+                self._time('list-objects-by-key', lambda: self._by_key(xid))
+                self._time('list-keys', lambda: _count(db.get_all_keys(xid)))
+                self._time('snapshot-at',
+                           lambda: _count(db.get_objects_at_date(xid, self.catalog.date_at(0.5))))
+                self._time('trim-plan', lambda: self._trim_plan(xid, self.catalog.date_at(0.5)))
+                self._recover_and_trim()
+            finally:
+                close_default_db()
+        finally:
+            conn.send(None)
+            server.join()
+        return {'format': BENCH_FORMAT,
+                'date': datetime.datetime.utcnow().strftime('%Y-%m-%dT%H:%M:%SZ'),
+                'commit': _git_commit(),
+                'python': platform.python_version(),
+                'sqlite': sqlite3.sqlite_version,
+                'platform': platform.platform(),
+                'params': {'versions': size,
+                           'keys': len(self.catalog.keys),
+                           'versions_per_key': self.args.versions_per_key,
+                           'delete_marker_ratio': self.args.delete_marker_ratio,
+                           'dirs': self.args.dirs,
+                           'split': self.args.split,
+                           'jobs': self.args.jobs,
+                           'page_size': self.args.page_size,
+                           'sample_keys': self.args.sample_keys,
+                           'recover_keys': self.args.recover_keys},
+                'results': self.results}
+
+def compare(old, new):
+    # seconds of both runs and new/old ratio, per benchmark
+    if old.get('params') != new.get('params'):
+        print('warning : benchmarks run with different params', file=sys.stderr)
+    print('{:<24} {:>10} {:>10} {:>7}'.format('benchmark', 'old', 'new', 'ratio'), file=sys.stderr)
+    for name, r in new['results'].items():
+        o = old['results'].get(name)
+        if o is None:
+            print('{:<24} {:>10} {:>9.3f}s {:>7}'.format(name, '-', r['seconds'], '-'), file=sys.stderr)
+            continue
+        ratio = r['seconds'] / o['seconds'] if o['seconds'] else float('inf')
+        print('{:<24} {:>9.3f}s {:>9.3f}s {:>6.2f}x'.format(name, o['seconds'], r['seconds'], ratio),
+              file=sys.stderr)
+
+def main():
+    parser = argparse.ArgumentParser(prog='bench')
+    parser.add_argument('--versions', type=int, default=10000,
+                        help='synthetic catalog size, e.g. 10000, 1000000 or 10000000')
+    parser.add_argument('--versions-per-key', type=int, default=5)
+    parser.add_argument('--delete-marker-ratio', type=float, default=0.1)
+    parser.add_argument('--dirs', type=int, default=100,
+                        help='top level prefixes the keys are spread over')
+    parser.add_argument('--split', action='store_true', help='fetch-bucket --split')
+    parser.add_argument('--jobs', type=int, default=config.FETCH_JOBS)
+    parser.add_argument('--page-size', type=int, default=config.FETCH_PAGE_SIZE)
+    parser.add_argument('--sample-keys', type=int, default=1000,
+                        help='keys listed by list-objects-by-key')
+    parser.add_argument('--recover-keys', type=int, default=100,
+                        help='keys recovered, then trimmed, in a bucket of their own')
+    parser.add_argument('--work-dir', help='keep the db here instead of a temporary directory')
+    parser.add_argument('--out', help='write the results here instead of stdout')
+    parser.add_argument('--compare', metavar='FILE', help='compare with the results in FILE')
+    args = parser.parse_args()
+    if args.versions < 1 or args.versions_per_key < 1:
+        parser.error('--versions and --versions-per-key must be at least 1')
+    if not 0 <= args.delete_marker_ratio <= 1:
+        parser.error('--delete-marker-ratio must be between 0 and 1')
+    bench = Bench(args)
+    if args.work_dir:
+        os.makedirs(args.work_dir, exist_ok=True)
+        results = bench.run(args.work_dir)
+    else:
+        with tempfile.TemporaryDirectory(prefix='caz-bench-') as work_dir:
+            results = bench.run(work_dir)
+    if args.out:
+        with open(args.out, 'w') as f:
+            json.dump(results, f, indent=2)
+            f.write('\n')
+    else:
+        print(json.dumps(results, indent=2))
+    if args.compare:
+        with open(args.compare) as f:
+            compare(json.load(f), results)
+
+if __name__ == '__main__':
+    main()
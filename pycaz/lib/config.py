@@ -20,8 +20,54 @@
 
 MASTER_GATEWAY   = 'http://rgw1:8000'
 ARCHIVE_GATEWAY  = 'http://rgw2:8001'
+# aws-cli recoveries stage objects in unique files next to TMP_FILE
 TMP_FILE         = '/tmp/output.raw'
+# recover-object polls the archive zone for the new version with exponential
+# backoff, up to SYNC_WINDOW_TIMEOUT seconds; SYNC_WINDOW_TIME is the fixed
+# wait used when the new version-id is unknown
 SYNC_WINDOW_TIME = 3
+SYNC_WINDOW_TIMEOUT    = 60
+SYNC_POLL_INTERVAL     = 0.1
+SYNC_POLL_MAX_INTERVAL = 2
 DEBUG_FLAG       = True
 DEBUG_FILE       = 'debug-caz.log'
 DB_FILE          = 'caz.db'
+# sqlite page cache and memory map sizes, in bytes, and busy timeout, in seconds
+DB_CACHE_SIZE    = 64 * 1024 * 1024
+DB_MMAP_SIZE     = 256 * 1024 * 1024
+DB_BUSY_TIMEOUT  = 30
+# fetch-bucket listing page size (1..1000) and partitions listed in parallel
+FETCH_PAGE_SIZE  = 1000
+FETCH_JOBS       = 4
+# fetch-bucket --split lists every common prefix under this delimiter apart
+FETCH_SPLIT_DELIMITER = '/'
+# trim-objects concurrent requests and versions per DeleteObjects request (1..1000)
+TRIM_JOBS        = 1
+TRIM_BATCH_SIZE  = 1
+# trim-objects --plan lists this many of the keys losing every version, unless --limit
+TRIM_PLAN_KEYS   = 20
+# recover-objects concurrent recoveries
+RECOVER_JOBS     = 4
+# data source strategy: 'aws-cli' or 'native'
+DATA_SOURCE      = 'aws-cli'
+# native data source settings (credentials fall back to env and ~/.aws/credentials)
+AWS_ACCESS_KEY_ID     = None
+AWS_SECRET_ACCESS_KEY = None
+S3_REGION        = 'us-east-1'
+S3_POOL_SIZE     = 16
+# S3 requests in flight per gateway, shared by every command of the process
+S3_MAX_REQUESTS  = 64
+S3_TIMEOUT       = 60
+# recover-object streams objects above this size as multipart uploads
+MULTIPART_THRESHOLD  = 64 * 1024 * 1024
+MULTIPART_CHUNK_SIZE = 16 * 1024 * 1024
+# recover-object copies inside the gateway realm (falls back to get/put)
+SERVER_SIDE_COPY     = False
+COPY_OBJECT_MAX_SIZE = 5 * 1024 * 1024 * 1024
+# --output writers buffer this much before writing to stdout
+OUTPUT_BUFFER_SIZE   = 1024 * 1024
+# caz --serve listens here, a unix socket path or localhost:port
+SERVE_ADDRESS        = 'caz.sock'
+# caz --serve on localhost:port writes the bearer token its clients send here,
+# readable by this user only
+SERVE_TOKEN_FILE     = 'caz.token'
@@ -18,34 +18,138 @@
 # OUT OF OR IN CONNECTION WITH THE SOFTWARE OR THE USE OR OTHER DEALINGS IN THE
 # SOFTWARE.
 
+import contextlib
 import sqlite3
 import os.path
-import dateutil.parser
+import threading
 
 from .s3_objects import *
+from .timestamps import to_epoch_us
 from . import logger
 from . import config
+from . import stats
+
+# schema migrations, MIGRATIONS[n] upgrades a db from user_version n to n + 1
+MIGRATIONS = [
+    # 1: secondary indexes for the listing, trimming and owner lookups
+    """
+    CREATE INDEX IF NOT EXISTS OBJECTS_KEY_LAST_MODIFIED ON OBJECTS (KEY, LAST_MODIFIED);
+    CREATE INDEX IF NOT EXISTS OBJECTS_LAST_MODIFIED ON OBJECTS (LAST_MODIFIED);
+    CREATE INDEX IF NOT EXISTS OWNERS_ID ON OWNERS (ID);
+    """,
+    # 2: (KEY, VERSION_ID) natural key for incremental refreshes
+    """
+    DELETE FROM OBJECTS WHERE XID NOT IN (SELECT MIN(XID) FROM OBJECTS GROUP BY KEY, VERSION_ID);
+    CREATE UNIQUE INDEX IF NOT EXISTS OBJECTS_KEY_VERSION_ID ON OBJECTS (KEY, VERSION_ID);
+    """,
+    # 3: objects keyed by bucket, several buckets share one catalog
+    """
+    CREATE TABLE BUCKET_NEW (
+    XID INTEGER PRIMARY KEY AUTOINCREMENT,
+    NAME TEXT UNIQUE NOT NULL
+    );
+    INSERT INTO BUCKET_NEW (NAME) SELECT NAME FROM BUCKET;
+    DROP TABLE BUCKET;
+    ALTER TABLE BUCKET_NEW RENAME TO BUCKET;
+    ALTER TABLE OBJECTS ADD COLUMN BUCKET_XID INTEGER REFERENCES BUCKET(XID);
+    UPDATE OBJECTS SET BUCKET_XID = (SELECT MIN(XID) FROM BUCKET);
+    DROP INDEX IF EXISTS OBJECTS_KEY_LAST_MODIFIED;
+    DROP INDEX IF EXISTS OBJECTS_LAST_MODIFIED;
+    DROP INDEX IF EXISTS OBJECTS_KEY_VERSION_ID;
+    CREATE INDEX IF NOT EXISTS OBJECTS_BUCKET_KEY_LAST_MODIFIED ON OBJECTS (BUCKET_XID, KEY, LAST_MODIFIED);
+    CREATE INDEX IF NOT EXISTS OBJECTS_BUCKET_LAST_MODIFIED ON OBJECTS (BUCKET_XID, LAST_MODIFIED);
+    CREATE UNIQUE INDEX IF NOT EXISTS OBJECTS_BUCKET_KEY_VERSION_ID ON OBJECTS (BUCKET_XID, KEY, VERSION_ID);
+    """,
+    # 4: trim jobs, the versions a trim selected and their state, P(ending),
+    # D(eleted) or F(ailed), so an interrupted trim can be resumed
+    """
+    CREATE TABLE IF NOT EXISTS TRIM_JOBS (
+    XID INTEGER PRIMARY KEY AUTOINCREMENT,
+    BUCKET_XID INTEGER REFERENCES BUCKET(XID),
+    DATE TEXT,
+    STATE TEXT,
+    CREATED TEXT,
+    UPDATED TEXT,
+    TOTAL INTEGER DEFAULT 0,
+    DELETED INTEGER DEFAULT 0,
+    FAILED INTEGER DEFAULT 0
+    );
+    CREATE TABLE IF NOT EXISTS TRIM_JOB_VERSIONS (
+    XID INTEGER PRIMARY KEY,
+    JOB_XID INTEGER REFERENCES TRIM_JOBS(XID),
+    LAST_MODIFIED TEXT,
+    KEY TEXT,
+    VERSION_ID TEXT,
+    STATE CHAR,
+    REASON TEXT
+    );
+    CREATE INDEX IF NOT EXISTS TRIM_JOB_VERSIONS_JOB_STATE ON TRIM_JOB_VERSIONS (JOB_XID, STATE, XID);
+    """,
+    # 5: LAST_MODIFIED_US, LAST_MODIFIED as integer microseconds since the
+    # epoch, is the one dates are compared with and indexed on; LAST_MODIFIED
+    # keeps the text of the listings (S3 timestamps have millisecond precision,
+    # the one of julianday)
+    """
+    ALTER TABLE OBJECTS ADD COLUMN LAST_MODIFIED_US INTEGER;
+    UPDATE OBJECTS SET LAST_MODIFIED_US = CAST(round((julianday(LAST_MODIFIED) - 2440587.5) * 86400000.0) AS INTEGER) * 1000;
+    DROP INDEX IF EXISTS OBJECTS_BUCKET_KEY_LAST_MODIFIED;
+    DROP INDEX IF EXISTS OBJECTS_BUCKET_LAST_MODIFIED;
+    CREATE INDEX IF NOT EXISTS OBJECTS_BUCKET_KEY_LAST_MODIFIED ON OBJECTS (BUCKET_XID, KEY, LAST_MODIFIED_US);
+    CREATE INDEX IF NOT EXISTS OBJECTS_BUCKET_LAST_MODIFIED ON OBJECTS (BUCKET_XID, LAST_MODIFIED_US);
+    """,
+]
+
+SCHEMA_VERSION = len(MIGRATIONS)
+
+OBJECT_COLUMNS = """OBJECTS.*,
+               OWNERS.DISPLAY_NAME AS OWNER_DISPLAY_NAME,
+               OWNERS.ID AS OWNER_ID"""
 
 class SQLiteAccess:
 
     db_name = config.DB_FILE
     database = None
 
-    def open(self, filename):
+    def __init__(self):
+        self.owners = {}
+        # serializes the write transactions of the threads sharing the connection
+        self.lock = threading.RLock()
+
+    def open(self, filename, shared=False):
         logger.debug('connecting {} sqlite db'.format(self.db_name))
         if self.database is not None:
             self.database.close()
-        self.database = sqlite3.connect(filename, isolation_level='DEFERRED')
+        self.owners = {}
+        # a shared connection is used by the worker threads too
+        self.database = sqlite3.connect(filename,
+                                        isolation_level='DEFERRED',
+                                        timeout=config.DB_BUSY_TIMEOUT,
+                                        check_same_thread=not shared)
         self.database.row_factory = sqlite3.Row
+        # WAL lets readers run while a fetch or trim is writing
+        self.database.execute('PRAGMA journal_mode = WAL')
+        self.database.execute('PRAGMA synchronous = NORMAL')
+        self.database.execute('PRAGMA cache_size = -{}'.format(config.DB_CACHE_SIZE // 1024))
+        self.database.execute('PRAGMA mmap_size = {}'.format(config.DB_MMAP_SIZE))
+        self.database.execute('PRAGMA temp_store = MEMORY')
+
+    def open_default(self, shared=False):
+        self.open(self.db_name, shared)
 
-    def open_default(self):
-        self.open(self.db_name)
+    def close(self):
+        if self.database is not None:
+            self.database.close()
+            self.database = None
 
     def exists(self):
         return os.path.isfile(self.db_name)
 
     def purge(self):
+        close_default_db()
         os.remove(self.db_name)
+        for suffix in ('-wal', '-shm'):
+            if os.path.isfile(self.db_name + suffix):
+                os.remove(self.db_name + suffix)
 
     def health_or_die(self):
         querys = [
@@ -60,45 +164,190 @@ class SQLiteAccess:
             logger.debug('Error health_or_die()')
             print('Error db requires proper initilization')
             exit(-1)
+        self.migrate()
 
-    def delete_all_content(self):
-        sql_ddl = """
-        DELETE FROM BUCKET;
-        DELETE FROM OWNERS;
-        DELETE FROM OBJECTS;
-        """
-        self.open_default()
-        logger.debug('deleting db tables content')
-        try:
-            self.database.executescript(sql_ddl)
-        except sqlite3.OperationalError:
-            logger.debug('Error db.delete_all_content()')
-            raise
-        logger.debug('db tables deleted')
+    def get_schema_version(self):
+        return self.database.execute('PRAGMA user_version').fetchone()[0]
 
-    def delete_objects_below_date(self, tdate):
-        # validate tdate
-        try:
-             dateutil.parser.parse(tdate)
-        except:
-             logger.debug('Error db.delete_objects_below_date() parsing trimming date')
-             print('Error invalid date')
-             exit(-1)
-
-        sql_ddl = """
-        delete from objects where last_modified < '{}';
-        """.format(tdate);
-        self.open_default()
-        logger.debug('Deleting db tables content')
+    def migrate(self):
+        version = self.get_schema_version()
+        if version > SCHEMA_VERSION:
+            logger.debug('Error db schema version {} is newer than {}'.format(version, SCHEMA_VERSION))
+            print('Error db schema version {} not supported'.format(version))
+            exit(-1)
+        while version < SCHEMA_VERSION:
+            logger.debug('Migrating db schema from version {} to {}'.format(version, version + 1))
+            sql_ddl = """
+            BEGIN IMMEDIATE;
+            {}
+            PRAGMA user_version = {};
+            COMMIT;
+            """.format(MIGRATIONS[version], version + 1)
+            try:
+                self.database.executescript(sql_ddl)
+            except sqlite3.OperationalError:
+                logger.debug('Error db.migrate()')
+                if self.database.in_transaction:
+                    self.database.rollback()
+                raise
+            version += 1
+
+    def add_trim_job(self, bucket_xid, tdate):
+        # the versions below tdate (microseconds since the epoch), in
+        # LAST_MODIFIED order, become the pending versions of a new job
+        insert_into_trim_jobs = """
+        INSERT INTO TRIM_JOBS (BUCKET_XID, DATE, STATE, CREATED, UPDATED)
+                    VALUES (?, strftime('%Y-%m-%dT%H:%M:%fZ', ? / 1000000.0, 'unixepoch'),
+                            'running', strftime('%Y-%m-%dT%H:%M:%fZ', 'now'),
+                                             strftime('%Y-%m-%dT%H:%M:%fZ', 'now'));
+        """
+        insert_into_trim_job_versions = """
+        INSERT INTO TRIM_JOB_VERSIONS (JOB_XID, LAST_MODIFIED, KEY, VERSION_ID, STATE)
+        SELECT ?, LAST_MODIFIED, KEY, VERSION_ID, 'P'
+          FROM OBJECTS
+         WHERE BUCKET_XID = ? AND LAST_MODIFIED_US < ?
+         ORDER BY LAST_MODIFIED_US, XID;
+        """
+        update_trim_jobs_total = """
+        UPDATE TRIM_JOBS SET TOTAL = ? WHERE XID = ?;
+        """
+        with self.lock, stats.span('db.add_trim_job'):
+            self._begin_tx()
+            try:
+                job_xid = self.database.execute(insert_into_trim_jobs, (bucket_xid, tdate)).lastrowid
+                n = self.database.execute(insert_into_trim_job_versions, (job_xid, bucket_xid, tdate)).rowcount
+                self.database.execute(update_trim_jobs_total, (n, job_xid))
+            except Exception:
+                logger.debug('Rollback sql transaction')
+                self.database.rollback()
+                raise
+            self._end_tx()
+        return self.get_trim_job(job_xid)
+
+    def get_trim_job(self, job_xid):
+        query_trim_job = """
+        SELECT * FROM TRIM_JOBS WHERE XID = ?
+        """
         try:
-            self.database.executescript(sql_ddl)
+            row = self.database.execute(query_trim_job, (job_xid,)).fetchone()
         except sqlite3.OperationalError:
-            logger.debug('Error db.delete_objects_below_date()')
+            logger.debug('Error db.get_trim_job()')
             raise
-        logger.debug('db objects deleted')
+        if row is None:
+            return None
+        return _row_to_trim_job(row)
+
+    def get_trim_jobs(self, states=('running', 'failed')):
+        query_trim_jobs = """
+        SELECT * FROM TRIM_JOBS WHERE STATE IN ({}) ORDER BY XID;
+        """.format(','.join('?' * len(states)))
+        return RecordsIt(self, query_trim_jobs, states, 'get_trim_jobs', _row_to_trim_job)
+
+    def get_trim_job_versions(self, job_xid, after=0, limit=None):
+        # pending versions of job, keyset paged by XID (after = XID of the
+        # last version of the previous page)
+        query_trim_job_versions = """
+        SELECT XID, LAST_MODIFIED, KEY, VERSION_ID
+          FROM TRIM_JOB_VERSIONS
+         WHERE JOB_XID = ? AND STATE = 'P' AND XID > ?
+         ORDER BY XID{};
+        """
+        params = [job_xid, after]
+        if limit is not None:
+            params.append(limit)
+        return RecordsIt(self,
+                         query_trim_job_versions.format(' LIMIT ?' if limit is not None else ''),
+                         params,
+                         'get_trim_job_versions',
+                         lambda row: TrimJobVersion(*row))
+
+    def resume_trim_job(self, job_xid):
+        # failed versions are tried again
+        update_trim_job_versions = """
+        UPDATE TRIM_JOB_VERSIONS SET STATE = 'P', REASON = NULL WHERE JOB_XID = ? AND STATE = 'F';
+        """
+        update_trim_jobs = """
+        UPDATE TRIM_JOBS SET STATE = 'running',
+                             FAILED = 0,
+                             UPDATED = strftime('%Y-%m-%dT%H:%M:%fZ', 'now')
+         WHERE XID = ?;
+        """
+        with self.lock, stats.span('db.resume_trim_job'):
+            self._begin_tx()
+            try:
+                self.database.execute(update_trim_job_versions, (job_xid,))
+                self.database.execute(update_trim_jobs, (job_xid,))
+            except Exception:
+                logger.debug('Rollback sql transaction')
+                self.database.rollback()
+                raise
+            self._end_tx()
+        return self.get_trim_job(job_xid)
+
+    def checkpoint_trim_job(self, job, deleted, failed):
+        # versions gone from storage leave the catalog in the same transaction
+        # that marks them deleted, failed = [(version, reason)]
+        delete_from_objects = """
+        DELETE FROM OBJECTS WHERE BUCKET_XID = ? AND KEY = ? AND VERSION_ID = ?;
+        """
+        update_trim_job_versions_deleted = """
+        UPDATE TRIM_JOB_VERSIONS SET STATE = 'D' WHERE XID = ?;
+        """
+        update_trim_job_versions_failed = """
+        UPDATE TRIM_JOB_VERSIONS SET STATE = 'F', REASON = ? WHERE XID = ?;
+        """
+        update_trim_jobs = """
+        UPDATE TRIM_JOBS SET DELETED = DELETED + ?,
+                             FAILED = FAILED + ?,
+                             UPDATED = strftime('%Y-%m-%dT%H:%M:%fZ', 'now')
+         WHERE XID = ?;
+        """
+        with self.lock, stats.span('db.checkpoint_trim_job'):
+            self._begin_tx()
+            try:
+                n = 0
+                for v in deleted:
+                    n += self.database.execute(delete_from_objects, (job.bucket_xid, v.key, v.version_id)).rowcount
+                self.database.executemany(update_trim_job_versions_deleted, ((v.xid,) for v in deleted))
+                self.database.executemany(update_trim_job_versions_failed,
+                                          ((reason, v.xid) for (v, reason) in failed))
+                self.database.execute(update_trim_jobs, (len(deleted), len(failed), job.xid))
+            except Exception:
+                logger.debug('Rollback sql transaction')
+                self.database.rollback()
+                raise
+            self._end_tx()
+        stats.add('db.rows_deleted', n)
+
+    def end_trim_job(self, job_xid):
+        # a job without failures is done and its versions are dropped, the
+        # failed ones are kept for --resume
+        update_trim_jobs = """
+        UPDATE TRIM_JOBS SET STATE = CASE WHEN FAILED = 0 THEN 'done' ELSE 'failed' END,
+                             UPDATED = strftime('%Y-%m-%dT%H:%M:%fZ', 'now')
+         WHERE XID = ?;
+        """
+        delete_from_trim_job_versions = """
+        DELETE FROM TRIM_JOB_VERSIONS
+         WHERE JOB_XID = ? AND (SELECT STATE FROM TRIM_JOBS WHERE XID = ?) = 'done';
+        """
+        with self.lock, stats.span('db.end_trim_job'):
+            self._begin_tx()
+            try:
+                self.database.execute(update_trim_jobs, (job_xid,))
+                self.database.execute(delete_from_trim_job_versions, (job_xid, job_xid))
+            except Exception:
+                logger.debug('Rollback sql transaction')
+                self.database.rollback()
+                raise
+            self._end_tx()
+        return self.get_trim_job(job_xid)
 
     def _begin_tx(self):
-        self.database.execute('BEGIN')
+        # write transactions take the write lock up front, the busy timeout
+        # then waits for other caz processes instead of failing the upgrade
+        # of a read transaction with SQLITE_BUSY
+        self.database.execute('BEGIN IMMEDIATE')
 
     def _step_tx(self, sql_l):
         try:
@@ -120,11 +369,6 @@ class SQLiteAccess:
             self.database.rollback()
             raise
 
-    def _execute_tx(self, sql_l):
-        self._begin_tx()
-        self._step_tx(sql_l)
-        self._end_tx()
-
     def set_up(self):
         logger.debug('Setting up sqlite db')
         sql_ddl = """
@@ -157,200 +401,163 @@ class SQLiteAccess:
         except sqlite3.OperationalError:
             logger.debug('Error db.set_up()')
             raise
+        self.migrate()
         logger.debug('db tables created')
 
-    def get_owner_by_xid(self, xid):
-        query_owner_by_xid = """
-        SELECT * FROM OWNERS WHERE XID = ?
+    def _get_owner(self, xid, display_name, id):
+        # owners are interned by xid for the life of this instance
+        owner = self.owners.get(xid)
+        if owner is None:
+            owner = S3Owner(xid, display_name, id)
+            self.owners[xid] = owner
+        return owner
+
+    def _row_to_object(self, row):
+        s3o = self._get_owner(row['owner_xid'], row['owner_display_name'], row['owner_id'])
+        if row['type'] == 'V':
+            return S3Version(row['xid'],
+                             row['last_modified'],
+                             row['version_id'],
+                             row['etag'],
+                             row['storage_class'],
+                             row['key'],
+                             s3o,
+                             row['is_latest'],
+                             row['size'])
+        return S3DeleteMarker(row['xid'],
+                              row['last_modified'],
+                              row['version_id'],
+                              row['key'],
+                              s3o,
+                              row['is_latest'])
+
+    def _query_objects(self, where, params, order_by, name, columns=None):
+        # columns, a select list over OBJECTS and OWNERS, returns plain tuples
+        # instead of S3 objects
+        query_objects = """
+        SELECT {}
+          FROM OBJECTS LEFT JOIN OWNERS ON OWNERS.XID = OBJECTS.OWNER_XID
+          {} {};
+        """.format(columns or OBJECT_COLUMNS, where, order_by)
+        return RecordsIt(self, query_objects, params, name, None if columns else self._row_to_object)
+
+    def get_objects_by_key_and_last_modified(self, bucket_xid, key, order='desc', filters=None, columns=None):
+        (where, params, limit) = _filters_where(filters, ['BUCKET_XID = ?', 'KEY = ?'], [bucket_xid, key])
+        return self._query_objects(where,
+                                   params,
+                                   'ORDER BY LAST_MODIFIED_US {}{}'.format(_order(order), limit),
+                                   'get_objects_by_key_and_last_modified',
+                                   columns)
+
+    def get_objects_by_last_modified(self, bucket_xid, order='desc', filters=None, columns=None):
+        (where, params, limit) = _filters_where(filters, ['BUCKET_XID = ?'], [bucket_xid])
+        return self._query_objects(where,
+                                   params,
+                                   'ORDER BY LAST_MODIFIED_US {}{}'.format(_order(order), limit),
+                                   'get_objects_by_last_modified',
+                                   columns)
+
+    def get_trim_plan(self, bucket_xid, date):
+        # (prefix, storage class, type, versions, bytes, keys) of the versions
+        # below date, grouped by top level prefix, storage class and type;
+        # keys counts the latest versions below date, the keys losing every
+        # version. One range scan of the (BUCKET_XID, LAST_MODIFIED_US) index,
+        # reading the rows it selects; the GROUP BY sort takes most of the time
+        query_trim_plan = """
+        SELECT substr(KEY, 1, instr(KEY, '/')) AS PREFIX,
+               STORAGE_CLASS,
+               TYPE,
+               COUNT(*),
+               SUM(SIZE),
+               SUM(IS_LATEST)
+          FROM OBJECTS
+         WHERE BUCKET_XID = ? AND LAST_MODIFIED_US < ?
+         GROUP BY PREFIX, STORAGE_CLASS, TYPE;
         """
-        try:
-            row = self.database.execute(query_owner_by_xid, (xid,)).fetchone()
-        except sqlite3.OperationalError:
-            logger.debug('Error db.get_owner_by_xid()')
-            raise
-        if row is None:
-            return None
-        return S3Owner(row['xid'], row['display_name'], row['id'])
-
-    def get_owner_by_id(self, id):
-        query_owner_by_id = """
-        SELECT * FROM OWNERS WHERE ID = ?
+        return RecordsIt(self, query_trim_plan, (bucket_xid, date), 'get_trim_plan', None)
+
+    def get_keys_below_date(self, bucket_xid, date, limit=None):
+        # keys whose latest version, and so every version, is below date
+        query_keys_below_date = """
+        SELECT KEY
+          FROM OBJECTS
+         WHERE BUCKET_XID = ? AND LAST_MODIFIED_US < ? AND IS_LATEST = 1
+         ORDER BY KEY{};
         """
-        try:
-            row = self.database.execute(query_owner_by_id, (id,)).fetchone()
-        except sqlite3.OperationalError:
-            logger.debug('Error db.get_owner_by_id()')
-            raise
-        if row is None:
-            return None
-        return S3Owner(row['xid'], row['display_name'], row['id'])
-
-    def get_object_by_version_id(self, version_id):
-        query_object_by_version_id = """
-        SELECT * FROM OBJECTS WHERE VERSION_ID = ?
+        params = [bucket_xid, date]
+        if limit is not None:
+            params.append(limit)
+        return RecordsIt(self,
+                         query_keys_below_date.format(' LIMIT ?' if limit is not None else ''),
+                         params,
+                         'get_keys_below_date',
+                         lambda row: row['key'])
+
+    def get_objects_at_date(self, bucket_xid, date, prefix=None, columns=None):
+        # latest version or delete marker of every key with LAST_MODIFIED <= date,
+        # in key order; the window walks the (BUCKET_XID, KEY, LAST_MODIFIED_US)
+        # index (+LAST_MODIFIED_US keeps the planner off the LAST_MODIFIED_US
+        # one) so rows stream out without a full sort, and the CROSS JOIN keeps
+        # the window as the outer loop instead of materializing it. Versions
+        # sharing a LAST_MODIFIED_US are ordered as listed, newest first (the
+        # latest one, then the lowest XID), so the newest one is the last
+        query_objects_at_date = """
+        SELECT {}
+          FROM (SELECT XID,
+                       LEAD(XID) OVER (PARTITION BY KEY
+                                       ORDER BY LAST_MODIFIED_US, IS_LATEST, XID DESC) AS NEXT_XID
+                  FROM OBJECTS
+                 WHERE BUCKET_XID = ? AND +LAST_MODIFIED_US <= ? {}) AT_DATE
+         CROSS JOIN OBJECTS ON OBJECTS.XID = AT_DATE.XID
+          LEFT JOIN OWNERS ON OWNERS.XID = OBJECTS.OWNER_XID
+         WHERE AT_DATE.NEXT_XID IS NULL;
         """
-        try:
-            row = self.database.execute(query_object_by_version_id, (version_id,)).fetchone()
-        except sqlite3.OperationalError:
-            logger.debug('Error db.get_object_by_version_id()')
-            raise
-        if row is None:
-            return None
-        s3o = self.get_owner_by_xid(row['owner_xid'])
-        return S3Version(row['xid'],
-                         row['last_modified'],
-                         row['version_id'],
-                         row['etag'],
-                         row['storage_class'],
-                         row['key'],
-                         s3o,
-                         row['is_latest'],
-                         row['size'])
-
-    def get_objects_by_key_and_last_modified(self, key, order='desc'):
-
-        class RecordsIt(object):
-
-            def __init__(self, parent, key, order):
-                self.parent = parent
-                self.query_objects_by_key_and_last_modified = """
-                select * from objects where key = '{}' order by last_modified {};
-                """.format(key,order)
-                try:
-                    self.cursor = self.parent.database.execute(self.query_objects_by_key_and_last_modified)
-                except sqlite3.OperationalError:
-                    logger.debug('Error db.get_objects_by_last_modified()')
-                    raise
-
-            def __iter__(self):
-                return self
-
-            def __next__(self):
-              row = self.cursor.fetchone()
-              if row is None:
-                  raise StopIteration
-              s3o = self.parent.get_owner_by_xid(row['owner_xid'])
-              if row['type'] == 'V':
-                  s3x = S3Version(row['xid'],
-                                  row['last_modified'],
-                                  row['version_id'],
-                                  row['etag'],
-                                  row['storage_class'],
-                                  row['key'],
-                                  s3o,
-                                  row['is_latest'],
-                                  row['size'])
-              else:
-                  s3x = S3DeleteMarker(row['xid'],
-                                       row['last_modified'],
-                                       row['version_id'],
-                                       row['key'],
-                                       s3o,
-                                       row['is_latest'])
-              return s3x
-
-        return RecordsIt(self, key, order)
-
-
-    def get_objects_by_last_modified(self, order='desc'):
-
-        class RecordsIt(object):
-
-            def __init__(self, parent, order):
-                self.parent = parent
-                self.query_objects_by_last_modified = """
-                select * from objects order by last_modified {};
-                """.format(order)
-                try:
-                    self.cursor = self.parent.database.execute(self.query_objects_by_last_modified)
-                except sqlite3.OperationalError:
-                    logger.debug('Error db.get_objects_by_last_modified()')
-                    raise
-
-            def __iter__(self):
-                return self
-
-            def __next__(self):
-              row = self.cursor.fetchone()
-              if row is None:
-                  raise StopIteration
-              s3o = self.parent.get_owner_by_xid(row['owner_xid'])
-              if row['type'] == 'V':
-                  s3x = S3Version(row['xid'],
-                                  row['last_modified'],
-                                  row['version_id'],
-                                  row['etag'],
-                                  row['storage_class'],
-                                  row['key'],
-                                  s3o,
-                                  row['is_latest'],
-                                  row['size'])
-              else:
-                  s3x = S3DeleteMarker(row['xid'],
-                                       row['last_modified'],
-                                       row['version_id'],
-                                       row['key'],
-                                       s3o,
-                                       row['is_latest'])
-              return s3x
-
-        return RecordsIt(self, order)
-
-    def get_objects_by_last_modified_below_date(self, date, order='desc'):
-
-        class RecordsIt(object):
-
-            def __init__(self, parent, order):
-                self.parent = parent
-                self.query_objects_by_last_modified_below_date = """
-                select * from objects where last_modified < '{}' order by last_modified {};
-                """.format(date, order)
-                try:
-                    self.cursor = self.parent.database.execute(self.query_objects_by_last_modified_below_date)
-                except sqlite3.OperationalError:
-                    logger.debug('Error db.get_objects_by_last_modified_below_date()')
-                    raise
-
-            def __iter__(self):
-                return self
-
-            def __next__(self):
-              row = self.cursor.fetchone()
-              if row is None:
-                  raise StopIteration
-              s3o = self.parent.get_owner_by_xid(row['owner_xid'])
-              if row['type'] == 'V':
-                  s3x = S3Version(row['xid'],
-                                  row['last_modified'],
-                                  row['version_id'],
-                                  row['etag'],
-                                  row['storage_class'],
-                                  row['key'],
-                                  s3o,
-                                  row['is_latest'],
-                                  row['size'])
-              else:
-                  s3x = S3DeleteMarker(row['xid'],
-                                       row['last_modified'],
-                                       row['version_id'],
-                                       row['key'],
-                                       s3o,
-                                       row['is_latest'])
-              return s3x
-
-        return RecordsIt(self, order)
-
-    def add_object(self, obj):
-
+        (where, params) = _prefix_where(prefix)
+        return RecordsIt(self,
+                         query_objects_at_date.format(columns or OBJECT_COLUMNS,
+                                                      'AND ' + where if where else ''),
+                         (bucket_xid, date) + params,
+                         'get_objects_at_date',
+                         None if columns else self._row_to_object)
+
+    def _get_owner_xids(self, owners):
+        # map owner id -> xid, inserting the owners not yet known; versions
+        # listed without an owner (id None) get no OWNERS row
         insert_into_owners = """
         INSERT INTO OWNERS (XID,
                             DISPLAY_NAME,
                             ID)
                     VALUES (?,?,?);
         """
+        xids = self._query_owner_xids([id for id in owners if id is not None])
+        if None in owners:
+            xids[None] = None
+        missing = [id for id in owners if id not in xids]
+        if missing:
+            self.database.executemany(insert_into_owners,
+                                      ((None, owners[id], id) for id in missing))
+            xids.update(self._query_owner_xids(missing))
+        return xids
+
+    def _query_owner_xids(self, ids):
+        query_owners_by_id = """
+        SELECT XID, ID FROM OWNERS WHERE ID IN ({})
+        """
+        xids = {}
+        # keep below the sqlite host parameter limit
+        for i in range(0, len(ids), 500):
+            chunk = ids[i:i + 500]
+            q = query_owners_by_id.format(','.join('?' * len(chunk)))
+            for row in self.database.execute(q, chunk):
+                xids[row['id']] = row['xid']
+        return xids
+
+    def add_objects(self, bucket_xid, objs, refresh=False):
 
         insert_into_objects = """
-        INSERT INTO OBJECTS (LAST_MODIFIED,
+        INSERT INTO OBJECTS (BUCKET_XID,
+                             LAST_MODIFIED,
+                             LAST_MODIFIED_US,
                              VERSION_ID,
                              ETAG,
                              STORAGE_CLASS,
@@ -359,103 +566,303 @@ class SQLiteAccess:
                              IS_LATEST,
                              SIZE,
                              TYPE)
-                    VALUES (?,?,?,?,?,?,?,?,?);
+                    VALUES (?,?,?,?,?,?,?,?,?,?,?)
         """
 
-        # S3Version
-        obj_type = 'V'
-        if isinstance(obj, S3DeleteMarker):
-            # S3DeleteMarker
-            obj_type = 'D'
-
-        sql_l = []
+        upsert_objects = """
+            ON CONFLICT (BUCKET_XID, KEY, VERSION_ID) DO UPDATE SET
+                LAST_MODIFIED = excluded.LAST_MODIFIED,
+                LAST_MODIFIED_US = excluded.LAST_MODIFIED_US,
+                ETAG = excluded.ETAG,
+                STORAGE_CLASS = excluded.STORAGE_CLASS,
+                OWNER_XID = excluded.OWNER_XID,
+                IS_LATEST = excluded.IS_LATEST,
+                SIZE = excluded.SIZE,
+                TYPE = excluded.TYPE
+        """
 
-        self._begin_tx()
+        insert_into_refresh_seen = """
+        INSERT OR IGNORE INTO temp.REFRESH_SEEN (BUCKET_XID, KEY, VERSION_ID) VALUES (?,?,?);
+        """
 
-        owner = self.get_owner_by_id(obj.owner.id)
+        if refresh:
+            insert_into_objects += upsert_objects
+
+        objs = list(objs)
+        if not objs:
+            return 0
+
+        owners = {}
+        for obj in objs:
+            owners[obj.owner.id] = obj.owner.display_name
+
+        with self.lock, stats.span('db.add_objects'):
+
+            self._begin_tx()
+
+            try:
+                xids = self._get_owner_xids(owners)
+                self.database.executemany(insert_into_objects,
+                                          ((bucket_xid,
+                                            obj.last_modified,
+                                            to_epoch_us(obj.last_modified),
+                                            obj.version_id,
+                                            obj.etag,
+                                            obj.storage_class,
+                                            obj.key,
+                                            xids[obj.owner.id],
+                                            obj.is_latest,
+                                            obj.size,
+                                            # S3DeleteMarker or S3Version
+                                            'D' if isinstance(obj, S3DeleteMarker) else 'V')
+                                           for obj in objs))
+                if refresh:
+                    self.database.executemany(insert_into_refresh_seen,
+                                              ((bucket_xid, obj.key, obj.version_id) for obj in objs))
+            except Exception:
+                logger.debug('Rollback sql transaction')
+                self.database.rollback()
+                raise
+
+            self._end_tx()
+
+        stats.add('db.rows_inserted', len(objs))
+        return len(objs)
+
+    def begin_refresh(self, bucket_xid):
+        # versions seen while refreshing, add_objects(refresh=True) upserts
+        # into OBJECTS and records them here
+        create_refresh_seen = """
+        CREATE TEMP TABLE IF NOT EXISTS REFRESH_SEEN (
+        BUCKET_XID INTEGER,
+        KEY TEXT,
+        VERSION_ID TEXT,
+        PRIMARY KEY (BUCKET_XID, KEY, VERSION_ID)
+        ) WITHOUT ROWID;
+        """
+        delete_from_refresh_seen = """
+        DELETE FROM temp.REFRESH_SEEN WHERE BUCKET_XID = ?;
+        """
+        with self.lock, stats.span('db.begin_refresh'):
+            try:
+                self.database.execute(create_refresh_seen)
+                self.database.execute(delete_from_refresh_seen, (bucket_xid,))
+                self.database.commit()
+            except sqlite3.OperationalError:
+                logger.debug('Error db.begin_refresh()')
+                raise
+
+    def end_refresh(self, bucket_xid, prefix=None):
+        # drop the catalog versions under prefix that the refresh did not see
+        delete_unseen_objects = """
+        DELETE FROM OBJECTS
+         WHERE BUCKET_XID = ? {}
+           AND NOT EXISTS (SELECT 1 FROM temp.REFRESH_SEEN S
+                            WHERE S.BUCKET_XID = OBJECTS.BUCKET_XID
+                              AND S.KEY = OBJECTS.KEY
+                              AND S.VERSION_ID = OBJECTS.VERSION_ID);
+        """
+        delete_from_refresh_seen = """
+        DELETE FROM temp.REFRESH_SEEN WHERE BUCKET_XID = ?;
+        """
+        (where, params) = _prefix_where(prefix)
+        with self.lock, stats.span('db.end_refresh'):
+            self._begin_tx()
+            try:
+                n = self.database.execute(delete_unseen_objects.format('AND ' + where if where else ''),
+                                          (bucket_xid,) + params).rowcount
+                self.database.execute(delete_from_refresh_seen, (bucket_xid,))
+            except Exception:
+                logger.debug('Rollback sql transaction')
+                self.database.rollback()
+                raise
+            self._end_tx()
+        stats.add('db.rows_deleted', n)
+        return n
 
-        if owner is None:
-            owner  = (None,
-                      obj.owner.display_name,
-                      obj.owner.id)
-            sql_l.append((insert_into_owners,owner))
-            self._step_tx(sql_l)
-            sql_l = []
-            owner = self.get_owner_by_id(obj.owner.id)
-            assert(owner is not None)
+    def add_bucket_name(self, bucket_name):
 
-        object = (obj.last_modified,
-                  obj.version_id,
-                  obj.etag,
-                  obj.storage_class,
-                  obj.key,
-                  owner.xid,
-                  obj.is_latest,
-                  obj.size,
-                  obj_type)
+        insert_into_bucket = """
+        INSERT OR IGNORE INTO BUCKET (NAME) VALUES (?);
+        """
 
-        sql_l.append((insert_into_objects,object))
+        sql_l = []
 
-        self._step_tx(sql_l)
+        with self.lock:
 
-        self._end_tx()
+            self._begin_tx()
 
-    def add_bucket_name(self, bucket_name):
+            bucket = (bucket_name,)
 
-        insert_into_bucket = """
-        INSERT INTO BUCKET (NAME) VALUES (?);
-        """
+            sql_l.append((insert_into_bucket, bucket))
 
-        sql_l = []
+            self._step_tx(sql_l)
 
-        self._begin_tx()
+            self._end_tx()
 
-        bucket = (bucket_name,)
+        return self.get_bucket_xid(bucket_name)
 
-        sql_l.append((insert_into_bucket, bucket))
+    def get_bucket_xid(self, bucket_name):
 
-        self._step_tx(sql_l)
+        query_bucket_xid = """
+        SELECT XID FROM BUCKET WHERE NAME = ?
+        """
 
-        self._end_tx()
+        try:
+            row = self.database.execute(query_bucket_xid, (bucket_name,)).fetchone()
+        except sqlite3.OperationalError:
+            logger.debug('Error db.get_bucket_xid()')
+            raise
 
-    def get_bucket_name(self):
+        if row is None:
+            return None
+        return row['xid']
 
+    def get_bucket_name(self, bucket_xid):
         query_bucket_name = """
-        SELECT name FROM BUCKET
+        SELECT NAME FROM BUCKET WHERE XID = ?
         """
-
         try:
-            row = self.database.execute(query_bucket_name).fetchone()
+            row = self.database.execute(query_bucket_name, (bucket_xid,)).fetchone()
         except sqlite3.OperationalError:
             logger.debug('Error db.get_bucket_name()')
             raise
-
         if row is None:
             return None
         return row['name']
 
-    def get_all_keys(self, order='asc'):
-
-        class RecordsIt(object):
-
-            def __init__(self, parent, order):
-                self.parent = parent
-                self.query_objects_all_keys = """
-                select distinct(key) from objects order by key {};
-                """.format(order)
-                try:
-                    self.cursor = self.parent.database.execute(self.query_objects_all_keys)
-                except sqlite3.OperationalError:
-                    logger.debug('Error db.get_all_keys()')
-                    raise
-
-            def __iter__(self):
-                return self
+    def get_bucket_names(self):
+        query_bucket_names = """
+        SELECT NAME FROM BUCKET ORDER BY NAME;
+        """
+        return RecordsIt(self, query_bucket_names, (), 'get_bucket_names',
+                         lambda row: row['name'])
+
+    def get_all_keys(self, bucket_xid, order='asc', filters=None, columns=None):
+        # keys with at least one version or delete marker matching filters
+        (where, params, limit) = _filters_where(filters, ['BUCKET_XID = ?'], [bucket_xid])
+        query_objects_all_keys = """
+        SELECT {} FROM OBJECTS {} GROUP BY KEY ORDER BY KEY {}{};
+        """.format(columns or 'KEY', where, _order(order), limit)
+        return RecordsIt(self, query_objects_all_keys, params, 'get_all_keys',
+                         None if columns else lambda row: row['key'])
+
+_default_db = None
+_default_db_lock = threading.Lock()
+_thread_db = threading.local()
+
+def get_default_db():
+    # process-wide connection, opened and validated once, unless the thread
+    # runs with a connection of its own (see thread_db)
+    global _default_db
+    db = getattr(_thread_db, 'db', None)
+    if db is not None:
+        return db
+    with _default_db_lock:
+        if _default_db is None:
+            db = SQLiteAccess()
+            db.open_default(shared=True)
+            db.health_or_die()
+            _default_db = db
+        return _default_db
+
+def close_default_db():
+    global _default_db
+    with _default_db_lock:
+        if _default_db is not None:
+            _default_db.close()
+            _default_db = None
+
+@contextlib.contextmanager
+def thread_db(db):
+    # get_default_db returns db to the calling thread meanwhile
+    _thread_db.db = db
+    try:
+        yield db
+    finally:
+        _thread_db.db = None
+
+def _row_to_trim_job(row):
+    return TrimJob(row['xid'],
+                   row['bucket_xid'],
+                   row['date'],
+                   row['state'],
+                   row['created'],
+                   row['updated'],
+                   row['total'],
+                   row['deleted'],
+                   row['failed'])
+
+def _prefix_where(prefix):
+    # index friendly KEY range for a key prefix
+    if not prefix:
+        return ('', ())
+    upper = prefix[:-1] + chr(ord(prefix[-1]) + 1)
+    return ('KEY >= ? AND KEY < ?', (prefix, upper))
+
+def _filters_where(filters, where, params):
+    # WHERE clause and LIMIT for the listing filters, every value is bound
+    # as a parameter; filters keys: prefix, since, until, type, latest_only,
+    # min_size, max_size and limit
+    filters = filters or {}
+    where = list(where)
+    params = list(params)
+    (prefix_where, prefix_params) = _prefix_where(filters.get('prefix'))
+    if prefix_where:
+        where.append(prefix_where)
+        params.extend(prefix_params)
+    if filters.get('since') is not None:
+        where.append('LAST_MODIFIED_US >= ?')
+        params.append(filters['since'])
+    if filters.get('until') is not None:
+        where.append('LAST_MODIFIED_US <= ?')
+        params.append(filters['until'])
+    if filters.get('type') is not None:
+        where.append('TYPE = ?')
+        params.append(filters['type'])
+    if filters.get('latest_only'):
+        where.append('IS_LATEST = 1')
+    if filters.get('min_size') is not None:
+        where.append('SIZE >= ?')
+        params.append(filters['min_size'])
+    if filters.get('max_size') is not None:
+        where.append('SIZE <= ?')
+        params.append(filters['max_size'])
+    limit = ''
+    if filters.get('limit') is not None:
+        limit = ' LIMIT ?'
+        params.append(filters['limit'])
+    return ('WHERE ' + ' AND '.join(where) if where else '', params, limit)
+
+def _order(order):
+    if order.lower() not in ('asc', 'desc'):
+        raise ValueError('Invalid sort order : {}'.format(order))
+    return order.upper()
+
+class RecordsIt(object):
+
+    # mapper None iterates the plain tuples of the sqlite cursor
+    def __init__(self, parent, query, params, name, mapper):
+        self.parent = parent
+        self.mapper = mapper
+        try:
+            self.cursor = self.parent.database.cursor()
+            if mapper is None:
+                self.cursor.row_factory = None
+            # time to the first row, the rest streams to the caller
+            with stats.span('db.' + name):
+                self.cursor.execute(query, params)
+        except sqlite3.OperationalError:
+            logger.debug('Error db.{}()'.format(name))
+            raise
 
-            def __next__(self):
-              row = self.cursor.fetchone()
-              if row is None:
-                  raise StopIteration
-              return row['key']
+    def __iter__(self):
+        if self.mapper is None:
+            return self.cursor
+        return self
 
-        return RecordsIt(self, order)
+    def __next__(self):
+        row = self.cursor.fetchone()
+        if row is None:
+            raise StopIteration
+        return self.mapper(row)
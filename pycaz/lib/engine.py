@@ -0,0 +1,128 @@
+# Copyright (c) 2018 Javier M. Mellid <jmunhoz@igalia.com>
+#
+# Permission is hereby granted, free of charge, to any person obtaining a copy
+# of this software and associated documentation files (the "Software"), to deal
+# in the Software without restriction, including without limitation the rights
+# to use, copy, modify, merge, publish, distribute, sublicense, and/or sell
+# copies of the Software, and to permit persons to whom the Software is
+# furnished to do so, subject to the following conditions:
+#
+# The above copyright notice and this permission notice shall be included in all
+# copies or substantial portions of the Software.
+#
+# THE SOFTWARE IS PROVIDED "AS IS", WITHOUT WARRANTY OF ANY KIND, EXPRESS OR
+# IMPLIED, INCLUDING BUT NOT LIMITED TO THE WARRANTIES OF MERCHANTABILITY,
+# FITNESS FOR A PARTICULAR PURPOSE AND NONINFRINGEMENT. IN NO EVENT SHALL THE
+# AUTHORS OR COPYRIGHT HOLDERS BE LIABLE FOR ANY CLAIM, DAMAGES OR OTHER
+# LIABILITY, WHETHER IN AN ACTION OF CONTRACT, TORT OR OTHERWISE, ARISING FROM,
+# OUT OF OR IN CONNECTION WITH THE SOFTWARE OR THE USE OR OTHER DEALINGS IN THE
+# SOFTWARE.
+
+# asyncio engine under the data source layer: the S3 requests of every
+# command run from one event loop, at most config.S3_MAX_REQUESTS in flight
+# per gateway. The pooled S3 client and the aws cli are blocking, so the
+# loop hands each request over to an executor thread once its gateways
+# have a free slot.
+
+import asyncio
+import collections
+import contextvars
+import threading
+import time
+
+from concurrent.futures import ThreadPoolExecutor
+
+from . import config
+from . import stats
+
+class EngineAbort(Exception):
+
+    # SystemExit raised by a request, carried back to the waiting thread
+    def __init__(self, code):
+        self.code = code
+
+def _call(f, *args):
+    # a SystemExit escaping into the loop would stop it
+    try:
+        return (f(*args), None)
+    except SystemExit as e:
+        return (None, e)
+
+def _result(future):
+    try:
+        return future.result()
+    except EngineAbort as e:
+        raise SystemExit(e.code)
+
+class S3Engine:
+
+    def __init__(self, max_requests):
+        self.max_requests = max_requests
+        # gateway -> semaphore, only touched from the loop
+        self.limits = {}
+        # a request holds at most one thread, a copy holds both gateways
+        self.executor = ThreadPoolExecutor(max_workers=2 * max_requests,
+                                           thread_name_prefix='caz-s3')
+        self.loop = asyncio.new_event_loop()
+        self.thread = threading.Thread(target=self.loop.run_forever,
+                                       name='caz-engine', daemon=True)
+        self.thread.start()
+
+    def _limit(self, gateway):
+        limit = self.limits.get(gateway)
+        if limit is None:
+            limit = self.limits[gateway] = asyncio.Semaphore(self.max_requests)
+        return limit
+
+    async def execute(self, gateways, f, *args):
+        # f(*args) on an executor thread, once every gateway has a free
+        # slot; slots are taken in gateway order so two copies never deadlock
+        acquired = []
+        start = time.perf_counter()
+        try:
+            for gateway in sorted(set(gateways)):
+                limit = self._limit(gateway)
+                await limit.acquire()
+                acquired.append(limit)
+            stats.record('engine.wait', time.perf_counter() - start)
+            # the caller context (its stdout under caz --serve) goes along
+            ctx = contextvars.copy_context()
+            (r, e) = await self.loop.run_in_executor(self.executor, ctx.run, _call, f, *args)
+        finally:
+            for limit in acquired:
+                limit.release()
+        if e is not None:
+            raise EngineAbort(e.code)
+        return r
+
+    def run(self, coro):
+        # sync facade, runs coro on the loop and waits for its result
+        if threading.current_thread() is self.thread:
+            raise RuntimeError('S3Engine.run() can not wait from the engine loop')
+        return _result(asyncio.run_coroutine_threadsafe(coro, self.loop))
+
+    def map(self, f, iterable, window):
+        # results of the f(item) coroutines in input order, at most window
+        # running; items are read as slots free up, never ahead of the window
+        pending = collections.deque()
+        try:
+            for item in iterable:
+                if len(pending) >= window:
+                    yield _result(pending.popleft())
+                pending.append(asyncio.run_coroutine_threadsafe(f(item), self.loop))
+            while pending:
+                yield _result(pending.popleft())
+        finally:
+            for future in pending:
+                future.cancel()
+
+_engine = None
+_engine_lock = threading.Lock()
+
+def get_engine():
+    # one engine, and so one set of gateway limits, per process
+    global _engine
+    with _engine_lock:
+        if _engine is None:
+            _engine = S3Engine(config.S3_MAX_REQUESTS)
+        return _engine
@@ -25,3 +25,21 @@ class ProcessException(Exception):
 
     def __str__(self):
         return repr(self.parameter)
+
+class S3ClientException(Exception):
+
+    def __init__(self, value, status=None, code=None):
+        self.parameter = value
+        self.status = status
+        self.code = code
+
+    def __str__(self):
+        return repr(self.parameter)
+
+class ServerException(Exception):
+
+    def __init__(self, value):
+        self.parameter = value
+
+    def __str__(self):
+        return repr(self.parameter)
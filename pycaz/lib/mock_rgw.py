@@ -0,0 +1,539 @@
+# Copyright (c) 2018 Javier M. Mellid <jmunhoz@igalia.com>
+#
+# Permission is hereby granted, free of charge, to any person obtaining a copy
+# of this software and associated documentation files (the "Software"), to deal
+# in the Software without restriction, including without limitation the rights
+# to use, copy, modify, merge, publish, distribute, sublicense, and/or sell
+# copies of the Software, and to permit persons to whom the Software is
+# furnished to do so, subject to the following conditions:
+#
+# The above copyright notice and this permission notice shall be included in all
+# copies or substantial portions of the Software.
+#
+# THE SOFTWARE IS PROVIDED "AS IS", WITHOUT WARRANTY OF ANY KIND, EXPRESS OR
+# IMPLIED, INCLUDING BUT NOT LIMITED TO THE WARRANTIES OF MERCHANTABILITY,
+# FITNESS FOR A PARTICULAR PURPOSE AND NONINFRINGEMENT. IN NO EVENT SHALL THE
+# AUTHORS OR COPYRIGHT HOLDERS BE LIABLE FOR ANY CLAIM, DAMAGES OR OTHER
+# LIABILITY, WHETHER IN AN ACTION OF CONTRACT, TORT OR OTHERWISE, ARISING FROM,
+# OUT OF OR IN CONNECTION WITH THE SOFTWARE OR THE USE OR OTHER DEALINGS IN THE
+# SOFTWARE.
+
+# Minimal in-memory RGW/S3 endpoint, enough of the versioned bucket API for
+# caz to run offline. Run two zones sharing one store with:
+#
+#   python3 -m pycaz.lib.mock_rgw --master-port 8000 --archive-port 8001
+
+import argparse
+import bisect
+import datetime
+import hashlib
+import threading
+import time
+import urllib.parse
+import uuid
+import xml.etree.ElementTree as ET
+
+from http.server import BaseHTTPRequestHandler, ThreadingHTTPServer
+from xml.sax.saxutils import escape
+
+S3_XMLNS = 'http://s3.amazonaws.com/doc/2006-03-01/'
+
+def _now():
+    return datetime.datetime.utcnow().strftime('%Y-%m-%dT%H:%M:%S.%f')[:-3] + 'Z'
+
+def _version_id():
+    return uuid.uuid4().hex
+
+def _prefix_end(prefix):
+    # smallest string sorting after every key starting with prefix
+    return prefix[:-1] + chr(ord(prefix[-1]) + 1)
+
+class MockStore:
+
+    def __init__(self):
+        self.lock = threading.RLock()
+        # bucket -> key -> [versions, newest first]
+        self.buckets = {}
+        # bucket -> sorted keys, dropped whenever a key is added or removed
+        self.sorted_keys = {}
+        # upload id -> multipart upload
+        self.uploads = {}
+
+    def create_bucket(self, bucket):
+        with self.lock:
+            self.buckets.setdefault(bucket, {})
+
+    def _versions(self, bucket, key):
+        versions = self.buckets[bucket].get(key)
+        if versions is None:
+            versions = self.buckets[bucket][key] = []
+            self.sorted_keys.pop(bucket, None)
+        return versions
+
+    def _sorted_keys(self, bucket):
+        keys = self.sorted_keys.get(bucket)
+        if keys is None:
+            keys = self.sorted_keys[bucket] = sorted(self.buckets[bucket])
+        return keys
+
+    def _key_versions(self, bucket, key):
+        return self.buckets[bucket][key]
+
+    def put(self, bucket, key, data, owner, headers=None, etag=None):
+        with self.lock:
+            if bucket not in self.buckets:
+                return None
+            v = {'Key': key,
+                 'VersionId': _version_id(),
+                 'LastModified': _now(),
+                 'Created': time.time(),
+                 'ETag': etag or '"{}"'.format(hashlib.md5(data).hexdigest()),
+                 'Size': len(data),
+                 'StorageClass': 'STANDARD',
+                 'Owner': owner,
+                 'IsDeleteMarker': False,
+                 'Headers': headers or {},
+                 'Data': data}
+            self._add(bucket, v)
+            return v
+
+    def create_upload(self, bucket, key, owner, headers):
+        with self.lock:
+            upload_id = _version_id()
+            self.uploads[upload_id] = {'Bucket': bucket,
+                                       'Key': key,
+                                       'Owner': owner,
+                                       'Headers': headers,
+                                       'Parts': {}}
+            return upload_id
+
+    def put_part(self, upload_id, part_number, data):
+        with self.lock:
+            upload = self.uploads.get(upload_id)
+            if upload is None:
+                return None
+            etag = '"{}"'.format(hashlib.md5(data).hexdigest())
+            upload['Parts'][part_number] = (etag, data)
+            return etag
+
+    def complete_upload(self, upload_id, parts):
+        with self.lock:
+            upload = self.uploads.pop(upload_id, None)
+            if upload is None:
+                return None
+            data = []
+            md5s = []
+            for (part_number, etag) in parts:
+                (part_etag, part_data) = upload['Parts'][part_number]
+                if part_etag != etag:
+                    return None
+                data.append(part_data)
+                md5s.append(bytes.fromhex(part_etag.strip('"')))
+            etag = '"{}-{}"'.format(hashlib.md5(b''.join(md5s)).hexdigest(), len(parts))
+            return self.put(upload['Bucket'], upload['Key'], b''.join(data),
+                            upload['Owner'], upload['Headers'], etag)
+
+    def abort_upload(self, upload_id):
+        with self.lock:
+            return self.uploads.pop(upload_id, None)
+
+    def add_delete_marker(self, bucket, key, owner):
+        with self.lock:
+            v = {'Key': key,
+                 'VersionId': _version_id(),
+                 'LastModified': _now(),
+                 'Created': time.time(),
+                 'Owner': owner,
+                 'IsDeleteMarker': True}
+            self._add(bucket, v)
+            return v
+
+    def _add(self, bucket, v):
+        self._versions(bucket, v['Key']).insert(0, v)
+
+    def _visible(self, versions, lag):
+        # versions written less than lag seconds ago are not replicated yet
+        if not lag:
+            return versions
+        now = time.time()
+        return [v for v in versions if now - v['Created'] >= lag]
+
+    def get(self, bucket, key, version_id=None, lag=0):
+        with self.lock:
+            versions = self._visible(self.buckets.get(bucket, {}).get(key, []), lag)
+            if version_id is None:
+                return versions[0] if versions else None
+            for v in versions:
+                if v['VersionId'] == version_id:
+                    return v
+            return None
+
+    def delete_version(self, bucket, key, version_id):
+        with self.lock:
+            versions = self.buckets.get(bucket, {}).get(key, [])
+            for v in versions:
+                if v['VersionId'] == version_id:
+                    versions.remove(v)
+                    if not versions:
+                        del self.buckets[bucket][key]
+                        self.sorted_keys.pop(bucket, None)
+                    return v
+            return None
+
+    def list_versions(self, bucket, prefix='', key_marker='', version_id_marker='',
+                      max_keys=1000, delimiter='', lag=0):
+        with self.lock:
+            keys = self._sorted_keys(bucket)
+            entries = []
+            prefixes = []
+            truncated = False
+            last = None
+            i = bisect.bisect_left(keys, max(prefix, key_marker))
+            while i < len(keys):
+                k = keys[i]
+                i += 1
+                if not k.startswith(prefix):
+                    break
+                if key_marker:
+                    if delimiter and key_marker.endswith(delimiter) and k.startswith(key_marker):
+                        i = bisect.bisect_left(keys, _prefix_end(key_marker), i)
+                        continue
+                    if k == key_marker and not version_id_marker:
+                        continue
+                versions = self._visible(self._key_versions(bucket, k), lag)
+                if not versions:
+                    continue
+                if delimiter:
+                    j = k.find(delimiter, len(prefix))
+                    if j >= 0:
+                        cp = k[:j + len(delimiter)]
+                        if len(entries) + len(prefixes) >= max_keys:
+                            truncated = True
+                            break
+                        prefixes.append(cp)
+                        last = (cp, None)
+                        # skip the rest of the keys rolled up into cp
+                        i = bisect.bisect_left(keys, _prefix_end(cp), i)
+                        continue
+                skip = k == key_marker and bool(version_id_marker)
+                for n, v in enumerate(versions):
+                    if skip:
+                        if v['VersionId'] == version_id_marker:
+                            skip = False
+                        continue
+                    if len(entries) + len(prefixes) >= max_keys:
+                        truncated = True
+                        break
+                    entries.append((v, n == 0))
+                    last = (k, v['VersionId'])
+                if truncated:
+                    break
+            return entries, prefixes, truncated, last
+
+class MockRGWHandler(BaseHTTPRequestHandler):
+
+    protocol_version = 'HTTP/1.1'
+    server_version = 'MockRGW'
+    # headers and body are separate writes, do not wait for delayed acks
+    disable_nagle_algorithm = True
+
+    def log_message(self, format, *args):
+        pass
+
+    @property
+    def store(self):
+        return self.server.store
+
+    def _parse(self):
+        u = urllib.parse.urlsplit(self.path)
+        parts = u.path.lstrip('/').split('/', 1)
+        bucket = urllib.parse.unquote(parts[0])
+        key = urllib.parse.unquote(parts[1]) if len(parts) > 1 and parts[1] else None
+        query = dict(urllib.parse.parse_qsl(u.query, keep_blank_values=True))
+        return bucket, key, query
+
+    def _owner(self):
+        auth = self.headers.get('Authorization', '')
+        user = 'testuser1'
+        if 'Credential=' in auth:
+            user = auth.split('Credential=', 1)[1].split('/', 1)[0]
+        return {'ID': user, 'DisplayName': 'Test User'}
+
+    def _body(self):
+        if self.headers.get('Transfer-Encoding', '').lower() == 'chunked':
+            chunks = []
+            while True:
+                size = int(self.rfile.readline().split(b';')[0], 16)
+                if size == 0:
+                    self.rfile.readline()
+                    return b''.join(chunks)
+                chunks.append(self.rfile.read(size))
+                self.rfile.readline()
+        length = int(self.headers.get('Content-Length') or 0)
+        return self.rfile.read(length) if length else b''
+
+    def _send(self, status, body=b'', headers=None):
+        if isinstance(body, str):
+            body = body.encode('utf-8')
+        self.send_response(status)
+        for k, v in (headers or {}).items():
+            self.send_header(k, v)
+        self.send_header('Content-Length', str(len(body)))
+        self.end_headers()
+        if self.command != 'HEAD':
+            self.wfile.write(body)
+
+    def _xml(self, status, body, headers=None):
+        h = {'Content-Type': 'application/xml'}
+        h.update(headers or {})
+        self._send(status, '<?xml version="1.0" encoding="UTF-8"?>' + body, h)
+
+    def _error(self, status, code, message=''):
+        self._xml(status, '<Error><Code>{}</Code><Message>{}</Message></Error>'.format(
+            code, escape(message)))
+
+    def _object_headers(self):
+        return dict((h, v) for h, v in self.headers.items()
+                    if h.lower() == 'content-type' or h.lower().startswith('x-amz-meta-'))
+
+    def _copy_source(self):
+        u = urllib.parse.urlsplit(self.headers['x-amz-copy-source'])
+        (bucket, key) = urllib.parse.unquote(u.path).lstrip('/').split('/', 1)
+        query = dict(urllib.parse.parse_qsl(u.query))
+        v = self.store.get(bucket, key, query.get('versionId'))
+        if v is None or v['IsDeleteMarker']:
+            return None
+        return v
+
+    def _check_bucket(self, bucket):
+        if bucket not in self.store.buckets:
+            self._error(404, 'NoSuchBucket', bucket)
+            return False
+        return True
+
+    def do_PUT(self):
+        bucket, key, query = self._parse()
+        body = self._body()
+        if key is None:
+            self.store.create_bucket(bucket)
+            return self._send(200)
+        if not self._check_bucket(bucket):
+            return
+        if 'x-amz-copy-source' in self.headers:
+            source = self._copy_source()
+            if source is None:
+                return self._error(404, 'NoSuchKey', self.headers['x-amz-copy-source'])
+            if 'uploadId' in query:
+                data = source['Data']
+                r = self.headers.get('x-amz-copy-source-range')
+                if r:
+                    (first, last) = r.split('=', 1)[1].split('-')
+                    data = data[int(first):int(last) + 1]
+                etag = self.store.put_part(query['uploadId'], int(query['partNumber']), data)
+                if etag is None:
+                    return self._error(404, 'NoSuchUpload', query['uploadId'])
+                return self._xml(200, '<CopyPartResult><ETag>{}</ETag></CopyPartResult>'.format(
+                    escape(etag)))
+            v = self.store.put(bucket, key, source['Data'], self._owner(), source['Headers'])
+            return self._xml(200, '<CopyObjectResult><ETag>{}</ETag><LastModified>{}</LastModified>'
+                                  '</CopyObjectResult>'.format(escape(v['ETag']), v['LastModified']),
+                             {'x-amz-version-id': v['VersionId']})
+        if 'uploadId' in query:
+            etag = self.store.put_part(query['uploadId'], int(query['partNumber']), body)
+            if etag is None:
+                return self._error(404, 'NoSuchUpload', query['uploadId'])
+            return self._send(200, headers={'ETag': etag})
+        v = self.store.put(bucket, key, body, self._owner(), self._object_headers())
+        self._send(200, headers={'ETag': v['ETag'], 'x-amz-version-id': v['VersionId']})
+
+    def do_GET(self):
+        bucket, key, query = self._parse()
+        if not self._check_bucket(bucket):
+            return
+        if key is None:
+            if 'versions' in query:
+                return self._list_versions(bucket, query)
+            return self._error(501, 'NotImplemented')
+        self._get(bucket, key, query)
+
+    def do_HEAD(self):
+        bucket, key, query = self._parse()
+        if not self._check_bucket(bucket):
+            return
+        self._get(bucket, key, query)
+
+    def _get(self, bucket, key, query):
+        v = self.store.get(bucket, key, query.get('versionId'), self.server.lag)
+        if v is None:
+            return self._error(404, 'NoSuchVersion' if 'versionId' in query else 'NoSuchKey', key)
+        if v['IsDeleteMarker']:
+            return self._error(404, 'NoSuchKey', key)
+        headers = {'Content-Type': 'binary/octet-stream'}
+        headers.update(v['Headers'])
+        headers.update({'ETag': v['ETag'], 'x-amz-version-id': v['VersionId']})
+        self._send(200, v['Data'], headers)
+
+    def do_DELETE(self):
+        bucket, key, query = self._parse()
+        if not self._check_bucket(bucket):
+            return
+        if 'uploadId' in query:
+            self.store.abort_upload(query['uploadId'])
+            return self._send(204)
+        if 'versionId' in query:
+            v = self.store.delete_version(bucket, key, query['versionId'])
+            headers = {'x-amz-version-id': query['versionId']}
+        else:
+            v = self.store.add_delete_marker(bucket, key, self._owner())
+            headers = {'x-amz-version-id': v['VersionId'], 'x-amz-delete-marker': 'true'}
+        self._send(204, headers=headers)
+
+    def do_POST(self):
+        bucket, key, query = self._parse()
+        body = self._body()
+        if not self._check_bucket(bucket):
+            return
+        if key is None and 'delete' in query:
+            return self._delete_objects(bucket, body)
+        if key is not None and 'uploads' in query:
+            upload_id = self.store.create_upload(bucket, key, self._owner(), self._object_headers())
+            return self._xml(200, '<InitiateMultipartUploadResult xmlns="{}"><Bucket>{}</Bucket>'
+                                  '<Key>{}</Key><UploadId>{}</UploadId>'
+                                  '</InitiateMultipartUploadResult>'.format(
+                                      S3_XMLNS, escape(bucket), escape(key), upload_id))
+        if key is not None and 'uploadId' in query:
+            parts = []
+            for p in ET.fromstring(body):
+                f = dict((e.tag.rsplit('}', 1)[-1], e.text) for e in p)
+                parts.append((int(f['PartNumber']), f['ETag']))
+            v = self.store.complete_upload(query['uploadId'], parts)
+            if v is None:
+                return self._error(400, 'InvalidPart', key)
+            return self._xml(200, '<CompleteMultipartUploadResult xmlns="{}"><Bucket>{}</Bucket>'
+                                  '<Key>{}</Key><ETag>{}</ETag>'
+                                  '</CompleteMultipartUploadResult>'.format(
+                                      S3_XMLNS, escape(bucket), escape(key), escape(v['ETag'])),
+                             {'x-amz-version-id': v['VersionId']})
+        self._error(501, 'NotImplemented')
+
+    def _delete_objects(self, bucket, body):
+        out = ['<DeleteResult xmlns="{}">'.format(S3_XMLNS)]
+        for o in ET.fromstring(body):
+            if o.tag.rsplit('}', 1)[-1] != 'Object':
+                continue
+            f = dict((e.tag.rsplit('}', 1)[-1], e.text) for e in o)
+            key = f.get('Key')
+            version_id = f.get('VersionId')
+            try:
+                if version_id is not None:
+                    self.store.delete_version(bucket, key, version_id)
+                else:
+                    version_id = self.store.add_delete_marker(bucket, key, self._owner())['VersionId']
+            except Exception as e:
+                # one object failing does not fail the request
+                out.append('<Error><Key>{}</Key><VersionId>{}</VersionId><Code>InternalError</Code>'
+                           '<Message>{}</Message></Error>'.format(escape(key), escape(version_id or ''), escape(str(e))))
+                continue
+            out.append('<Deleted><Key>{}</Key><VersionId>{}</VersionId></Deleted>'.format(
+                escape(key), escape(version_id)))
+        out.append('</DeleteResult>')
+        self._xml(200, ''.join(out))
+
+    def _list_versions(self, bucket, query):
+        prefix = query.get('prefix', '')
+        delimiter = query.get('delimiter', '')
+        max_keys = int(query.get('max-keys', 1000))
+        entries, prefixes, truncated, last = self.store.list_versions(
+            bucket, prefix, query.get('key-marker', ''), query.get('version-id-marker', ''),
+            max_keys, delimiter, self.server.lag)
+        out = ['<ListVersionsResult xmlns="{}">'.format(S3_XMLNS),
+               '<Name>{}</Name>'.format(escape(bucket)),
+               '<Prefix>{}</Prefix>'.format(escape(prefix)),
+               '<MaxKeys>{}</MaxKeys>'.format(max_keys),
+               '<IsTruncated>{}</IsTruncated>'.format('true' if truncated else 'false')]
+        if truncated:
+            out.append('<NextKeyMarker>{}</NextKeyMarker>'.format(escape(last[0])))
+            if last[1] is not None:
+                out.append('<NextVersionIdMarker>{}</NextVersionIdMarker>'.format(last[1]))
+        for v, is_latest in entries:
+            tag = 'DeleteMarker' if v['IsDeleteMarker'] else 'Version'
+            out.append('<{}>'.format(tag))
+            out.append('<Key>{}</Key>'.format(escape(v['Key'])))
+            out.append('<VersionId>{}</VersionId>'.format(v['VersionId']))
+            out.append('<IsLatest>{}</IsLatest>'.format('true' if is_latest else 'false'))
+            out.append('<LastModified>{}</LastModified>'.format(v['LastModified']))
+            if not v['IsDeleteMarker']:
+                out.append('<ETag>{}</ETag>'.format(escape(v['ETag'])))
+                out.append('<Size>{}</Size>'.format(v['Size']))
+                out.append('<StorageClass>{}</StorageClass>'.format(v['StorageClass']))
+            # RGW lists versions of anonymous writes without an owner
+            if v['Owner']:
+                out.append('<Owner><ID>{}</ID><DisplayName>{}</DisplayName></Owner>'.format(
+                    escape(v['Owner']['ID']), escape(v['Owner']['DisplayName'])))
+            out.append('</{}>'.format(tag))
+        for cp in prefixes:
+            out.append('<CommonPrefixes><Prefix>{}</Prefix></CommonPrefixes>'.format(escape(cp)))
+        out.append('</ListVersionsResult>')
+        self._xml(200, ''.join(out))
+
+class MockHTTPServer(ThreadingHTTPServer):
+
+    daemon_threads = True
+    # room for the connections of a client with hundreds of requests in flight
+    request_queue_size = 256
+
+class MockRGW:
+
+    def __init__(self, store=None, host='127.0.0.1', port=0, lag=0):
+        self.store = store if store is not None else MockStore()
+        self.server = MockHTTPServer((host, port), MockRGWHandler)
+        self.server.store = self.store
+        # emulated replication lag, in seconds, of the versions read through this zone
+        self.server.lag = lag
+        self.thread = None
+
+    @property
+    def endpoint(self):
+        host, port = self.server.server_address[:2]
+        return 'http://{}:{}'.format(host, port)
+
+    def start(self):
+        self.thread = threading.Thread(target=self.server.serve_forever, daemon=True)
+        self.thread.start()
+        return self
+
+    def stop(self):
+        self.server.shutdown()
+        self.server.server_close()
+
+    def __enter__(self):
+        return self.start()
+
+    def __exit__(self, *exc):
+        self.stop()
+
+def main():
+    parser = argparse.ArgumentParser(prog='mock_rgw')
+    parser.add_argument('--host', default='127.0.0.1')
+    parser.add_argument('--master-port', type=int, default=8000)
+    parser.add_argument('--archive-port', type=int, default=8001)
+    parser.add_argument('--archive-lag', type=float, default=0,
+                        help='emulated replication lag of the archive zone, in seconds')
+    parser.add_argument('--bucket', action='append', default=[])
+    args = parser.parse_args()
+    store = MockStore()
+    for b in args.bucket:
+        store.create_bucket(b)
+    master = MockRGW(store, args.host, args.master_port).start()
+    archive = MockRGW(store, args.host, args.archive_port, args.archive_lag).start()
+    print('master  : {}'.format(master.endpoint))
+    print('archive : {}'.format(archive.endpoint))
+    try:
+        master.thread.join()
+    except KeyboardInterrupt:
+        pass
+    master.stop()
+    archive.stop()
+
+if __name__ == '__main__':
+    main()
@@ -49,8 +49,8 @@ class Options:
         # fetch-bucket
         self.parser.add_argument("-f",
                                  "--fetch-bucket",
-                                 help="fetch bucket",
-                                 type=str, nargs=1,
+                                 help="fetch buckets, in parallel (see --jobs, --split, --prefixes)",
+                                 type=str, nargs='+',
                                  metavar=('bucket'))
         # list-objects
         self.parser.add_argument("-l",
@@ -68,18 +68,149 @@ class Options:
                                  "--list-keys",
                                  help="list all available object keys",
                                  action='store_true')
+        # snapshot-at
+        self.parser.add_argument("--snapshot-at",
+                                 help="list the latest version or delete marker at date of every key (see --prefix)",
+                                 type=str, nargs=1,
+                                 metavar=('date'))
         # recover-object
         self.parser.add_argument("-r",
                                  "--recover-object",
                                  help="recover object",
                                  type=str, nargs=2,
                                  metavar=('key','version-id'))
+        # recover-objects
+        self.parser.add_argument("--recover-objects",
+                                 help="recover the (key, version-id) pairs listed in file ('-' for stdin)",
+                                 type=str, nargs=1,
+                                 metavar=('file'))
+        # recover-objects-at
+        self.parser.add_argument("--recover-objects-at",
+                                 help="recover the latest version at date of every key (see --prefix)",
+                                 type=str, nargs=1,
+                                 metavar=('date'))
         # trim-objects
         self.parser.add_argument("-t",
                                  "--trim-objects",
                                  help="trim objects",
                                  type=str, nargs=1,
                                  metavar=('date'))
+        # resume
+        self.parser.add_argument("--resume",
+                                 help="resume the trim-objects job, deleting its pending and failed versions",
+                                 type=int,
+                                 metavar=('job'))
+        # plan
+        self.parser.add_argument("--plan",
+                                 help="trim-objects shows the versions, bytes and keys it would delete, without deleting",
+                                 action='store_true')
+        # serve
+        self.parser.add_argument("--serve",
+                                 help="serve the caz commands over HTTP on a unix socket or localhost:port, keeping db and connections open",
+                                 type=str, nargs='?', const='',
+                                 metavar=('address'))
+        # bucket
+        self.parser.add_argument("-b",
+                                 "--bucket",
+                                 help="bucket the listing, recover and trim commands work on (required with several buckets in db)",
+                                 type=str,
+                                 metavar=('bucket'))
+        # page-size
+        self.parser.add_argument("--page-size",
+                                 help="fetch-bucket listing page size (max 1000)",
+                                 type=int,
+                                 metavar=('n'))
+        # prefix
+        self.parser.add_argument("--prefix",
+                                 help="limit the listings, fetch-bucket, snapshot-at and recover-objects-at to keys under prefix",
+                                 type=str,
+                                 metavar=('prefix'))
+        # since
+        self.parser.add_argument("--since",
+                                 help="list versions and delete markers modified at or after date",
+                                 type=str,
+                                 metavar=('date'))
+        # until
+        self.parser.add_argument("--until",
+                                 help="list versions and delete markers modified at or before date",
+                                 type=str,
+                                 metavar=('date'))
+        # type
+        self.parser.add_argument("--type",
+                                 help="list versions (V) or delete markers (D) only",
+                                 type=str,
+                                 choices=['V', 'D'])
+        # latest-only
+        self.parser.add_argument("--latest-only",
+                                 help="list latest versions and delete markers only",
+                                 action='store_true')
+        # min-size
+        self.parser.add_argument("--min-size",
+                                 help="list versions of n bytes or more (delete markers have 0)",
+                                 type=int,
+                                 metavar=('n'))
+        # max-size
+        self.parser.add_argument("--max-size",
+                                 help="list versions of n bytes or less",
+                                 type=int,
+                                 metavar=('n'))
+        # limit
+        self.parser.add_argument("--limit",
+                                 help="list at most n rows",
+                                 type=int,
+                                 metavar=('n'))
+        # output
+        self.parser.add_argument("--output",
+                                 help="listing output as JSON lines, CSV, TSV or NUL terminated fields",
+                                 type=str,
+                                 choices=['jsonl', 'csv', 'tsv', 'null'])
+        # prefixes
+        self.parser.add_argument("--prefixes",
+                                 help="fetch-bucket lists the prefixes in file ('-' for stdin) concurrently",
+                                 type=str,
+                                 metavar=('file'))
+        # split
+        self.parser.add_argument("--split",
+                                 help="fetch-bucket lists every '/' common prefix concurrently",
+                                 action='store_true')
+        # refresh
+        self.parser.add_argument("--refresh",
+                                 help="fetch-bucket updates the stored bucket data in place",
+                                 action='store_true')
+        # server-side-copy
+        self.parser.add_argument("--server-side-copy",
+                                 help="recover-object copies inside the gateway realm, falling back to get/put",
+                                 action='store_true')
+        # jobs
+        self.parser.add_argument("--jobs",
+                                 help="fetch-bucket, trim-objects and recover-objects concurrent requests",
+                                 type=int,
+                                 metavar=('n'))
+        # batch-size
+        self.parser.add_argument("--batch-size",
+                                 help="trim-objects versions per multi-object delete request (max 1000)",
+                                 type=int,
+                                 metavar=('n'))
+
+        # connect
+        self.parser.add_argument("--connect",
+                                 help="forward the command to the caz --serve at address",
+                                 type=str,
+                                 metavar=('address'))
+        # stats
+        self.parser.add_argument("--stats",
+                                 help="show the time spent per phase and the command counters on stderr",
+                                 action='store_true')
+        # stats-file
+        self.parser.add_argument("--stats-file",
+                                 help="write the time spent per phase and the command counters to file",
+                                 type=str,
+                                 metavar=('file'))
+        # stats-format
+        self.parser.add_argument("--stats-format",
+                                 help="--stats-file as JSON (default) or as a Prometheus textfile",
+                                 type=str,
+                                 choices=['json', 'prometheus'])
 
     def _parse(self, args=None):
         self.known, self.unknown = self.parser.parse_known_args(args)[:]
@@ -99,12 +230,20 @@ class Options:
             self.cmds['list-objects-by-key'] = True
         if self.args.list_keys:
             self.cmds['list-keys'] = True
+        if self.args.snapshot_at:
+            self.cmds['snapshot-at'] = True
         if self.args.fetch_bucket:
             self.cmds['fetch-bucket'] = True
         if self.args.recover_object:
             self.cmds['recover-object'] = True
-        if self.args.trim_objects:
+        if self.args.recover_objects:
+            self.cmds['recover-objects'] = True
+        if self.args.recover_objects_at:
+            self.cmds['recover-objects-at'] = True
+        if self.args.trim_objects or self.args.resume is not None:
             self.cmds['trim-objects'] = True
+        if self.args.serve is not None:
+            self.cmds['serve'] = True
 
     def get_command(self):
         cmds = ['init-db',
@@ -113,9 +252,13 @@ class Options:
                 'list-objects',
                 'list-objects-by-key',
                 'list-keys',
+                'snapshot-at',
                 'fetch-bucket',
                 'recover-object',
-                'trim-objects']
+                'recover-objects',
+                'recover-objects-at',
+                'trim-objects',
+                'serve']
         for c in cmds:
             if c in self.cmds:
                 self.current_cmd = c
@@ -127,8 +270,43 @@ class Options:
             return self.args.fetch_bucket
         if self.current_cmd == 'list-objects-by-key':
             return self.args.list_objects_by_key
+        if self.current_cmd == 'snapshot-at':
+            return self.args.snapshot_at
         if self.current_cmd == 'recover-object':
             return self.args.recover_object
+        if self.current_cmd == 'recover-objects':
+            return self.args.recover_objects
+        if self.current_cmd == 'recover-objects-at':
+            return self.args.recover_objects_at
         if self.current_cmd == 'trim-objects':
             return self.args.trim_objects
+        if self.current_cmd == 'serve':
+            return [self.args.serve] if self.args.serve else None
         return None
+
+    def get_modifiers(self):
+        return {
+            'bucket': self.args.bucket,
+            'page_size': self.args.page_size,
+            'prefix': self.args.prefix,
+            'prefixes': self.args.prefixes,
+            'since': self.args.since,
+            'until': self.args.until,
+            'type': self.args.type,
+            'latest_only': self.args.latest_only,
+            'min_size': self.args.min_size,
+            'max_size': self.args.max_size,
+            'limit': self.args.limit,
+            'output': self.args.output,
+            'split': self.args.split,
+            'refresh': self.args.refresh,
+            'server_side_copy': self.args.server_side_copy,
+            'jobs': self.args.jobs,
+            'batch_size': self.args.batch_size,
+            'resume': self.args.resume,
+            'plan': self.args.plan,
+            'connect': self.args.connect,
+            'stats': self.args.stats,
+            'stats_file': self.args.stats_file,
+            'stats_format': self.args.stats_format
+        }
@@ -0,0 +1,134 @@
+# Copyright (c) 2018 Javier M. Mellid <jmunhoz@igalia.com>
+#
+# Permission is hereby granted, free of charge, to any person obtaining a copy
+# of this software and associated documentation files (the "Software"), to deal
+# in the Software without restriction, including without limitation the rights
+# to use, copy, modify, merge, publish, distribute, sublicense, and/or sell
+# copies of the Software, and to permit persons to whom the Software is
+# furnished to do so, subject to the following conditions:
+#
+# The above copyright notice and this permission notice shall be included in all
+# copies or substantial portions of the Software.
+#
+# THE SOFTWARE IS PROVIDED "AS IS", WITHOUT WARRANTY OF ANY KIND, EXPRESS OR
+# IMPLIED, INCLUDING BUT NOT LIMITED TO THE WARRANTIES OF MERCHANTABILITY,
+# FITNESS FOR A PARTICULAR PURPOSE AND NONINFRINGEMENT. IN NO EVENT SHALL THE
+# AUTHORS OR COPYRIGHT HOLDERS BE LIABLE FOR ANY CLAIM, DAMAGES OR OTHER
+# LIABILITY, WHETHER IN AN ACTION OF CONTRACT, TORT OR OTHERWISE, ARISING FROM,
+# OUT OF OR IN CONNECTION WITH THE SOFTWARE OR THE USE OR OTHER DEALINGS IN THE
+# SOFTWARE.
+
+import io
+import operator
+import sys
+
+from . import config
+
+# (name, sql) columns of the version and delete marker records, pretty_str()
+# order; delete markers have no size, etag or storage class
+OBJECT_FIELDS = (('type', "OBJECTS.TYPE"),
+                 ('is_latest', "CASE WHEN OBJECTS.IS_LATEST THEN 'true' ELSE 'false' END"),
+                 ('last_modified', "OBJECTS.LAST_MODIFIED"),
+                 ('version_id', "OBJECTS.VERSION_ID"),
+                 ('key', "OBJECTS.KEY"),
+                 ('owner_display_name', "OWNERS.DISPLAY_NAME"),
+                 ('owner_id', "OWNERS.ID"),
+                 ('size', "CASE WHEN OBJECTS.TYPE = 'V' THEN OBJECTS.SIZE END"),
+                 ('etag', "CASE WHEN OBJECTS.TYPE = 'V' THEN OBJECTS.ETAG END"),
+                 ('storage_class', "CASE WHEN OBJECTS.TYPE = 'V' THEN OBJECTS.STORAGE_CLASS END"))
+
+KEY_FIELDS = (('key', "OBJECTS.KEY"),)
+
+def _open_stdout():
+    # own large buffer on top of fd 1, sys.stdout flushes every line on a tty
+    sys.stdout.flush()
+    try:
+        fd = sys.stdout.fileno()
+    except (AttributeError, io.UnsupportedOperation):
+        return (sys.stdout, False)
+    return (open(fd, 'w', buffering=config.OUTPUT_BUFFER_SIZE,
+                 encoding='utf-8', newline='', closefd=False), True)
+
+class OutputWriter:
+
+    # records are serialized by sqlite, the writer sql select list builds
+    # one ready to write text line per row
+    def __init__(self, fields):
+        self.fields = fields
+        (self.stream, self.owned) = _open_stdout()
+
+    def get_columns(self):
+        raise NotImplementedError
+
+    def write_rows(self, rows):
+        self.stream.writelines(map(operator.itemgetter(0), rows))
+
+    def close(self):
+        self.stream.flush()
+        if self.owned:
+            self.stream.close()
+
+class JSONLinesOutputWriter(OutputWriter):
+
+    def get_columns(self):
+        values = []
+        for (name, sql) in self.fields:
+            if name == 'is_latest':
+                sql = 'json({})'.format(sql)
+            values.append("'{}', {}".format(name, sql))
+        return "json_object({}) || char(10)".format(', '.join(values))
+
+class TSVOutputWriter(OutputWriter):
+
+    # backslash escapes keep one record per line; only the free form fields
+    # can hold tabs, newlines or backslashes
+    escaped = ('key', 'owner_display_name', 'owner_id')
+    escape = r"""CASE WHEN {0} GLOB '*[\' || char(9, 10, 13) || ']*'
+                 THEN replace(replace(replace(replace({0}, '\', '\\'), char(9), '\t'), char(10), '\n'), char(13), '\r')
+                 ELSE ifnull({0}, '') END"""
+
+    def __init__(self, fields):
+        OutputWriter.__init__(self, fields)
+        self.stream.write('\t'.join(name for (name, sql) in fields))
+        self.stream.write('\n')
+
+    def get_columns(self):
+        return " || char(9) || ".join((self.escape if name in self.escaped else "ifnull({0}, '')").format(sql)
+                                      for (name, sql) in self.fields) + " || char(10)"
+
+class CSVOutputWriter(OutputWriter):
+
+    # RFC 4180 quoting of the fields that can hold quotes, commas or newlines
+    quoted = ('key', 'owner_display_name', 'owner_id', 'etag')
+    quote = """CASE WHEN {0} GLOB '*["' || char(44, 10, 13) || ']*'
+                 THEN '"' || replace({0}, '"', '""') || '"'
+                 ELSE ifnull({0}, '') END"""
+
+    def __init__(self, fields):
+        OutputWriter.__init__(self, fields)
+        self.stream.write(','.join(name for (name, sql) in fields))
+        self.stream.write('\n')
+
+    def get_columns(self):
+        return " || ',' || ".join((self.quote if name in self.quoted else "ifnull({0}, '')").format(sql)
+                                  for (name, sql) in self.fields) + " || char(10)"
+
+class NullOutputWriter(OutputWriter):
+
+    # every field NUL terminated, len(fields) fields per record; a key
+    # listing is ready for xargs -0
+    def get_columns(self):
+        return " || ".join("ifnull({}, '') || char(0)".format(sql) for (name, sql) in self.fields)
+
+class OutputWriterFactory:
+
+    writers = {
+        'jsonl': JSONLinesOutputWriter,
+        'csv': CSVOutputWriter,
+        'tsv': TSVOutputWriter,
+        'null': NullOutputWriter
+    }
+
+    def create(name, fields):
+        return OutputWriterFactory.writers[name](fields)
+    create = staticmethod(create)
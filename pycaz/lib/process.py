@@ -18,11 +18,13 @@
 # OUT OF OR IN CONNECTION WITH THE SOFTWARE OR THE USE OR OTHER DEALINGS IN THE
 # SOFTWARE.
 
+import os
 import subprocess
 import shlex
 
 from .exceptions import ProcessException
 from . import logger
+from . import stats
 
 class ProcessResult:
     pass
@@ -33,15 +35,19 @@ class Process:
 
         logger.debug("Run command : %s" % command)
 
-        p = subprocess.Popen(shlex.split(command),
-                             #encoding='utf-8',
-                             stdin=subprocess.PIPE,
-                             stdout=subprocess.PIPE,
-                             stderr=subprocess.PIPE)
+        args = shlex.split(command)
+        stats.add('process.spawned')
+        with stats.span('process.' + os.path.basename(args[0])):
+            p = subprocess.Popen(args,
+                                 #encoding='utf-8',
+                                 stdin=subprocess.PIPE,
+                                 stdout=subprocess.PIPE,
+                                 stderr=subprocess.PIPE)
 
-        (stdout, stderr) = p.communicate()
+            (stdout, stderr) = p.communicate()
 
         if p.returncode != 0:
+            stats.add('process.failed')
             error_msg = "Error executing command : %s" % command
             logger.debug(error_msg)
             logger.debug('command stderr: [%s]' % stderr)
@@ -18,8 +18,15 @@
 # OUT OF OR IN CONNECTION WITH THE SOFTWARE OR THE USE OR OTHER DEALINGS IN THE
 # SOFTWARE.
 
-from .s3_commands import S3CommandFactory
+import os
+import sys
+
+from .exceptions import ServerException
+from .s3_commands import S3CommandFactory, S3CommandServe, show_error_and_abort
+from .server import CazClient
 from . import logger
+from . import stats
+from . import wks
 
 class Project:
 
@@ -33,12 +40,67 @@ class Project:
         par = self.options.get_params()
         logger.debug('S3 command detected : {}'.format(cmd))
 
-        # execute the command
-        s3Cmd = S3CommandFactory.createS3Command(cmd)
-        s3Cmd.set_params(par)
-        s3Cmd.execute()
-        logger.debug('{} command executed'.format(cmd))
-        logger.debug('{} params used'.format(par))
+        # execute the command, timing spans and counters are reported even
+        # when it aborts
+        try:
+            modifiers = self.options.get_modifiers()
+            if modifiers.get('connect'):
+                with stats.span('command.' + cmd):
+                    status = self._forward(cmd, par, modifiers)
+                if status != 0:
+                    exit(status)
+                return
+            s3Cmd = S3CommandFactory.createS3Command(cmd)
+            s3Cmd.set_params(par)
+            s3Cmd.set_modifiers(self.options.get_modifiers())
+            with stats.span('command.' + cmd):
+                s3Cmd.execute()
+            logger.debug('{} command executed'.format(cmd))
+            logger.debug('{} params used'.format(par))
+
+            # show command output
+            s3Cmd.show_output()
+        finally:
+            self._show_stats(cmd)
+
+    def _forward(self, cmd, par, modifiers):
+        # thin client, the caz --serve at --connect runs the command
+        if cmd not in S3CommandServe.served_commands:
+            show_error_and_abort('{} can not be forwarded'.format(cmd))
+        address = modifiers['connect']
+        par = list(par) if par else par
+        # the server gets the version id as typed, without the wks fix
+        if cmd == 'recover-object':
+            par = wks.unfix(par)
+        modifiers = dict(modifiers, connect=None)
+        # the server reads files by path, stdin ('-') is sent along
+        stdin = None
+        if cmd == 'recover-objects':
+            if par[0] == '-':
+                stdin = sys.stdin.read()
+            else:
+                par[0] = os.path.abspath(par[0])
+        if modifiers.get('prefixes'):
+            if modifiers['prefixes'] == '-':
+                stdin = sys.stdin.read()
+            else:
+                modifiers['prefixes'] = os.path.abspath(modifiers['prefixes'])
+        sys.stdout.flush()
+        try:
+            status = CazClient(address).run(cmd, par, modifiers, stdin)
+        except ServerException as e:
+            show_error_and_abort(e.parameter)
+        sys.stdout.flush()
+        return status
 
-        # show command output
-        s3Cmd.show_output()
+    def _show_stats(self, cmd):
+        modifiers = self.options.get_modifiers()
+        if modifiers.get('stats'):
+            # stderr keeps --output streams clean
+            print(stats.summary(), file=sys.stderr)
+        if modifiers.get('stats_file'):
+            try:
+                stats.write(modifiers['stats_file'], modifiers.get('stats_format') or 'json', cmd)
+            except OSError as e:
+                logger.debug('Error writing stats to {} : {}'.format(modifiers['stats_file'], e))
+                print('Error writing stats to {}'.format(modifiers['stats_file']), file=sys.stderr)
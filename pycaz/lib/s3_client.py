@@ -0,0 +1,520 @@
+# Copyright (c) 2018 Javier M. Mellid <jmunhoz@igalia.com>
+#
+# Permission is hereby granted, free of charge, to any person obtaining a copy
+# of this software and associated documentation files (the "Software"), to deal
+# in the Software without restriction, including without limitation the rights
+# to use, copy, modify, merge, publish, distribute, sublicense, and/or sell
+# copies of the Software, and to permit persons to whom the Software is
+# furnished to do so, subject to the following conditions:
+#
+# The above copyright notice and this permission notice shall be included in all
+# copies or substantial portions of the Software.
+#
+# THE SOFTWARE IS PROVIDED "AS IS", WITHOUT WARRANTY OF ANY KIND, EXPRESS OR
+# IMPLIED, INCLUDING BUT NOT LIMITED TO THE WARRANTIES OF MERCHANTABILITY,
+# FITNESS FOR A PARTICULAR PURPOSE AND NONINFRINGEMENT. IN NO EVENT SHALL THE
+# AUTHORS OR COPYRIGHT HOLDERS BE LIABLE FOR ANY CLAIM, DAMAGES OR OTHER
+# LIABILITY, WHETHER IN AN ACTION OF CONTRACT, TORT OR OTHERWISE, ARISING FROM,
+# OUT OF OR IN CONNECTION WITH THE SOFTWARE OR THE USE OR OTHER DEALINGS IN THE
+# SOFTWARE.
+
+import base64
+import configparser
+import datetime
+import hashlib
+import hmac
+import http.client
+import os
+import threading
+import urllib.parse
+import xml.etree.ElementTree as ET
+
+from xml.sax.saxutils import escape
+
+from .exceptions import S3ClientException
+from . import logger
+from . import config
+from . import stats
+
+EMPTY_SHA256 = hashlib.sha256(b'').hexdigest()
+UNSIGNED_PAYLOAD = 'UNSIGNED-PAYLOAD'
+S3_XMLNS = 'http://s3.amazonaws.com/doc/2006-03-01/'
+
+def _quote(s, safe='-_.~'):
+    return urllib.parse.quote(s, safe=safe)
+
+def _strip_ns(tag):
+    return tag.rsplit('}', 1)[-1]
+
+class Credentials:
+
+    def __init__(self, access_key, secret_key):
+        self.access_key = access_key
+        self.secret_key = secret_key
+
+    def load():
+        # config, then environment, then aws cli shared credentials file
+        access_key = config.AWS_ACCESS_KEY_ID or os.environ.get('AWS_ACCESS_KEY_ID')
+        secret_key = config.AWS_SECRET_ACCESS_KEY or os.environ.get('AWS_SECRET_ACCESS_KEY')
+        if access_key and secret_key:
+            return Credentials(access_key, secret_key)
+        profile = os.environ.get('AWS_PROFILE', 'default')
+        path = os.environ.get('AWS_SHARED_CREDENTIALS_FILE',
+                              os.path.expanduser('~/.aws/credentials'))
+        cp = configparser.ConfigParser()
+        cp.read(path)
+        if cp.has_section(profile):
+            return Credentials(cp.get(profile, 'aws_access_key_id', fallback=None),
+                               cp.get(profile, 'aws_secret_access_key', fallback=None))
+        raise S3ClientException('No S3 credentials found')
+    load = staticmethod(load)
+
+class SigV4Signer:
+
+    def __init__(self, credentials, region):
+        self.credentials = credentials
+        self.region = region
+        self._keys = {}
+
+    def _signing_key(self, datestamp):
+        key = self._keys.get(datestamp)
+        if key is None:
+            k = ('AWS4' + self.credentials.secret_key).encode('utf-8')
+            for m in (datestamp, self.region, 's3', 'aws4_request'):
+                k = hmac.new(k, m.encode('utf-8'), hashlib.sha256).digest()
+            self._keys = {datestamp: k}
+            key = k
+        return key
+
+    def sign(self, method, host, path, query, headers, payload_hash):
+        now = datetime.datetime.utcnow()
+        amz_date = now.strftime('%Y%m%dT%H%M%SZ')
+        datestamp = now.strftime('%Y%m%d')
+        headers['host'] = host
+        headers['x-amz-date'] = amz_date
+        headers['x-amz-content-sha256'] = payload_hash
+        signed = sorted(h.lower() for h in headers)
+        hdrs = dict((h.lower(), str(v).strip()) for h, v in headers.items())
+        canonical_headers = ''.join('{}:{}\n'.format(h, hdrs[h]) for h in signed)
+        signed_headers = ';'.join(signed)
+        canonical_query = '&'.join('{}={}'.format(_quote(k), _quote(v))
+                                   for k, v in sorted(query))
+        canonical_request = '\n'.join([method,
+                                       path,
+                                       canonical_query,
+                                       canonical_headers,
+                                       signed_headers,
+                                       payload_hash])
+        scope = '{}/{}/s3/aws4_request'.format(datestamp, self.region)
+        string_to_sign = '\n'.join(['AWS4-HMAC-SHA256',
+                                    amz_date,
+                                    scope,
+                                    hashlib.sha256(canonical_request.encode('utf-8')).hexdigest()])
+        signature = hmac.new(self._signing_key(datestamp),
+                             string_to_sign.encode('utf-8'),
+                             hashlib.sha256).hexdigest()
+        headers['Authorization'] = \
+            'AWS4-HMAC-SHA256 Credential={}/{}, SignedHeaders={}, Signature={}'.format(
+                self.credentials.access_key, scope, signed_headers, signature)
+        return headers
+
+class ConnectionPool:
+
+    def __init__(self, endpoint, maxsize):
+        u = urllib.parse.urlsplit(endpoint)
+        self.scheme = u.scheme or 'http'
+        self.host = u.hostname
+        self.port = u.port
+        self.netloc = u.netloc
+        self.maxsize = maxsize
+        self._idle = []
+        self._lock = threading.Lock()
+
+    def acquire(self):
+        with self._lock:
+            if self._idle:
+                return self._idle.pop()
+        if self.scheme == 'https':
+            return http.client.HTTPSConnection(self.host, self.port,
+                                               timeout=config.S3_TIMEOUT)
+        return http.client.HTTPConnection(self.host, self.port,
+                                          timeout=config.S3_TIMEOUT)
+
+    def release(self, conn):
+        with self._lock:
+            if len(self._idle) < self.maxsize:
+                self._idle.append(conn)
+                return
+        conn.close()
+
+    def discard(self, conn):
+        conn.close()
+
+class S3Response:
+
+    def __init__(self, pool, conn, response):
+        self.pool = pool
+        self.conn = conn
+        self.response = response
+        self.status = response.status
+        self.headers = response.headers
+
+    def read(self, amt=None):
+        data = self.response.read(amt)
+        stats.add('s3_client.bytes_received', len(data))
+        return data
+
+    def close(self):
+        if self.conn is None:
+            return
+        # hand back the connection only when the body was fully consumed
+        if self.response.isclosed() and not self.response.will_close:
+            self.pool.release(self.conn)
+        else:
+            self.pool.discard(self.conn)
+        self.conn = None
+
+    def __enter__(self):
+        return self
+
+    def __exit__(self, *exc):
+        self.close()
+
+class S3Client:
+
+    def __init__(self, endpoint, credentials=None, region=None):
+        self.endpoint = endpoint
+        # keep alive as many connections as the engine may have in flight
+        self.pool = ConnectionPool(endpoint, max(config.S3_POOL_SIZE, config.S3_MAX_REQUESTS))
+        if credentials is None:
+            credentials = Credentials.load()
+        self.signer = SigV4Signer(credentials, region or config.S3_REGION)
+
+    def __str__(self):
+        return 'S3Client({})'.format(self.endpoint)
+
+    def _path(self, bucket, key=None):
+        path = '/' + _quote(bucket)
+        if key is not None:
+            path += '/' + _quote(key, safe='-_.~/')
+        return path
+
+    def request(self, method, bucket, key=None, query=None, headers=None,
+                body=None, payload_hash=None, stream=False):
+        query = list(query or [])
+        headers = dict(headers or {})
+        path = self._path(bucket, key)
+        if payload_hash is None:
+            if body is None:
+                payload_hash = EMPTY_SHA256
+            elif isinstance(body, bytes):
+                payload_hash = hashlib.sha256(body).hexdigest()
+            else:
+                payload_hash = UNSIGNED_PAYLOAD
+        url = path
+        if query:
+            url += '?' + '&'.join(_quote(k) if v == '' else '{}={}'.format(_quote(k), _quote(v))
+                                  for k, v in query)
+        # a pooled keep-alive connection may have been closed by the gateway,
+        # replay once on a fresh connection when the body allows it
+        attempts = 2 if body is None or isinstance(body, bytes) else 1
+        stats.add('s3_client.requests')
+        if isinstance(body, bytes):
+            stats.add('s3_client.bytes_sent', len(body))
+        elif body is not None and 'Content-Length' in headers:
+            stats.add('s3_client.bytes_sent', int(headers['Content-Length']))
+        for attempt in range(attempts):
+            hdrs = self.signer.sign(method, self.pool.netloc, path, query,
+                                    dict(headers), payload_hash)
+            conn = self.pool.acquire()
+            try:
+                conn.request(method, url, body=body, headers=hdrs)
+                response = conn.getresponse()
+            except (http.client.RemoteDisconnected,
+                    http.client.CannotSendRequest,
+                    BrokenPipeError,
+                    ConnectionResetError):
+                self.pool.discard(conn)
+                if attempt + 1 == attempts:
+                    raise
+                logger.debug('{} stale connection, retrying {} {}'.format(self, method, url))
+                stats.add('s3_client.retries')
+                continue
+            except Exception:
+                self.pool.discard(conn)
+                raise
+            break
+        r = S3Response(self.pool, conn, response)
+        if response.status >= 300:
+            data = r.read()
+            r.close()
+            raise self._error(method, url, response.status, data)
+        if stream:
+            return r
+        data = r.read()
+        r.close()
+        r.data = data
+        return r
+
+    def _error(self, method, url, status, data):
+        code = None
+        message = None
+        try:
+            root = ET.fromstring(data)
+            for e in root:
+                if _strip_ns(e.tag) == 'Code':
+                    code = e.text
+                if _strip_ns(e.tag) == 'Message':
+                    message = e.text
+        except ET.ParseError:
+            pass
+        logger.debug('S3 error {} {} : {} {} {}'.format(method, url, status, code, message))
+        return S3ClientException('{} {} failed : {} {}'.format(method, url, status, code or ''),
+                                 status, code)
+
+    def list_object_versions(self, bucket, prefix=None, key_marker=None,
+                             version_id_marker=None, max_keys=None, delimiter=None):
+        query = [('versions', '')]
+        if prefix:
+            query.append(('prefix', prefix))
+        if key_marker:
+            query.append(('key-marker', key_marker))
+        if version_id_marker:
+            query.append(('version-id-marker', version_id_marker))
+        if max_keys:
+            query.append(('max-keys', str(max_keys)))
+        if delimiter:
+            query.append(('delimiter', delimiter))
+        r = self.request('GET', bucket, query=query)
+        return parse_list_versions(r.data)
+
+    def get_object(self, bucket, key, version_id=None):
+        query = []
+        if version_id is not None:
+            query.append(('versionId', version_id))
+        return self.request('GET', bucket, key, query=query, stream=True)
+
+    def head_object(self, bucket, key, version_id=None):
+        query = []
+        if version_id is not None:
+            query.append(('versionId', version_id))
+        return self.request('HEAD', bucket, key, query=query)
+
+    def put_object(self, bucket, key, body, length=None, headers=None):
+        headers = dict(headers or {})
+        if length is not None:
+            headers['Content-Length'] = str(length)
+        r = self.request('PUT', bucket, key, headers=headers, body=body)
+        return r.headers.get('x-amz-version-id')
+
+    def create_multipart_upload(self, bucket, key, headers=None):
+        r = self.request('POST', bucket, key, query=[('uploads', '')], headers=headers)
+        return _find_text(r.data, 'UploadId')
+
+    def upload_part(self, bucket, key, upload_id, part_number, data):
+        query = [('partNumber', str(part_number)), ('uploadId', upload_id)]
+        r = self.request('PUT', bucket, key, query=query, body=data,
+                         payload_hash=UNSIGNED_PAYLOAD)
+        return r.headers.get('ETag')
+
+    def complete_multipart_upload(self, bucket, key, upload_id, parts):
+        body = ['<CompleteMultipartUpload xmlns="{}">'.format(S3_XMLNS)]
+        for (part_number, etag) in parts:
+            body.append('<Part><PartNumber>{}</PartNumber><ETag>{}</ETag></Part>'.format(
+                part_number, escape(etag)))
+        body.append('</CompleteMultipartUpload>')
+        r = self.request('POST', bucket, key, query=[('uploadId', upload_id)],
+                         body=''.join(body).encode('utf-8'))
+        # a 200 response may still carry an error document
+        if _find_text(r.data, 'Code') is not None:
+            raise self._error('POST', key, r.status, r.data)
+        return r.headers.get('x-amz-version-id')
+
+    def abort_multipart_upload(self, bucket, key, upload_id):
+        return self.request('DELETE', bucket, key, query=[('uploadId', upload_id)])
+
+    def copy_stream(self, bucket, key, source):
+        # store the body of a streaming get_object() response as a new
+        # version, buffering at most one multipart part in memory
+        length = int(source.headers.get('Content-Length'))
+        headers = dict((h, v) for h, v in source.headers.items()
+                       if h.lower() in COPY_HEADERS or h.lower().startswith('x-amz-meta-'))
+        if length <= config.MULTIPART_THRESHOLD:
+            return self.put_object(bucket, key, source, length, headers)
+        # at most 10000 parts per upload
+        part_size = max(config.MULTIPART_CHUNK_SIZE, -(-length // 10000))
+        upload_id = self.create_multipart_upload(bucket, key, headers)
+        parts = []
+        try:
+            while True:
+                data = _read_exactly(source, part_size)
+                if not data:
+                    break
+                part_number = len(parts) + 1
+                parts.append((part_number,
+                              self.upload_part(bucket, key, upload_id, part_number, data)))
+            return self.complete_multipart_upload(bucket, key, upload_id, parts)
+        except Exception:
+            logger.debug('{} aborting multipart upload {}'.format(self, upload_id))
+            try:
+                self.abort_multipart_upload(bucket, key, upload_id)
+            except (S3ClientException, OSError):
+                pass
+            raise
+
+    def _copy_source(self, bucket, key, version_id):
+        source = '/{}/{}'.format(bucket, _quote(key, safe='-_.~/'))
+        if version_id is not None:
+            source += '?versionId={}'.format(_quote(version_id))
+        return source
+
+    def copy_object(self, bucket, key, src_bucket, src_key, src_version_id=None):
+        headers = {'x-amz-copy-source': self._copy_source(src_bucket, src_key, src_version_id),
+                   'x-amz-metadata-directive': 'COPY'}
+        r = self.request('PUT', bucket, key, headers=headers)
+        # a 200 response may still carry an error document
+        if _find_text(r.data, 'Code') is not None:
+            raise self._error('PUT', key, r.status, r.data)
+        return r.headers.get('x-amz-version-id')
+
+    def upload_part_copy(self, bucket, key, upload_id, part_number,
+                         src_bucket, src_key, src_version_id, first, last):
+        query = [('partNumber', str(part_number)), ('uploadId', upload_id)]
+        headers = {'x-amz-copy-source': self._copy_source(src_bucket, src_key, src_version_id),
+                   'x-amz-copy-source-range': 'bytes={}-{}'.format(first, last)}
+        r = self.request('PUT', bucket, key, query=query, headers=headers)
+        etag = _find_text(r.data, 'ETag')
+        if etag is None:
+            raise self._error('PUT', key, r.status, r.data)
+        return etag
+
+    def server_side_copy(self, bucket, key, src_bucket, src_key, src_version_id=None):
+        # copy a version inside the gateway realm, the payload never
+        # reaches this host; parts are copied above the CopyObject limit
+        r = self.head_object(src_bucket, src_key, src_version_id)
+        length = int(r.headers.get('Content-Length'))
+        if length <= config.COPY_OBJECT_MAX_SIZE:
+            return self.copy_object(bucket, key, src_bucket, src_key, src_version_id)
+        part_size = max(config.MULTIPART_CHUNK_SIZE, -(-length // 10000))
+        headers = dict((h, v) for h, v in r.headers.items()
+                       if h.lower() in COPY_HEADERS or h.lower().startswith('x-amz-meta-'))
+        upload_id = self.create_multipart_upload(bucket, key, headers)
+        parts = []
+        try:
+            for first in range(0, length, part_size):
+                part_number = len(parts) + 1
+                last = min(first + part_size, length) - 1
+                parts.append((part_number,
+                              self.upload_part_copy(bucket, key, upload_id, part_number,
+                                                    src_bucket, src_key, src_version_id,
+                                                    first, last)))
+            return self.complete_multipart_upload(bucket, key, upload_id, parts)
+        except Exception:
+            logger.debug('{} aborting multipart upload {}'.format(self, upload_id))
+            try:
+                self.abort_multipart_upload(bucket, key, upload_id)
+            except (S3ClientException, OSError):
+                pass
+            raise
+
+    def delete_object(self, bucket, key, version_id=None):
+        query = []
+        if version_id is not None:
+            query.append(('versionId', version_id))
+        return self.request('DELETE', bucket, key, query=query)
+
+    def delete_objects(self, bucket, objects, quiet=False):
+        # multi-object delete, at most 1000 (key, version-id) pairs
+        body = ['<Delete xmlns="{}">'.format(S3_XMLNS),
+                '<Quiet>{}</Quiet>'.format('true' if quiet else 'false')]
+        for (key, version_id) in objects:
+            body.append('<Object><Key>{}</Key>'.format(escape(key)))
+            if version_id is not None:
+                body.append('<VersionId>{}</VersionId>'.format(escape(version_id)))
+            body.append('</Object>')
+        body.append('</Delete>')
+        body = ''.join(body).encode('utf-8')
+        headers = {'Content-MD5': base64.b64encode(hashlib.md5(body).digest()).decode('ascii'),
+                   'Content-Type': 'application/xml'}
+        r = self.request('POST', bucket, query=[('delete', '')], headers=headers, body=body)
+        return parse_delete_result(r.data)
+
+COPY_HEADERS = ('content-type',
+                'content-encoding',
+                'content-disposition',
+                'content-language',
+                'cache-control',
+                'expires')
+
+def _read_exactly(f, n):
+    chunks = []
+    while n > 0:
+        chunk = f.read(n)
+        if not chunk:
+            break
+        chunks.append(chunk)
+        n -= len(chunk)
+    return b''.join(chunks)
+
+def _find_text(data, tag):
+    for e in ET.fromstring(data).iter():
+        if _strip_ns(e.tag) == tag:
+            return e.text
+    return None
+
+def parse_delete_result(data):
+    # mirror the aws cli delete-objects json layout
+    root = ET.fromstring(data)
+    result = {'Deleted': [], 'Errors': []}
+    for e in root:
+        tag = _strip_ns(e.tag)
+        item = dict((_strip_ns(f.tag), f.text) for f in e)
+        if tag == 'Deleted':
+            result['Deleted'].append(item)
+        elif tag == 'Error':
+            result['Errors'].append(item)
+    return result
+
+def parse_list_versions(data):
+    # mirror the aws cli list-object-versions json layout
+    root = ET.fromstring(data)
+    result = {'Versions': [], 'DeleteMarkers': [], 'CommonPrefixes': [], 'IsTruncated': False}
+    for e in root:
+        tag = _strip_ns(e.tag)
+        if tag in ('Version', 'DeleteMarker'):
+            item = {}
+            for f in e:
+                ftag = _strip_ns(f.tag)
+                if ftag == 'Owner':
+                    item['Owner'] = dict((_strip_ns(o.tag), o.text) for o in f)
+                elif ftag == 'IsLatest':
+                    item['IsLatest'] = f.text == 'true'
+                elif ftag == 'Size':
+                    item['Size'] = int(f.text)
+                else:
+                    item[ftag] = f.text
+            item.setdefault('Owner', {'DisplayName': None, 'ID': None})
+            if tag == 'Version':
+                result['Versions'].append(item)
+            else:
+                result['DeleteMarkers'].append(item)
+        elif tag == 'CommonPrefixes':
+            for p in e:
+                result['CommonPrefixes'].append({'Prefix': p.text})
+        elif tag == 'IsTruncated':
+            result['IsTruncated'] = e.text == 'true'
+        elif tag in ('NextKeyMarker', 'NextVersionIdMarker'):
+            result[tag] = e.text
+    return result
+
+_clients = {}
+_clients_lock = threading.Lock()
+
+def get_client(endpoint):
+    # one client, and so one connection pool, per gateway and process
+    with _clients_lock:
+        c = _clients.get(endpoint)
+        if c is None:
+            c = S3Client(endpoint)
+            _clients[endpoint] = c
+        return c
@@ -18,30 +18,44 @@
 # OUT OF OR IN CONNECTION WITH THE SOFTWARE OR THE USE OR OTHER DEALINGS IN THE
 # SOFTWARE.
 
+import contextvars
 import json
+import os
+import sys
+import queue
+import signal
+import threading
+import shlex
+import tempfile
 import time
+import urllib.parse
+
+from concurrent.futures import ThreadPoolExecutor
 
 from .process import Process
+from .s3_client import get_client
+from .exceptions import ProcessException, S3ClientException, ServerException
 from .s3_objects import *
 from .db import *
+from .output import *
+from .timestamps import to_epoch_us
+from .engine import get_engine
+from .server import create_server
 from . import logger
 from . import config
+from . import stats
 from . import wks
 
-class AWSCliDataSourceStrategy:
-
-    def __init__(self):
-        db = SQLiteAccess()
-        db.open_default()
-        db.health_or_die()
-        self.db = db
+class DataSourceStrategy:
 
-    def __str__(self):
-        return 'AWSCliDataSourceStrategy'
+    bucket_name = None
 
     def set_params(self, params):
         self.params = params
 
+    def set_bucket_name(self, bucket_name):
+        self.bucket_name = bucket_name
+
     def _get_master_gateway(self):
         return config.MASTER_GATEWAY
 
@@ -52,52 +66,99 @@ class AWSCliDataSourceStrategy:
         return config.TMP_FILE
 
     def _get_bucket_name(self):
-        # open db
-        db = SQLiteAccess()
-        db.open_default()
-        db.health_or_die()
-        bucket_name = db.get_bucket_name()
-        if bucket_name is None:
-            show_error_and_abort('Not bucket data found. Do you need to run --fetch-bucket?')
-        return bucket_name
+        if self.bucket_name is None:
+            show_error_and_abort('This command requires a bucket name.')
+        return self.bucket_name
+
+class AWSCliDataSourceStrategy(DataSourceStrategy):
+
+    def __str__(self):
+        return 'AWSCliDataSourceStrategy'
 
     def execute(self, command):
         logger.debug('Execute aws cli data source strategy : {}'.format(command))
-        # fetch-bucket
-        # aws --endpoint=http://rgw1:8000 s3api list-object-versions --bucket my-bucket
-        if command == 'fetch-bucket':
+        # list-object-versions-page
+        # aws --endpoint=ARCHIVE_GATEWAY s3api list-object-versions --bucket BUCKET_NAME --no-paginate --max-keys PAGE_SIZE [--prefix PREFIX] [--delimiter DELIMITER] [--key-marker KEY --version-id-marker VERSION_ID]
+        if command == 'list-object-versions-page':
             archive_gateway = self._get_archive_gateway()
-            bucket_name = self.params[0]
-            cmd = 'aws --endpoint={} s3api list-object-versions --bucket {}'.format(archive_gateway, bucket_name)
+            (bucket_name, prefix, key_marker, version_id_marker, page_size, delimiter) = self.params
+            cmd = 'aws --endpoint={} s3api list-object-versions --bucket {} --no-paginate --max-keys {}'.format(archive_gateway, shlex.quote(bucket_name), page_size)
+            if prefix:
+                cmd += ' --prefix {}'.format(shlex.quote(prefix))
+            if delimiter:
+                cmd += ' --delimiter {}'.format(shlex.quote(delimiter))
+            if key_marker:
+                cmd += ' --key-marker {}'.format(shlex.quote(key_marker))
+            if version_id_marker:
+                cmd += ' --version-id-marker {}'.format(shlex.quote(version_id_marker))
             try:
-                 return Process().execute(cmd)
+                 r = Process().execute(cmd)
             except:
                  show_error_and_abort('Error fetching bucket')
-        # get-object-from-archive
-        # aws --endpoint=ARCHIVE_GATEWAY s3api get-object --bucket BUCKET_NAME --key KEY --version-id VERSION_ID /tmp/OUTPUT_FILE.raw
-        if command == 'get-object-from-archive':
+            stdout = r.stdout.decode('UTF-8')
+            r.page = json.loads(stdout) if stdout.strip() else {}
+            return r
+        # copy-object-from-archive-to-master
+        # aws --endpoint=ARCHIVE_GATEWAY s3api get-object --bucket BUCKET_NAME --key KEY --version-id VERSION_ID /tmp/caz-XXXX.raw
+        # aws --endpoint=MASTER_GATEWAY s3api put-object --bucket BUCKET_NAME --key KEY --body /tmp/caz-XXXX.raw
+        if command == 'copy-object-from-archive-to-master':
             archive_gateway = self._get_archive_gateway()
+            master_gateway = self._get_master_gateway()
             bucket_name = self._get_bucket_name()
             key = self.params[0]
             version_id = self.params[1]
-            file = self._get_tmp_file()
-            cmd = "aws --endpoint={} s3api get-object --bucket {} --key {} --version-id='{}' {}".format(archive_gateway, bucket_name, key, version_id, file)
+            # one staging file per recovery, so concurrent recoveries do not collide
+            (fd, file) = tempfile.mkstemp(prefix='caz-', suffix='.raw',
+                                          dir=os.path.dirname(self._get_tmp_file()))
+            os.close(fd)
             try:
-                 return Process().execute(cmd)
-            except:
-                 show_error_and_abort('Error retrieving object from archive zone')
-        # put-object-in-master
-        # aws --endpoint=MASTER_GATEWAY s3api put-object --bucket BUCKET_NAME --key KEY --body /tmp/OUTPUT_FILE.raw
-        if command == 'put-object-in-master':
+                cmd = "aws --endpoint={} s3api get-object --bucket {} --key {} --version-id={} {}".format(archive_gateway, shlex.quote(bucket_name), shlex.quote(key), shlex.quote(version_id), file)
+                # failures are reported per object by the caller
+                try:
+                     Process().execute(cmd)
+                except ProcessException:
+                     raise ProcessException('Error retrieving object from archive zone')
+                stats.add('s3.bytes_copied', os.path.getsize(file))
+                cmd = 'aws --endpoint={} s3api put-object --bucket {} --key {} --body {}'.format(master_gateway, shlex.quote(bucket_name), shlex.quote(key), file)
+                try:
+                     r = Process().execute(cmd)
+                except ProcessException:
+                     raise ProcessException('Error storing object in master zone')
+            finally:
+                os.remove(file)
+            stdout = r.stdout.decode('UTF-8')
+            r.version_id = json.loads(stdout).get('VersionId') if stdout.strip() else None
+            return r
+        # copy-object-server-side
+        # aws --endpoint=MASTER_GATEWAY s3api copy-object --bucket BUCKET_NAME --key KEY --copy-source BUCKET_NAME/KEY?versionId=VERSION_ID
+        if command == 'copy-object-server-side':
             master_gateway = self._get_master_gateway()
             bucket_name = self._get_bucket_name()
             key = self.params[0]
-            file = self._get_tmp_file()
-            cmd = 'aws --endpoint={} s3api put-object --bucket {} --key {} --body {}'.format(master_gateway, bucket_name, key, file)
+            version_id = self.params[1]
+            source = '{}/{}?versionId={}'.format(bucket_name, urllib.parse.quote(key), urllib.parse.quote(version_id))
+            cmd = 'aws --endpoint={} s3api copy-object --bucket {} --key {} --copy-source {}'.format(master_gateway, shlex.quote(bucket_name), shlex.quote(key), shlex.quote(source))
+            # failures fall back to copy-object-from-archive-to-master
+            r = Process().execute(cmd)
+            stdout = r.stdout.decode('UTF-8')
+            r.version_id = json.loads(stdout).get('VersionId') if stdout.strip() else None
+            return r
+        # head-object-in-archive
+        # aws --endpoint=ARCHIVE_GATEWAY s3api head-object --bucket BUCKET_NAME --key KEY --version-id VERSION_ID
+        if command == 'head-object-in-archive':
+            archive_gateway = self._get_archive_gateway()
+            bucket_name = self._get_bucket_name()
+            key = self.params[0]
+            version_id = self.params[1]
+            cmd = 'aws --endpoint={} s3api head-object --bucket {} --key {} --version-id={}'.format(archive_gateway, shlex.quote(bucket_name), shlex.quote(key), shlex.quote(version_id))
+            # any failure counts as not replicated yet
             try:
-                 return Process().execute(cmd)
-            except:
-                 show_error_and_abort('Error storing object in master zone')
+                r = Process().execute(cmd)
+                r.found = True
+            except ProcessException:
+                r = S3CommandResult()
+                r.found = False
+            return r
         # delete-object-in-archive
         # aws --endpoint=ARCHIVE_GATEWAY s3api delete-object --bucket BUCKET_NAME --key KEY
         if command == 'delete-object-in-archive':
@@ -105,40 +166,244 @@ class AWSCliDataSourceStrategy:
             bucket_name = self._get_bucket_name()
             key = self.params[0]
             version_id = self.params[1]
-            cmd = "aws --endpoint={} s3api delete-object --bucket {} --key {} --version-id='{}'".format(archive_gateway, bucket_name, key, version_id)
+            cmd = 'aws --endpoint={} s3api delete-object --bucket {} --key {} --version-id={}'.format(archive_gateway, shlex.quote(bucket_name), shlex.quote(key), shlex.quote(version_id))
+            # failures are reported per version by the caller
             return Process().execute(cmd)
+        # delete-objects-in-archive
+        # aws --endpoint=ARCHIVE_GATEWAY s3api delete-objects --bucket BUCKET_NAME --delete file://DELETE_FILE.json
+        if command == 'delete-objects-in-archive':
+            archive_gateway = self._get_archive_gateway()
+            bucket_name = self._get_bucket_name()
+            delete = {'Objects': [{'Key': k, 'VersionId': v} for (k, v) in self.params],
+                      'Quiet': False}
+            with tempfile.NamedTemporaryFile('w', prefix='caz-', suffix='.json') as f:
+                json.dump(delete, f)
+                f.flush()
+                cmd = 'aws --endpoint={} s3api delete-objects --bucket {} --delete file://{}'.format(archive_gateway, shlex.quote(bucket_name), f.name)
+                r = Process().execute(cmd)
+            stdout = r.stdout.decode('UTF-8')
+            r.result = json.loads(stdout) if stdout.strip() else {}
+            return r
+
+        return None
+
+class S3CommandResult:
+    pass
+
+class NativeDataSourceStrategy(DataSourceStrategy):
+
+    def __str__(self):
+        return 'NativeDataSourceStrategy'
+
+    def _get_client(self, gateway):
+        try:
+            return get_client(gateway)
+        except S3ClientException as e:
+            show_error_and_abort('Error setting up S3 client : {}'.format(e))
+
+    def _result(self, stdout=b''):
+        r = S3CommandResult()
+        r.exit_code = 0
+        r.stdout = stdout
+        r.stderr = b''
+        return r
+
+    def execute(self, command):
+        logger.debug('Execute native data source strategy : {}'.format(command))
+        # list-object-versions-page
+        if command == 'list-object-versions-page':
+            client = self._get_client(self._get_archive_gateway())
+            (bucket_name, prefix, key_marker, version_id_marker, page_size, delimiter) = self.params
             try:
-                 return Process().execute(cmd)
-            except:
-                 show_error_and_abort('Error deleting object from archive zone')
+                page = client.list_object_versions(bucket_name,
+                                                   prefix=prefix,
+                                                   key_marker=key_marker,
+                                                   version_id_marker=version_id_marker,
+                                                   max_keys=page_size,
+                                                   delimiter=delimiter)
+            except (S3ClientException, OSError):
+                show_error_and_abort('Error fetching bucket')
+            r = self._result()
+            r.page = page
+            return r
+        # copy-object-from-archive-to-master
+        if command == 'copy-object-from-archive-to-master':
+            archive_client = self._get_client(self._get_archive_gateway())
+            master_client = self._get_client(self._get_master_gateway())
+            bucket_name = self._get_bucket_name()
+            key = self.params[0]
+            version_id = self.params[1]
+            r = self._result()
+            # failures are reported per object by the caller
+            try:
+                body = archive_client.get_object(bucket_name, key, version_id)
+            except S3ClientException as e:
+                raise S3ClientException('Error retrieving object from archive zone', e.status, e.code)
+            with body:
+                logger.debug('Copying {} bytes of {} {}'.format(body.headers.get('Content-Length'), key, version_id))
+                stats.add('s3.bytes_copied', int(body.headers.get('Content-Length') or 0))
+                try:
+                    r.version_id = master_client.copy_stream(bucket_name, key, body)
+                except S3ClientException as e:
+                    raise S3ClientException('Error storing object in master zone', e.status, e.code)
+            return r
+        # copy-object-server-side
+        if command == 'copy-object-server-side':
+            client = self._get_client(self._get_master_gateway())
+            bucket_name = self._get_bucket_name()
+            key = self.params[0]
+            version_id = self.params[1]
+            r = self._result()
+            # failures fall back to copy-object-from-archive-to-master
+            r.version_id = client.server_side_copy(bucket_name, key, bucket_name, key, version_id)
+            return r
+        # head-object-in-archive
+        if command == 'head-object-in-archive':
+            client = self._get_client(self._get_archive_gateway())
+            bucket_name = self._get_bucket_name()
+            key = self.params[0]
+            version_id = self.params[1]
+            r = self._result()
+            try:
+                client.head_object(bucket_name, key, version_id)
+                r.found = True
+            except S3ClientException as e:
+                if e.status != 404:
+                    raise
+                r.found = False
+            return r
+        # delete-object-in-archive
+        if command == 'delete-object-in-archive':
+            client = self._get_client(self._get_archive_gateway())
+            bucket_name = self._get_bucket_name()
+            key = self.params[0]
+            version_id = self.params[1]
+            # failures are reported per version by the caller
+            client.delete_object(bucket_name, key, version_id)
+            return self._result()
+        # delete-objects-in-archive
+        if command == 'delete-objects-in-archive':
+            client = self._get_client(self._get_archive_gateway())
+            bucket_name = self._get_bucket_name()
+            r = self._result()
+            r.result = client.delete_objects(bucket_name, self.params)
+            return r
 
         return None
 
 class DataSourceManager:
+
+    strategies = {
+        'aws-cli': AWSCliDataSourceStrategy,
+        'native': NativeDataSourceStrategy
+    }
+
     def __init__(self, data_source):
         self.data_source = data_source
 
     def execute(self, command):
-        return self.data_source.execute(command)
+        with stats.span('s3.' + command):
+            return self.data_source.execute(command)
 
-class S3CommandResult:
-    pass
+    def create_data_source(name=None):
+        name = name or config.DATA_SOURCE
+        if name not in DataSourceManager.strategies:
+            show_error_and_abort('Unknown data source : {}'.format(name))
+        return DataSourceManager.strategies[name]()
+    create_data_source = staticmethod(create_data_source)
 
 class S3Command:
 
     s3_cmd_name = None
     s3_cmd_params = None
+    s3_cmd_modifiers = {}
+    s3_cmd_bucket_name = None
+
+    # gateways the data source commands send requests to
+    s3_cmd_gateways = {
+        'list-object-versions-page': ('archive',),
+        'copy-object-from-archive-to-master': ('archive', 'master'),
+        'copy-object-server-side': ('master',),
+        'head-object-in-archive': ('archive',),
+        'delete-object-in-archive': ('archive',),
+        'delete-objects-in-archive': ('archive',)
+    }
 
     def execute(self):
-        strategy = AWSCliDataSourceStrategy()
+        # sync facade over execute_async()
+        return get_engine().run(self.execute_async())
+
+    async def execute_async(self):
+        # the data source command, within the engine per gateway limits
+        gateways = [config.MASTER_GATEWAY if g == 'master' else config.ARCHIVE_GATEWAY
+                    for g in self.s3_cmd_gateways.get(self.s3_cmd_name, ('archive',))]
+        return await get_engine().execute(gateways, self._execute)
+
+    def _execute(self):
+        strategy = DataSourceManager.create_data_source()
         logger.debug('Enabled strategy : {}'.format(strategy))
         strategy.set_params(self.s3_cmd_params)
+        strategy.set_bucket_name(self.s3_cmd_bucket_name)
         dsm = DataSourceManager(strategy)
         return dsm.execute(self.s3_cmd_name)
 
     def set_params(self, params):
         self.s3_cmd_params = params
 
+    def set_modifiers(self, modifiers):
+        self.s3_cmd_modifiers = modifiers
+
+    def _get_bucket(self, db):
+        # (name, xid) of the bucket selected with --bucket, or of the only
+        # bucket in db
+        bucket_name = self.s3_cmd_modifiers.get('bucket')
+        if bucket_name is None:
+            bucket_names = list(db.get_bucket_names())
+            if len(bucket_names) == 0:
+                show_error_and_abort('Not bucket data found. Do you need to run --fetch-bucket?')
+            if len(bucket_names) > 1:
+                show_error_and_abort('Several buckets found in db. Do you need to use --bucket?')
+            bucket_name = bucket_names[0]
+        bucket_xid = db.get_bucket_xid(bucket_name)
+        if bucket_xid is None:
+            show_error_and_abort('Bucket {} not found in db. Do you need to run --fetch-bucket?'.format(bucket_name))
+        return (bucket_name, bucket_xid)
+
+    def _get_filters(self):
+        # listing filters, pushed down to db
+        filters = {}
+        for name in ('prefix', 'type', 'latest_only'):
+            filters[name] = self.s3_cmd_modifiers.get(name)
+        for name in ('since', 'until'):
+            tdate = self.s3_cmd_modifiers.get(name)
+            filters[name] = self._get_date(tdate) if tdate is not None else None
+        for name in ('min_size', 'max_size'):
+            size = self.s3_cmd_modifiers.get(name)
+            if size is not None and size < 0:
+                show_error_and_abort('Size must be at least 0')
+            filters[name] = size
+        limit = self.s3_cmd_modifiers.get('limit')
+        if limit is not None and limit < 1:
+            show_error_and_abort('Limit must be at least 1')
+        filters['limit'] = limit
+        return filters
+
+    def _get_date(self, value):
+        # user dates are compared as microseconds since the epoch, UTC unless
+        # they carry a time zone
+        try:
+            return to_epoch_us(value)
+        except ValueError:
+            show_error_and_abort('Error invalid date')
+
+    def _get_jobs(self, default):
+        jobs = self.s3_cmd_modifiers.get('jobs')
+        if jobs is None:
+            jobs = default
+        if jobs < 1:
+            show_error_and_abort('Jobs must be at least 1')
+        return jobs
+
     def show_output(self):
         show_error_and_abort('S3Command requires output')
 
@@ -189,14 +454,16 @@ class S3CommandInfoDb(S3Command):
 
     def execute(self):
         # open db
-        db = SQLiteAccess()
-        db.open_default()
-        db.health_or_die()
-        bucket_name = db.get_bucket_name()
-        if bucket_name is None:
+        db = get_default_db()
+        bucket_names = list(db.get_bucket_names())
+        if len(bucket_names) == 0:
             show_error_and_abort('Not bucket data found. Do you need to run --fetch-bucket?')
-        # show current bucket name
-        print('bucket name : {}'.format(bucket_name))
+        # show stored bucket names
+        for bucket_name in bucket_names:
+            print('bucket name : {}'.format(bucket_name))
+        # show the trim jobs to resume
+        for job in db.get_trim_jobs():
+            print('trim job : {}'.format(job.pretty_str()))
 
     def show_output(self):
         print('{} ok'.format(self.s3_cmd_name))
@@ -218,7 +485,36 @@ class S3CommandPurgeDb(S3Command):
     def show_output(self):
         print('{} ok'.format(self.s3_cmd_name))
 
-class S3CommandListObjects(S3Command):
+class S3CommandList(S3Command):
+
+    def _get_output(self):
+        return self.s3_cmd_modifiers.get('output')
+
+    def _show(self, fields, pretty, query, *args, **kwargs):
+        # pretty lines by default, or records serialized by sqlite itself
+        output = self._get_output()
+        if output is None:
+            for r in query(*args, **kwargs):
+                print(pretty(r))
+            return
+        writer = OutputWriterFactory.create(output, fields)
+        try:
+            writer.write_rows(query(*args, columns=writer.get_columns(), **kwargs))
+        finally:
+            writer.close()
+
+    def _show_objects(self, query, *args, **kwargs):
+        self._show(OBJECT_FIELDS, lambda s3o: s3o.pretty_str(), query, *args, **kwargs)
+
+    def _show_keys(self, query, *args, **kwargs):
+        self._show(KEY_FIELDS, str, query, *args, **kwargs)
+
+    def show_output(self):
+        # nothing but records in machine readable output
+        if self._get_output() is None:
+            print('{} ok'.format(self.s3_cmd_name))
+
+class S3CommandListObjects(S3CommandList):
 
     s3_cmd_name = 'list-objects'
 
@@ -228,19 +524,14 @@ class S3CommandListObjects(S3Command):
 
     def execute(self):
         # open db
-        db = SQLiteAccess()
-        if db.exists() is False:
+        if SQLiteAccess().exists() is False:
             show_error_and_abort('Error db not exist. Do you need to run --init-db?')
-        db.open_default()
-        db.health_or_die()
+        db = get_default_db()
+        (bucket_name, bucket_xid) = self._get_bucket(db)
         # retrieve and show ordered records
-        for s3o in db.get_objects_by_last_modified():
-            print(s3o.pretty_str())
-
-    def show_output(self):
-        print('{} ok'.format(self.s3_cmd_name))
+        self._show_objects(db.get_objects_by_last_modified, bucket_xid, filters=self._get_filters())
 
-class S3CommandListObjectsByKey(S3Command):
+class S3CommandListObjectsByKey(S3CommandList):
 
     s3_cmd_name = 'list-objects-by-key'
 
@@ -250,22 +541,18 @@ class S3CommandListObjectsByKey(S3Command):
 
     def execute(self):
         # open db
-        db = SQLiteAccess()
-        if db.exists() is False:
+        if SQLiteAccess().exists() is False:
             show_error_and_abort('Error db not exist. Do you need to run --init-db?')
-        db.open_default()
-        db.health_or_die()
+        db = get_default_db()
+        (bucket_name, bucket_xid) = self._get_bucket(db)
         # retrieve key
         if self.s3_cmd_params is None:
             show_error_and_abort('This command requires an object key')
         # retrieve and show ordered records by key
-        for s3o in db.get_objects_by_key_and_last_modified(self.s3_cmd_params[0]):
-            print(s3o.pretty_str())
-
-    def show_output(self):
-        print('{} ok'.format(self.s3_cmd_name))
+        self._show_objects(db.get_objects_by_key_and_last_modified, bucket_xid, self.s3_cmd_params[0],
+                           filters=self._get_filters())
 
-class S3CommandListKeys(S3Command):
+class S3CommandListKeys(S3CommandList):
 
     s3_cmd_name = 'list-keys'
 
@@ -275,119 +562,295 @@ class S3CommandListKeys(S3Command):
 
     def execute(self):
         # open db
-        db = SQLiteAccess()
-        if db.exists() is False:
+        if SQLiteAccess().exists() is False:
             show_error_and_abort('Error db not exist. Do you need to run --init-db?')
-        db.open_default()
-        db.health_or_die()
+        db = get_default_db()
+        (bucket_name, bucket_xid) = self._get_bucket(db)
         # retrieve and show ordered records
-        for k in db.get_all_keys():
-            print(k)
+        self._show_keys(db.get_all_keys, bucket_xid, filters=self._get_filters())
 
-    def show_output(self):
-        print('{} ok'.format(self.s3_cmd_name))
+class S3CommandSnapshotAt(S3CommandList):
+
+    s3_cmd_name = 'snapshot-at'
+
+    class Factory:
+        def create(self):
+            return S3CommandSnapshotAt()
+
+    def execute(self):
+        # open db
+        if SQLiteAccess().exists() is False:
+            show_error_and_abort('Error db not exist. Do you need to run --init-db?')
+        db = get_default_db()
+        (bucket_name, bucket_xid) = self._get_bucket(db)
+        # get snapshot date
+        tdate = self._get_date(self.s3_cmd_params[0])
+        # show the latest version or delete marker of every key at date
+        self._show_objects(db.get_objects_at_date, bucket_xid, tdate, self.s3_cmd_modifiers.get('prefix'))
 
 class S3CommandFetchBucket(S3Command):
 
     s3_cmd_name = 'fetch-bucket'
+    # keys or prefixes to list instead of --prefix/--prefixes, set by the
+    # recoveries refreshing the keys they recovered
+    prefixes = None
 
     class Factory:
         def create(self):
             return S3CommandFetchBucket()
 
-    def execute(self):
+    def _get_page_size(self):
+        page_size = self.s3_cmd_modifiers.get('page_size') or config.FETCH_PAGE_SIZE
+        if page_size < 1 or page_size > 1000:
+            show_error_and_abort('Page size must be between 1 and 1000')
+        return page_size
+
+    def _add_page(self, db, bucket_xid, page, refresh):
+        # store object versions and delete markers in db, one transaction per page
+        objs = [s3_version_from_json(v) for v in page.get('Versions', [])]
+        objs.extend(s3_delete_marker_from_json(v) for v in page.get('DeleteMarkers', []))
+        stats.add('fetch.pages')
+        stats.add('fetch.versions', len(objs))
+        try:
+            db.add_objects(bucket_xid, objs, refresh=refresh)
+        except:
+            show_error_and_abort('{} failed'.format(self.s3_cmd_name))
+
+    def _pages(self, bucket_name, prefix, delimiter=None, stop=None):
+        # page through the listing of prefix, one request at a time
+        page_size = self._get_page_size()
+        key_marker = None
+        version_id_marker = None
+        while stop is None or not stop.is_set():
+            c = S3Command()
+            c.s3_cmd_name = 'list-object-versions-page'
+            c.s3_cmd_params = [bucket_name, prefix, key_marker, version_id_marker, page_size, delimiter]
+            page = c.execute().page
+            yield page
+            if not page.get('IsTruncated'):
+                break
+            key_marker = page.get('NextKeyMarker')
+            version_id_marker = page.get('NextVersionIdMarker')
+            logger.debug('{} {} next page : {} {}'.format(self.s3_cmd_name, bucket_name, key_marker, version_id_marker))
+
+    def _get_prefixes(self):
+        # --prefixes: one prefix per line from a file or stdin ('-'), or --prefix
+        if self.prefixes is not None:
+            return _covering_prefixes(self.prefixes)
+        name = self.s3_cmd_modifiers.get('prefixes')
+        if name is None:
+            return [self.s3_cmd_modifiers.get('prefix') or '']
+        if self.s3_cmd_modifiers.get('prefix') is not None:
+            show_error_and_abort('--prefix and --prefixes can not be used together')
+        try:
+            f = sys.stdin if name == '-' else open(name)
+        except OSError:
+            show_error_and_abort('Error reading {}'.format(name))
+        with f:
+            return _covering_prefixes(line.rstrip('\n') for line in f if line.strip())
+
+    def _split(self, db, bucket_name, bucket_xid, prefix, refresh):
+        # list prefix with a delimiter: the keys right under prefix are stored
+        # here, the common prefixes are the partitions listed concurrently
+        partitions = []
+        for page in self._pages(bucket_name, prefix, config.FETCH_SPLIT_DELIMITER):
+            self._add_page(db, bucket_xid, page, refresh)
+            partitions.extend(cp['Prefix'] for cp in page.get('CommonPrefixes', []))
+        logger.debug('{} {} prefix {} split in {} partitions'.format(self.s3_cmd_name, bucket_name, prefix, len(partitions)))
+        return partitions
+
+    def _put(self, pages, stop, item):
+        # give up once the writer is gone
+        while not stop.is_set():
+            try:
+                pages.put(item, timeout=0.1)
+                return
+            except queue.Full:
+                pass
+
+    def _list_partition(self, pages, stop, bucket_name, bucket_xid, prefix):
+        try:
+            for page in self._pages(bucket_name, prefix, stop=stop):
+                self._put(pages, stop, (bucket_xid, page))
+        except BaseException:
+            stop.set()
+            raise
+        finally:
+            # one None per partition tells the writer it is done
+            self._put(pages, stop, None)
 
-        # run s3 command
-        r = super().execute()
+    def execute(self):
 
         # open db
-        db = SQLiteAccess()
-        if db.exists() is False:
+        if SQLiteAccess().exists() is False:
             show_error_and_abort('Error db not exist. Do you need to run --init-db?')
-        db.open_default()
-        db.health_or_die()
+        db = get_default_db()
 
-        # store bucket name in db
         if self.s3_cmd_params is None:
             show_error_and_abort('This command requires a bucket name.')
-        if db.get_bucket_name() is not None:
-            show_error_and_abort('Previous bucket data found. Do you need to run --purge-db?')
-        try:
-            db.add_bucket_name(self.s3_cmd_params[0])
-        except:
-            show_error_and_abort('Error adding bucket name in db')
-
-        # store object versions in db
-        try:
-             for v in json.loads(r.stdout.decode('UTF-8'))['Versions']:
-                 o = v['Owner']
-                 s3o = S3Owner(0,
-                               o['DisplayName'],
-                               o['ID'])
-                 s3v = S3Version(0,
-                                 v['LastModified'],
-                                 v['VersionId'],
-                                 v['ETag'],
-                                 v['StorageClass'],
-                                 v['Key'],
-                                 s3o,
-                                 v['IsLatest'],
-                                 v['Size'])
-                 #print(s3v)
-                 try:
-                     db.add_object(s3v)
-                 except:
-                     show_error_and_abort('{} (versions) failed'.format(self.s3_cmd_name))
-        except:
-             # no object versions availables
-             pass
-
-        # store delete markers in db
-        try:
-             for v in json.loads(r.stdout.decode('UTF-8'))['DeleteMarkers']:
-
-                 o = v['Owner']
-                 s3o = S3Owner(0,
-                               o['DisplayName'],
-                               o['ID'])
-                 s3dm = S3DeleteMarker(0,
-                                  v['LastModified'],
-                                  v['VersionId'],
-                                  v['Key'],
-                                  s3o,
-                                  v['IsLatest'])
-                 #print(s3dm)
-                 try:
-                     db.add_object(s3dm)
-                 except:
-                     show_error_and_abort('{} (delete markers) failed'.format(self.s3_cmd_name))
-        except:
-             # no delete markers availables
-             pass
+        prefixes = self._get_prefixes()
+        split = bool(self.s3_cmd_modifiers.get('split'))
+        refresh = bool(self.s3_cmd_modifiers.get('refresh'))
+        jobs = self._get_jobs(config.FETCH_JOBS)
+
+        buckets = []
+        for bucket_name in self.s3_cmd_params:
+            bucket_xid = db.get_bucket_xid(bucket_name)
+            if refresh:
+                # update the stored bucket data in place
+                if bucket_xid is None:
+                    show_error_and_abort('Bucket {} not found in db. Do you need to run --fetch-bucket?'.format(bucket_name))
+                db.begin_refresh(bucket_xid)
+            else:
+                # store bucket name in db
+                if bucket_xid is not None:
+                    show_error_and_abort('Previous bucket data found for {}. Do you need to run --refresh?'.format(bucket_name))
+                try:
+                    bucket_xid = db.add_bucket_name(bucket_name)
+                except:
+                    show_error_and_abort('Error adding bucket name in db')
+            buckets.append((bucket_name, bucket_xid))
+
+        # (bucket, prefix) partitions, listed concurrently
+        partitions = []
+        for (bucket_name, bucket_xid) in buckets:
+            for prefix in prefixes:
+                if split:
+                    partitions.extend((bucket_name, bucket_xid, p)
+                                      for p in self._split(db, bucket_name, bucket_xid, prefix, refresh))
+                else:
+                    partitions.append((bucket_name, bucket_xid, prefix))
+
+        # listing workers hand their pages over to this thread, the only one
+        # writing to db; the bounded queue holds them back when db is behind
+        pages = queue.Queue(maxsize=jobs * 2)
+        stop = threading.Event()
+        with ThreadPoolExecutor(max_workers=jobs) as executor:
+            # workers print in the caller context (its stdout under caz --serve)
+            futures = [executor.submit(contextvars.copy_context().run,
+                                       self._list_partition, pages, stop, bucket_name, bucket_xid, prefix)
+                       for (bucket_name, bucket_xid, prefix) in partitions]
+            try:
+                running = len(futures)
+                while running and not stop.is_set():
+                    try:
+                        item = pages.get(timeout=0.1)
+                    except queue.Empty:
+                        continue
+                    if item is None:
+                        running -= 1
+                        continue
+                    (bucket_xid, page) = item
+                    self._add_page(db, bucket_xid, page, refresh)
+            finally:
+                stop.set()
+            for f in futures:
+                f.result()
+
+        # drop the versions gone from storage
+        if refresh:
+            for (bucket_name, bucket_xid) in buckets:
+                for prefix in prefixes:
+                    n = db.end_refresh(bucket_xid, prefix)
+                    logger.debug('{} refresh removed {} versions of {} under prefix {}'.format(self.s3_cmd_name, n, bucket_name, prefix))
 
     def show_output(self):
         print('{} ok'.format(self.s3_cmd_name))
 
-class S3CommandRecoverObject(S3Command):
-
-    s3_cmd_name = 'recover-object'
+class S3CommandRecover(S3Command):
 
     def _get_bucket_name(self):
         # open db
-        db = SQLiteAccess()
-        db.open_default()
-        db.health_or_die()
-        bucket_name = db.get_bucket_name()
-        if bucket_name is None:
-            show_error_and_abort('Not bucket data found. Do you need to run --fetch-bucket?')
-        return bucket_name
+        db = get_default_db()
+        (self.bucket_name, self.bucket_xid) = self._get_bucket(db)
+        return self.bucket_name
+
+    def _recover(self, key, version_id):
+        return get_engine().run(self._recover_async(key, version_id))
+
+    async def _recover_async(self, key, version_id):
+        with stats.span('recover.object'):
+            return await self._copy(key, version_id)
+
+    async def _copy(self, key, version_id):
+        # recover object from archive zone and store it in master zone,
+        # returns the new master version-id
+        r = None
+        if self.s3_cmd_modifiers.get('server_side_copy') or config.SERVER_SIDE_COPY:
+            c = S3Command()
+            c.s3_cmd_name = 'copy-object-server-side'
+            c.s3_cmd_bucket_name = self.bucket_name
+            c.s3_cmd_params = [key, version_id]
+            try:
+                r = await c.execute_async()
+            except (ProcessException, S3ClientException, OSError) as e:
+                logger.debug('{} server side copy failed, falling back to get/put : {}'.format(self.s3_cmd_name, e))
+        if r is None:
+            c = S3Command()
+            c.s3_cmd_name = 'copy-object-from-archive-to-master'
+            c.s3_cmd_bucket_name = self.bucket_name
+            c.s3_cmd_params = [key, version_id]
+            r = await c.execute_async()
+        logger.debug('{} new master version-id : {}'.format(self.s3_cmd_name, r.version_id))
+        return r.version_id
+
+    async def _is_replicated(self, pair):
+        (key, version_id) = pair
+        c = S3Command()
+        c.s3_cmd_name = 'head-object-in-archive'
+        c.s3_cmd_bucket_name = self.bucket_name
+        c.s3_cmd_params = [key, version_id]
+        try:
+            return (await c.execute_async()).found
+        except (ProcessException, S3ClientException, OSError) as e:
+            logger.debug('{} polling {} {} failed : {}'.format(self.s3_cmd_name, key, version_id, e))
+            return False
+
+    def _wait_for_replication(self, versions):
+        with stats.span('recover.replication_wait'):
+            self._poll_for_replication(versions)
+
+    def _poll_for_replication(self, versions):
+        # poll the archive zone with exponential backoff until every new
+        # (key, version-id) shows up there, or the deadline passes
+        start = time.time()
+        pending = [(k, v) for (k, v) in versions if v is not None]
+        if len(pending) < len(versions):
+            # new version-id unknown, nothing to poll for
+            time.sleep(config.SYNC_WINDOW_TIME)
+        deadline = start + config.SYNC_WINDOW_TIMEOUT
+        interval = config.SYNC_POLL_INTERVAL
+        while pending:
+            # every pending version polled at once, within the gateway limits
+            replicated = list(get_engine().map(self._is_replicated, pending, config.S3_MAX_REQUESTS))
+            pending = [p for (p, found) in zip(pending, replicated) if not found]
+            now = time.time()
+            if not pending or now >= deadline:
+                break
+            time.sleep(min(interval, deadline - now))
+            interval = min(interval * 2, config.SYNC_POLL_MAX_INTERVAL)
+        wait = time.time() - start
+        logger.debug('{} replication wait {:.3f}s, {} versions pending'.format(self.s3_cmd_name, wait, len(pending)))
+        if pending:
+            print('replication wait : {:.3f}s, {} versions not replicated yet'.format(wait, len(pending)))
+        else:
+            print('replication wait : {:.3f}s'.format(wait))
+
+    def _refresh(self, bucket_name, keys, versions):
+        # wait for object replication
+        self._wait_for_replication(versions)
 
-    def _delete_all_table_content(self):
-        # open db
-        db = SQLiteAccess()
-        db.open_default()
-        db.health_or_die()
-        db.delete_all_content()
+        # refresh the recovered keys in db, each one listed as a prefix
+        c = S3CommandFetchBucket()
+        c.s3_cmd_params = [bucket_name]
+        c.s3_cmd_modifiers = {'refresh': True}
+        c.prefixes = keys
+        with stats.span('recover.refresh'):
+            c.execute()
+
+class S3CommandRecoverObject(S3CommandRecover):
+
+    s3_cmd_name = 'recover-object'
 
     class Factory:
         def create(self):
@@ -401,77 +864,402 @@ class S3CommandRecoverObject(S3Command):
         # save working bucket name
         bucket_name = self._get_bucket_name()
 
-        # recover object from archive zone
-        c = S3Command()
-        c.s3_cmd_name = 'get-object-from-archive'
-        c.s3_cmd_params = self.s3_cmd_params
-        r = c.execute()
-        #print(r.stdout.decode('UTF-8'))
+        (key, version_id) = self.s3_cmd_params
+        try:
+            new_version_id = self._recover(key, version_id)
+        except (ProcessException, S3ClientException, OSError) as e:
+            show_error_and_abort(e.parameter if hasattr(e, 'parameter') else str(e))
 
-        # store recovered object in master zone
-        c = S3Command()
-        c.s3_cmd_name = 'put-object-in-master'
-        c.s3_cmd_params = self.s3_cmd_params
-        r = c.execute()
-        #print(r.stdout.decode('UTF-8'))
+        self._refresh(bucket_name, [key], [(key, new_version_id)])
 
-        # delete db
-        self._delete_all_table_content()
+    def show_output(self):
+        print('{} ok'.format(self.s3_cmd_name))
 
-        # wait for object replication
-        time.sleep(config.SYNC_WINDOW_TIME)
+class S3CommandRecoverObjects(S3CommandRecover):
 
-        # fetch bucket
-        c = S3CommandFetchBucket()
-        c.s3_cmd_params = [bucket_name]
-        r = c.execute()
+    s3_cmd_name = 'recover-objects'
+
+    class Factory:
+        def create(self):
+            return S3CommandRecoverObjects()
+
+    def _select(self, bucket_name):
+        # (key, version-id) pairs, one per line from a file or stdin ('-');
+        # a tab or the last blank separates key and version-id
+        name = self.s3_cmd_params[0]
+        try:
+            f = sys.stdin if name == '-' else open(name)
+        except OSError:
+            show_error_and_abort('Error reading {}'.format(name))
+        with f:
+            for line in f:
+                line = line.rstrip('\n')
+                if not line.strip():
+                    continue
+                pair = line.split('\t') if '\t' in line else line.rsplit(None, 1)
+                if len(pair) != 2:
+                    show_error_and_abort('Error invalid line : {}'.format(line))
+                yield pair
+
+    async def _recover_pair(self, pair):
+        try:
+            return (pair, await self._recover_async(pair[0], pair[1]), None)
+        except (ProcessException, S3ClientException, OSError) as e:
+            return (pair, None, e.parameter if hasattr(e, 'parameter') else str(e))
+
+    def execute(self):
+
+        # save working bucket name
+        bucket_name = self._get_bucket_name()
+
+        jobs = self._get_jobs(config.RECOVER_JOBS)
+        self.recovered = 0
+        self.failed = 0
+        keys = []
+        versions = []
+        # at most jobs recoveries in flight, the pairs are read as they finish
+        for ((key, version_id), new_version_id, error) in get_engine().map(self._recover_pair, self._select(bucket_name), jobs):
+            keys.append(key)
+            if error is None:
+                versions.append((key, new_version_id))
+                self.recovered += 1
+                stats.add('recover.recovered')
+                print('key = {}, version-id = {} ... RECOVERED ({})'.format(key, version_id, new_version_id))
+            else:
+                self.failed += 1
+                stats.add('recover.failed')
+                logger.debug('Error recovering {} {} : {}'.format(key, version_id, error))
+                print('key = {}, version-id = {} ... FAILED ({})'.format(key, version_id, error))
+
+        # reconcile db once, relisting the recovered keys only
+        if keys:
+            self._refresh(bucket_name, keys, versions)
 
     def show_output(self):
+        if self.failed:
+            show_error_and_abort('{} failed : {} objects recovered, {} failed'.format(self.s3_cmd_name, self.recovered, self.failed))
         print('{} ok'.format(self.s3_cmd_name))
 
+class S3CommandRecoverObjectsAt(S3CommandRecoverObjects):
+
+    s3_cmd_name = 'recover-objects-at'
+
+    class Factory:
+        def create(self):
+            return S3CommandRecoverObjectsAt()
+
+    def _select(self, bucket_name):
+        # latest version at date of every key under prefix, skipping the keys
+        # deleted at that date and the ones not changed since; read from the
+        # cursor as recoveries free up, db is only written once it is done
+        tdate = self._get_date(self.s3_cmd_params[0])
+        db = get_default_db()
+        for s3o in db.get_objects_at_date(self.bucket_xid, tdate, self.s3_cmd_modifiers.get('prefix')):
+            if isinstance(s3o, S3DeleteMarker):
+                print('key = {}, version-id = {} ... SKIPPED (delete marker)'.format(s3o.key, s3o.version_id))
+                continue
+            if s3o.is_latest:
+                print('key = {}, version-id = {} ... SKIPPED (latest version)'.format(s3o.key, s3o.version_id))
+                continue
+            yield (s3o.key, s3o.version_id)
+
 class S3CommandTrimObjects(S3Command):
 
     s3_cmd_name = 'trim-objects'
 
-    def _delete_db_objects_below_date(self, tdate):
-        # open db
-        db = SQLiteAccess()
-        db.open_default()
-        db.health_or_die()
-        db.delete_objects_below_date(tdate)
-
-    def _trim_objects_in_storage_below_date(self, tdate):
-        db = SQLiteAccess()
-        db.open_default()
-        db.health_or_die()
-        for s3o in db.get_objects_by_last_modified_below_date(tdate, order='asc'):
-            print('{} key = {}, version-id = {} ... '.format(s3o.last_modified, s3o.key, s3o.version_id), end='')
-            # delete object in storage by version-id
+    def _get_batch_size(self):
+        batch_size = self.s3_cmd_modifiers.get('batch_size')
+        if batch_size is None:
+            batch_size = config.TRIM_BATCH_SIZE
+        if batch_size < 1 or batch_size > 1000:
+            show_error_and_abort('Batch size must be between 1 and 1000')
+        return batch_size
+
+    async def _delete_batch(self, batch):
+        # returns the deleted objects and the (object, reason) failures
+        if len(batch) == 1:
+            s3o = batch[0]
             c = S3Command()
             c.s3_cmd_name = 'delete-object-in-archive'
+            c.s3_cmd_bucket_name = self.bucket_name
             c.s3_cmd_params = [s3o.key, s3o.version_id]
-            r = c.execute()
-            #print(r.stdout.decode('UTF-8'))
-            print('DELETED')
+            try:
+                await c.execute_async()
+            except (ProcessException, S3ClientException, OSError) as e:
+                return [], [(s3o, str(e))]
+            return batch, []
+        c = S3Command()
+        c.s3_cmd_name = 'delete-objects-in-archive'
+        c.s3_cmd_bucket_name = self.bucket_name
+        c.s3_cmd_params = [(s3o.key, s3o.version_id) for s3o in batch]
+        try:
+            result = (await c.execute_async()).result
+        except (ProcessException, S3ClientException, OSError) as e:
+            return [], [(s3o, str(e)) for s3o in batch]
+        errors = {}
+        for e in result.get('Errors', []):
+            # already gone, as expected when a job is resumed
+            if e.get('Code') in ('NoSuchKey', 'NoSuchVersion'):
+                continue
+            errors[(e.get('Key'), e.get('VersionId'))] = '{} {}'.format(e.get('Code'), e.get('Message'))
+        deleted = [s3o for s3o in batch if (s3o.key, s3o.version_id) not in errors]
+        failed = [(s3o, errors[(s3o.key, s3o.version_id)]) for s3o in batch
+                  if (s3o.key, s3o.version_id) in errors]
+        return deleted, failed
+
+    def _batches(self, db, job, batch_size, page_size):
+        # keyset paging over the pending versions of the job keeps the
+        # in-flight work bounded and lets failed versions stay behind
+        after = 0
+        while True:
+            with stats.span('trim.select'):
+                page = list(db.get_trim_job_versions(job.xid, after, page_size))
+            if not page:
+                break
+            after = page[-1].xid
+            for i in range(0, len(page), batch_size):
+                yield page[i:i + batch_size]
+
+    def _get_job(self, db):
+        # a new job with the versions below the trimming date, or the job
+        # given with --resume
+        job_xid = self.s3_cmd_modifiers.get('resume')
+        if job_xid is None:
+            tdate = self._get_date(self.s3_cmd_params[0])
+            (self.bucket_name, bucket_xid) = self._get_bucket(db)
+            with stats.span('trim.select'):
+                job = db.add_trim_job(bucket_xid, tdate)
+            print('trim job {} : {} versions below {}'.format(job.xid, job.total, job.date))
+            return job
+        if self.s3_cmd_params:
+            show_error_and_abort('Error --resume takes the trimming date from the job')
+        job = db.get_trim_job(job_xid)
+        if job is None:
+            show_error_and_abort('Error trim job {} not found'.format(job_xid))
+        if job.state == 'done':
+            show_error_and_abort('Error trim job {} is done'.format(job_xid))
+        self.bucket_name = db.get_bucket_name(job.bucket_xid)
+        job = db.resume_trim_job(job.xid)
+        print('trim job {} resumed : {} of {} versions below {} left'.format(job.xid,
+                                                                            job.total - job.deleted,
+                                                                            job.total,
+                                                                            job.date))
+        return job
+
+    def _trim_objects(self):
+        db = get_default_db()
+        jobs = self._get_jobs(config.TRIM_JOBS)
+        batch_size = self._get_batch_size()
+        page_size = max(1000, jobs * batch_size * 2)
+        self.job = self._get_job(db)
+        self.deleted = 0
+        self.failed = 0
+        # at most jobs batches in flight, the next ones selected as they
+        # finish; a job that is interrupted stays running and is resumed
+        # from its pending versions
+        for (deleted, failed) in get_engine().map(self._delete_batch,
+                                                  self._batches(db, self.job, batch_size, page_size),
+                                                  jobs):
+            for s3o in deleted:
+                print('{} key = {}, version-id = {} ... DELETED'.format(s3o.last_modified, s3o.key, s3o.version_id))
+            for (s3o, reason) in failed:
+                logger.debug('Error deleting {} {} : {}'.format(s3o.key, s3o.version_id, reason))
+                print('{} key = {}, version-id = {} ... FAILED ({})'.format(s3o.last_modified, s3o.key, s3o.version_id, reason))
+            # trim objects in db as soon as they are gone from storage
+            db.checkpoint_trim_job(self.job, deleted, failed)
+            self.deleted += len(deleted)
+            self.failed += len(failed)
+            stats.add('trim.deleted', len(deleted))
+            stats.add('trim.failed', len(failed))
+        self.job = db.end_trim_job(self.job.xid)
 
     class Factory:
         def create(self):
             return S3CommandTrimObjects()
 
+    def _plan(self):
+        # what trim-objects would delete, aggregated by db
+        if not self.s3_cmd_params:
+            show_error_and_abort('Error --plan requires a trimming date')
+        tdate = self._get_date(self.s3_cmd_params[0])
+        db = get_default_db()
+        (self.bucket_name, bucket_xid) = self._get_bucket(db)
+        versions = [0, 0]
+        delete_markers = 0
+        keys = 0
+        storage_classes = {}
+        prefixes = {}
+        for (prefix, storage_class, type, n, size, latest) in db.get_trim_plan(bucket_xid, tdate):
+            keys += latest
+            if type == 'D':
+                delete_markers += n
+                continue
+            versions[0] += n
+            versions[1] += size
+            for (totals, name) in ((storage_classes, storage_class), (prefixes, prefix)):
+                t = totals.setdefault(name, [0, 0])
+                t[0] += n
+                t[1] += size
+        print('trim plan : {} below {}'.format(self.bucket_name, self.s3_cmd_params[0]))
+        print('versions : {} ({} bytes)'.format(versions[0], versions[1]))
+        print('delete markers : {}'.format(delete_markers))
+        for name in sorted(storage_classes):
+            print('storage class : {} : {} versions ({} bytes)'.format(name, *storage_classes[name]))
+        for name in sorted(prefixes):
+            # keys without '/' are grouped as (none)
+            print('prefix : {} : {} versions ({} bytes)'.format(name or '(none)', *prefixes[name]))
+        print('keys losing every version : {}'.format(keys))
+        limit = self.s3_cmd_modifiers.get('limit')
+        if limit is None:
+            limit = config.TRIM_PLAN_KEYS
+        if limit < 1:
+            show_error_and_abort('Limit must be at least 1')
+        for key in db.get_keys_below_date(bucket_xid, tdate, limit):
+            print('key : {}'.format(key))
+        if keys > limit:
+            print('... {} more keys (see --limit)'.format(keys - limit))
+        self.deleted = 0
+        self.failed = 0
+
     def execute(self):
+        if self.s3_cmd_modifiers.get('plan'):
+            self._plan()
+            return
+        # trim objects in storage and db
+        self._trim_objects()
 
-        # get trimming date
-        tdate = self.s3_cmd_params[0]
+    def show_output(self):
+        if self.failed:
+            show_error_and_abort('{} failed : {} versions deleted, {} failed (see --resume {})'.format(self.s3_cmd_name,
+                                                                                                    self.deleted,
+                                                                                                    self.failed,
+                                                                                                    self.job.xid))
+        print('{} ok'.format(self.s3_cmd_name))
 
-        # trim objects in storage
-        self._trim_objects_in_storage_below_date(tdate)
+class S3CommandServe(S3Command):
+
+    s3_cmd_name = 'serve'
+
+    # commands served, the ones changing storage or db run one at a time
+    served_commands = ('info-db',
+                       'list-objects',
+                       'list-objects-by-key',
+                       'list-keys',
+                       'snapshot-at',
+                       'fetch-bucket',
+                       'recover-object',
+                       'recover-objects',
+                       'recover-objects-at',
+                       'trim-objects')
+    writing_commands = ('fetch-bucket',
+                        'recover-object',
+                        'recover-objects',
+                        'recover-objects-at',
+                        'trim-objects')
+
+    class Factory:
+        def create(self):
+            return S3CommandServe()
+
+    def _reader(self):
+        # listings read through connections of their own, so they see the
+        # last committed state and not the transaction of a running writer
+        with self.readers_lock:
+            if self.readers:
+                return self.readers.pop()
+        db = SQLiteAccess()
+        db.open_default(shared=True)
+        return db
+
+    def _run(self, command, params, modifiers):
+        c = S3CommandFactory.createS3Command(command)
+        c.set_params(params)
+        c.set_modifiers(modifiers)
+        if command in self.writing_commands:
+            with self.lock:
+                self._execute(c)
+            return
+        db = self._reader()
+        try:
+            with thread_db(db):
+                self._execute(c)
+        finally:
+            # idle readers are kept, and their caches with them
+            with self.readers_lock:
+                self.readers.append(db)
+
+    def _execute(self, c):
+        with stats.span('command.' + c.s3_cmd_name):
+            c.execute()
+        c.show_output()
+
+    def execute(self):
+
+        # open db once, every served command shares the connection
+        if SQLiteAccess().exists() is False:
+            show_error_and_abort('Error db not exist. Do you need to run --init-db?')
+        get_default_db()
+
+        address = self.s3_cmd_params[0] if self.s3_cmd_params else config.SERVE_ADDRESS
+        self.lock = threading.Lock()
+        self.readers = []
+        self.readers_lock = threading.Lock()
+        try:
+            server = create_server(address, self.served_commands, self._run)
+        except ServerException as e:
+            show_error_and_abort(e.parameter)
+        print('serving on {}'.format(address))
+        sys.stdout.flush()
+        # stop on SIGTERM as on ctrl-c, removing the unix socket
+        signal.signal(signal.SIGTERM, _interrupt)
+        try:
+            server.serve_forever()
+        except KeyboardInterrupt:
+            pass
+        finally:
+            server.server_close()
+            for db in self.readers:
+                db.close()
 
-        # trim objects in db
-        self._delete_db_objects_below_date(tdate)
- 
     def show_output(self):
         print('{} ok'.format(self.s3_cmd_name))
 
+def s3_version_from_json(v):
+    # the aws cli leaves Owner out of versions listed without an owner
+    o = v.get('Owner') or {}
+    s3o = intern_owner(o.get('DisplayName'), o.get('ID'))
+    return S3Version(0,
+                     v['LastModified'],
+                     v['VersionId'],
+                     v['ETag'],
+                     v['StorageClass'],
+                     v['Key'],
+                     s3o,
+                     v['IsLatest'],
+                     v['Size'])
+
+def s3_delete_marker_from_json(v):
+    # the aws cli leaves Owner out of versions listed without an owner
+    o = v.get('Owner') or {}
+    s3o = intern_owner(o.get('DisplayName'), o.get('ID'))
+    return S3DeleteMarker(0,
+                          v['LastModified'],
+                          v['VersionId'],
+                          v['Key'],
+                          s3o,
+                          v['IsLatest'])
+
+def _covering_prefixes(prefixes):
+    # the distinct prefixes, without the ones already covered by a shorter one
+    covered = []
+    for prefix in sorted(set(prefixes)):
+        if not covered or not prefix.startswith(covered[-1]):
+            covered.append(prefix)
+    return covered
+
+def _interrupt(signum, frame):
+    raise KeyboardInterrupt
+
 def show_error_and_abort(str):
     logger.debug(str)
     print(str)
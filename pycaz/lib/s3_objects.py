@@ -18,11 +18,13 @@
 # OUT OF OR IN CONNECTION WITH THE SOFTWARE OR THE USE OR OTHER DEALINGS IN THE
 # SOFTWARE.
 
-class S3Owner:
-    def __init__(self, xid, display_name, id):
-        self.xid = xid
-        self.display_name = display_name
-        self.id = id
+from collections import namedtuple
+
+# records are immutable named tuples, no per instance __dict__
+
+class S3Owner(namedtuple('S3Owner', ['xid', 'display_name', 'id'])):
+
+    __slots__ = ()
 
     def __str__(self):
         return "{} - {} - {}".format(self.xid,
@@ -30,29 +32,20 @@ class S3Owner:
                                      self.id)
 
 class S3Object:
-    pass
-
-class S3Version(S3Object):
-    xid = 0
-    last_modified = ''
-    version_id = ''
-    etag = ''
-    storage_class = ''
-    key = ''
-    owner = None
-    is_latest = True
-    size = 0
-
-    def __init__(self, xid, last_modified, version_id, etag, storage_class, key, owner, is_latest, size):
-        self.xid = xid
-        self.last_modified = last_modified
-        self.version_id = version_id
-        self.etag = etag
-        self.storage_class = storage_class
-        self.key = key
-        self.owner = owner
-        self.is_latest = is_latest
-        self.size = size
+
+    __slots__ = ()
+
+class S3Version(S3Object, namedtuple('S3Version', ['xid',
+                                                   'last_modified',
+                                                   'version_id',
+                                                   'etag',
+                                                   'storage_class',
+                                                   'key',
+                                                   'owner',
+                                                   'is_latest',
+                                                   'size'])):
+
+    __slots__ = ()
 
     '''
         "Versions": [
@@ -84,7 +77,7 @@ class S3Version(S3Object):
                                                          self.size)
     def pretty_str(self):
         return "{}:{}:{}:{}:{}:{}:{}:{}:{}:{}".format('V',
-                                                      '+' if self.is_latest is 1 else '-',
+                                                      '+' if self.is_latest else '-',
                                                       self.last_modified,
                                                       self.version_id,
                                                       self.key,
@@ -95,13 +88,12 @@ class S3Version(S3Object):
                                                       self.storage_class)
 
 class S3DeleteMarker(S3Version):
-    def __init__(self, xid, last_modified, version_id, key, owner, is_latest):
-        self.xid = xid
-        self.last_modified = last_modified
-        self.version_id = version_id
-        self.key = key
-        self.owner = owner
-        self.is_latest = is_latest
+
+    __slots__ = ()
+
+    # no etag, storage class or size
+    def __new__(cls, xid, last_modified, version_id, key, owner, is_latest):
+        return tuple.__new__(cls, (xid, last_modified, version_id, '', '', key, owner, is_latest, 0))
 
     '''
     "DeleteMarkers": [
@@ -134,3 +126,42 @@ class S3DeleteMarker(S3Version):
                                              self.key,
                                              self.owner.display_name,
                                              self.owner.id)
+
+class TrimJob(namedtuple('TrimJob', ['xid',
+                                       'bucket_xid',
+                                       'date',
+                                       'state',
+                                       'created',
+                                       'updated',
+                                       'total',
+                                       'deleted',
+                                       'failed'])):
+
+    __slots__ = ()
+
+    def pretty_str(self):
+        return "{}:{}:{}:{}:{}:{}:{}".format(self.xid,
+                                             self.state,
+                                             self.date,
+                                             self.updated,
+                                             self.total,
+                                             self.deleted,
+                                             self.failed)
+
+# version selected by a trim job
+class TrimJobVersion(namedtuple('TrimJobVersion', ['xid',
+                                                   'last_modified',
+                                                   'key',
+                                                   'version_id'])):
+
+    __slots__ = ()
+
+_owners = {}
+
+def intern_owner(display_name, id):
+    # one S3Owner per owner id shared by every listed version
+    owner = _owners.get(id)
+    if owner is None or owner.display_name != display_name:
+        owner = S3Owner(0, display_name, id)
+        _owners[id] = owner
+    return owner
@@ -0,0 +1,330 @@
+# Copyright (c) 2018 Javier M. Mellid <jmunhoz@igalia.com>
+#
+# Permission is hereby granted, free of charge, to any person obtaining a copy
+# of this software and associated documentation files (the "Software"), to deal
+# in the Software without restriction, including without limitation the rights
+# to use, copy, modify, merge, publish, distribute, sublicense, and/or sell
+# copies of the Software, and to permit persons to whom the Software is
+# furnished to do so, subject to the following conditions:
+#
+# The above copyright notice and this permission notice shall be included in all
+# copies or substantial portions of the Software.
+#
+# THE SOFTWARE IS PROVIDED "AS IS", WITHOUT WARRANTY OF ANY KIND, EXPRESS OR
+# IMPLIED, INCLUDING BUT NOT LIMITED TO THE WARRANTIES OF MERCHANTABILITY,
+# FITNESS FOR A PARTICULAR PURPOSE AND NONINFRINGEMENT. IN NO EVENT SHALL THE
+# AUTHORS OR COPYRIGHT HOLDERS BE LIABLE FOR ANY CLAIM, DAMAGES OR OTHER
+# LIABILITY, WHETHER IN AN ACTION OF CONTRACT, TORT OR OTHERWISE, ARISING FROM,
+# OUT OF OR IN CONNECTION WITH THE SOFTWARE OR THE USE OR OTHER DEALINGS IN THE
+# SOFTWARE.
+
+# caz --serve: a long running caz keeping the db connection, the S3
+# connection pools and the owner caches warm, and serving the caz commands
+# over HTTP on a unix socket or a localhost port:
+#
+#   POST /commands/<command>  {"params": [...], "modifiers": {...}, "stdin": "..."}
+#                             command stdout, exit status in X-Caz-Exit-Status
+#   GET  /stats               timing spans and counters (?format=prometheus)
+#   GET  /health
+#
+# caz --connect address forwards a command line to it. Requests come from a
+# caz client or not at all: no Origin header, a localhost Host, JSON bodies
+# and, on a tcp port, the bearer token of SERVE_TOKEN_FILE, so neither a web
+# page (CSRF, DNS rebinding) nor another local user can run a command.
+
+import contextvars
+import hmac
+import http.client
+import io
+import json
+import os
+import secrets
+import shutil
+import socket
+import socketserver
+import stat
+import sys
+import tempfile
+import urllib.parse
+
+from http.server import BaseHTTPRequestHandler, ThreadingHTTPServer
+
+from .exceptions import ServerException
+from . import config
+from . import logger
+from . import stats
+
+LOCALHOSTS = ('127.0.0.1', 'localhost')
+
+def parse_address(address):
+    # host:port for tcp, anything else is a unix socket path
+    if '/' not in address and ':' in address:
+        (host, port) = address.rsplit(':', 1)
+        host = host or '127.0.0.1'
+        try:
+            return ('tcp', (host, int(port)))
+        except ValueError:
+            raise ServerException('Error invalid address : {}'.format(address))
+    return ('unix', address)
+
+class ContextStream:
+
+    # sys.stdout and sys.stdin stand-in, every request thread, and the
+    # engine tasks it starts, reads and writes a stream of its own
+    def __init__(self, name, default):
+        self.default = default
+        self.stream = contextvars.ContextVar(name, default=None)
+
+    def set(self, stream):
+        self.stream.set(stream)
+
+    def _stream(self):
+        return self.stream.get() or self.default
+
+    def fileno(self):
+        # no raw fd behind a request stream, --output writes through it
+        if self.stream.get() is not None:
+            raise io.UnsupportedOperation('fileno')
+        return self.default.fileno()
+
+    def __getattr__(self, name):
+        return getattr(self._stream(), name)
+
+    def __iter__(self):
+        return iter(self._stream())
+
+    def __enter__(self):
+        return self._stream().__enter__()
+
+    def __exit__(self, *exc):
+        return self._stream().__exit__(*exc)
+
+def _exit_status(e):
+    if e.code is None:
+        return 0
+    if isinstance(e.code, int):
+        return e.code
+    print(e.code)
+    return 1
+
+class CazHandler(BaseHTTPRequestHandler):
+
+    protocol_version = 'HTTP/1.1'
+    server_version = 'caz'
+    # headers and body are separate writes, do not wait for delayed acks
+    disable_nagle_algorithm = True
+
+    def log_message(self, format, *args):
+        logger.debug('serve : ' + format % args)
+
+    def _reply(self, status, body, content_type='text/plain; charset=utf-8', headers=None):
+        self.send_response(status)
+        self.send_header('Content-Type', content_type)
+        self.send_header('Content-Length', str(len(body)))
+        for (name, value) in (headers or {}).items():
+            self.send_header(name, value)
+        self.end_headers()
+        self.wfile.write(body)
+
+    def _forbidden(self):
+        # the reason a request is refused, None for the ones of a caz client
+        if self.headers.get('Origin') is not None:
+            return 'cross origin request'
+        host = (self.headers.get('Host') or '').rsplit(':', 1)[0]
+        if host not in LOCALHOSTS:
+            return 'host {}'.format(host)
+        token = self.server.token
+        if token is not None:
+            auth = self.headers.get('Authorization') or ''
+            if not hmac.compare_digest(auth.encode('utf-8'), 'Bearer {}'.format(token).encode('utf-8')):
+                return 'bad token'
+        return None
+
+    def _refuse(self):
+        reason = self._forbidden()
+        if reason is None:
+            return False
+        logger.debug('serve : request refused : {}'.format(reason))
+        self._reply(403, b'forbidden\n')
+        return True
+
+    def do_GET(self):
+        if self._refuse():
+            return
+        u = urllib.parse.urlsplit(self.path)
+        if u.path == '/health':
+            return self._reply(200, b'ok\n')
+        if u.path == '/stats':
+            query = dict(urllib.parse.parse_qsl(u.query))
+            if query.get('format') == 'prometheus':
+                return self._reply(200, stats.to_prometheus().encode('utf-8'),
+                                   'text/plain; version=0.0.4; charset=utf-8')
+            return self._reply(200, stats.to_json().encode('utf-8'), 'application/json')
+        self._reply(404, b'not found\n')
+
+    def do_POST(self):
+        if self._refuse():
+            return
+        # a form can not send JSON, a cross origin fetch of JSON needs a preflight
+        content_type = (self.headers.get('Content-Type') or '').split(';', 1)[0].strip()
+        if content_type != 'application/json':
+            return self._reply(415, b'unsupported media type\n')
+        path = urllib.parse.urlsplit(self.path).path
+        command = path[len('/commands/'):] if path.startswith('/commands/') else None
+        try:
+            length = int(self.headers.get('Content-Length') or 0)
+            request = json.loads(self.rfile.read(length) or b'{}')
+        except ValueError:
+            return self._reply(400, b'bad request\n')
+        if command not in self.server.commands:
+            return self._reply(404, 'unknown command : {}\n'.format(command).encode('utf-8'))
+        # the command output is spooled and sent once its exit status is known
+        with tempfile.TemporaryFile() as spool:
+            out = io.TextIOWrapper(spool, encoding='utf-8', newline='', write_through=False)
+            sys.stdout.set(out)
+            sys.stdin.set(io.StringIO(request.get('stdin') or ''))
+            try:
+                self.server.run(command, request.get('params'), request.get('modifiers') or {})
+                status = 0
+            except SystemExit as e:
+                status = _exit_status(e)
+            except Exception as e:
+                logger.debug('serve : {} failed : {!r}'.format(command, e))
+                print('Error {} failed : {}'.format(command, e))
+                status = 1
+            finally:
+                sys.stdout.set(None)
+                sys.stdin.set(None)
+                out.flush()
+            out.detach()
+            size = spool.tell()
+            spool.seek(0)
+            self.send_response(200 if status == 0 else 500)
+            self.send_header('Content-Type', 'text/plain; charset=utf-8')
+            self.send_header('Content-Length', str(size))
+            self.send_header('X-Caz-Exit-Status', str(status))
+            self.end_headers()
+            shutil.copyfileobj(spool, self.wfile)
+
+class UnixCazHandler(CazHandler):
+    # TCP_NODELAY does not apply to unix sockets
+    disable_nagle_algorithm = False
+
+class TCPCazServer(ThreadingHTTPServer):
+
+    daemon_threads = True
+    request_queue_size = 128
+
+    def server_bind(self):
+        ThreadingHTTPServer.server_bind(self)
+        # any local user may connect to the port, only this one reads the token
+        self.token = secrets.token_hex(32)
+        self.token_file = config.SERVE_TOKEN_FILE
+        fd = os.open(self.token_file, os.O_WRONLY | os.O_CREAT | os.O_TRUNC, 0o600)
+        with os.fdopen(fd, 'w') as f:
+            os.fchmod(f.fileno(), 0o600)
+            f.write(self.token)
+
+    def server_close(self):
+        ThreadingHTTPServer.server_close(self)
+        try:
+            os.remove(self.token_file)
+        except OSError:
+            pass
+
+class UnixCazServer(socketserver.ThreadingMixIn, socketserver.UnixStreamServer):
+
+    daemon_threads = True
+    request_queue_size = 128
+    # the socket mode is the credential
+    token = None
+
+    def server_bind(self):
+        # drop a socket left behind by a caz --serve that did not shut down
+        try:
+            if stat.S_ISSOCK(os.stat(self.server_address).st_mode):
+                os.remove(self.server_address)
+        except FileNotFoundError:
+            pass
+        socketserver.UnixStreamServer.server_bind(self)
+        # only this user may send commands
+        os.chmod(self.server_address, 0o600)
+
+    def get_request(self):
+        (request, client_address) = socketserver.UnixStreamServer.get_request(self)
+        # BaseHTTPRequestHandler expects a (host, port) client address
+        return (request, ('unix', 0))
+
+    def server_close(self):
+        socketserver.UnixStreamServer.server_close(self)
+        try:
+            os.remove(self.server_address)
+        except OSError:
+            pass
+
+def create_server(address, commands, run):
+    # run(command, params, modifiers) executes one of commands, writing to
+    # sys.stdout and reading sys.stdin
+    (family, addr) = parse_address(address)
+    if family == 'tcp' and addr[0] not in LOCALHOSTS:
+        raise ServerException('caz serves localhost only, not {}'.format(addr[0]))
+    if not isinstance(sys.stdout, ContextStream):
+        sys.stdout = ContextStream('stdout', sys.stdout)
+    if not isinstance(sys.stdin, ContextStream):
+        sys.stdin = ContextStream('stdin', sys.stdin)
+    try:
+        if family == 'tcp':
+            server = TCPCazServer(addr, CazHandler)
+        else:
+            server = UnixCazServer(addr, UnixCazHandler)
+    except OSError as e:
+        raise ServerException('Error listening on {} : {}'.format(address, e))
+    server.commands = commands
+    server.run = run
+    return server
+
+class UnixHTTPConnection(http.client.HTTPConnection):
+
+    def __init__(self, path, timeout=None):
+        http.client.HTTPConnection.__init__(self, 'localhost', timeout=timeout)
+        self.path = path
+
+    def connect(self):
+        self.sock = socket.socket(socket.AF_UNIX, socket.SOCK_STREAM)
+        if self.timeout is not None:
+            self.sock.settimeout(self.timeout)
+        self.sock.connect(self.path)
+
+class CazClient:
+
+    def __init__(self, address):
+        self.address = address
+        (family, addr) = parse_address(address)
+        self.headers = {'Content-Type': 'application/json'}
+        if family == 'tcp':
+            self.conn = http.client.HTTPConnection(addr[0], addr[1])
+            try:
+                with open(config.SERVE_TOKEN_FILE) as f:
+                    self.headers['Authorization'] = 'Bearer {}'.format(f.read().strip())
+            except OSError as e:
+                raise ServerException('Error reading the caz server token {} : {}'.format(config.SERVE_TOKEN_FILE, e))
+        else:
+            self.conn = UnixHTTPConnection(addr)
+
+    def run(self, command, params, modifiers, stdin=None, out=None):
+        # forward a command, copy its output to out and return its exit status
+        body = json.dumps({'params': params, 'modifiers': modifiers, 'stdin': stdin}).encode('utf-8')
+        try:
+            self.conn.request('POST', '/commands/' + command, body, self.headers)
+            response = self.conn.getresponse()
+            status = response.getheader('X-Caz-Exit-Status')
+            if status is None:
+                raise ServerException('Error {} : {}'.format(self.address, response.read().decode('utf-8', 'replace').strip()))
+            shutil.copyfileobj(response, out or sys.stdout.buffer)
+        except OSError as e:
+            raise ServerException('Error connecting to caz server at {} : {}'.format(self.address, e))
+        except http.client.HTTPException as e:
+            raise ServerException('Error talking to caz server at {} : {!r}'.format(self.address, e))
+        finally:
+            self.conn.close()
+        return int(status)
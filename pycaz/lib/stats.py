@@ -0,0 +1,138 @@
+# Copyright (c) 2018 Javier M. Mellid <jmunhoz@igalia.com>
+#
+# Permission is hereby granted, free of charge, to any person obtaining a copy
+# of this software and associated documentation files (the "Software"), to deal
+# in the Software without restriction, including without limitation the rights
+# to use, copy, modify, merge, publish, distribute, sublicense, and/or sell
+# copies of the Software, and to permit persons to whom the Software is
+# furnished to do so, subject to the following conditions:
+#
+# The above copyright notice and this permission notice shall be included in all
+# copies or substantial portions of the Software.
+#
+# THE SOFTWARE IS PROVIDED "AS IS", WITHOUT WARRANTY OF ANY KIND, EXPRESS OR
+# IMPLIED, INCLUDING BUT NOT LIMITED TO THE WARRANTIES OF MERCHANTABILITY,
+# FITNESS FOR A PARTICULAR PURPOSE AND NONINFRINGEMENT. IN NO EVENT SHALL THE
+# AUTHORS OR COPYRIGHT HOLDERS BE LIABLE FOR ANY CLAIM, DAMAGES OR OTHER
+# LIABILITY, WHETHER IN AN ACTION OF CONTRACT, TORT OR OTHERWISE, ARISING FROM,
+# OUT OF OR IN CONNECTION WITH THE SOFTWARE OR THE USE OR OTHER DEALINGS IN THE
+# SOFTWARE.
+
+# Process-wide timing spans and counters; --stats prints them when the
+# command ends, --stats-file exports them as JSON or as a Prometheus
+# textfile collector file.
+
+import json
+import os
+import re
+import tempfile
+import threading
+import time
+
+_lock = threading.Lock()
+# span name -> [calls, total seconds, max seconds]
+_spans = {}
+# counter name -> value
+_counters = {}
+
+class Span:
+
+    __slots__ = ('name', 'start')
+
+    def __init__(self, name):
+        self.name = name
+
+    def __enter__(self):
+        self.start = time.perf_counter()
+        return self
+
+    def __exit__(self, *exc):
+        record(self.name, time.perf_counter() - self.start)
+
+def span(name):
+    # times the enclosed block: with stats.span('db.add_objects'): ...
+    return Span(name)
+
+def record(name, seconds):
+    with _lock:
+        s = _spans.get(name)
+        if s is None:
+            _spans[name] = [1, seconds, seconds]
+        else:
+            s[0] += 1
+            s[1] += seconds
+            if seconds > s[2]:
+                s[2] = seconds
+
+def add(name, value=1):
+    with _lock:
+        _counters[name] = _counters.get(name, 0) + value
+
+def reset():
+    with _lock:
+        _spans.clear()
+        _counters.clear()
+
+def snapshot():
+    with _lock:
+        return {'spans': dict((name, {'calls': s[0], 'seconds': s[1], 'max_seconds': s[2]})
+                              for (name, s) in sorted(_spans.items())),
+                'counters': dict(sorted(_counters.items()))}
+
+def summary():
+    # spans by total time, then counters
+    snap = snapshot()
+    lines = ['{:<44} {:>8} {:>11} {:>11}'.format('span', 'calls', 'seconds', 'max')]
+    for (name, s) in sorted(snap['spans'].items(), key=lambda i: -i[1]['seconds']):
+        lines.append('{:<44} {:>8} {:>11.3f} {:>11.3f}'.format(name, s['calls'], s['seconds'], s['max_seconds']))
+    if snap['counters']:
+        lines.append('{:<44} {:>8}'.format('counter', 'value'))
+        for (name, value) in snap['counters'].items():
+            lines.append('{:<44} {:>8}'.format(name, value))
+    return '\n'.join(lines)
+
+def _metric_name(name):
+    return re.sub('[^a-zA-Z0-9_]', '_', name)
+
+def _label(value):
+    return value.replace('\\', '\\\\').replace('"', '\\"').replace('\n', '\\n')
+
+def to_prometheus(command=None):
+    # text exposition format, one sample per span and counter
+    snap = snapshot()
+    command = 'command="{}"'.format(_label(command)) if command else ''
+    labels = '{{{}}}'.format(command) if command else ''
+    lines = []
+    for (metric, kind, key, text) in (('caz_span_seconds_total', 'counter', 'seconds', 'Time spent in caz spans.'),
+                                      ('caz_span_calls_total', 'counter', 'calls', 'Calls of caz spans.'),
+                                      ('caz_span_max_seconds', 'gauge', 'max_seconds', 'Longest call of caz spans.')):
+        lines.append('# HELP {} {}'.format(metric, text))
+        lines.append('# TYPE {} {}'.format(metric, kind))
+        for (name, s) in snap['spans'].items():
+            lines.append('{}{{span="{}"{}}} {}'.format(metric, _label(name), ',' + command if command else '', s[key]))
+    for (name, value) in snap['counters'].items():
+        metric = 'caz_{}_total'.format(_metric_name(name))
+        lines.append('# TYPE {} counter'.format(metric))
+        lines.append('{}{} {}'.format(metric, labels, value))
+    lines.append('# TYPE caz_last_run_timestamp_seconds gauge')
+    lines.append('caz_last_run_timestamp_seconds{} {}'.format(labels, time.time()))
+    return '\n'.join(lines) + '\n'
+
+def to_json(command=None):
+    snap = snapshot()
+    snap['command'] = command
+    snap['timestamp'] = time.time()
+    return json.dumps(snap, indent=2) + '\n'
+
+def write(filename, format='json', command=None):
+    # written aside and renamed, textfile collectors never read a partial file
+    data = to_prometheus(command) if format == 'prometheus' else to_json(command)
+    (fd, tmp) = tempfile.mkstemp(prefix='.caz-stats-', dir=os.path.dirname(os.path.abspath(filename)))
+    try:
+        with os.fdopen(fd, 'w') as f:
+            f.write(data)
+        os.chmod(tmp, 0o644)
+        os.replace(tmp, filename)
+    except BaseException:
+        os.remove(tmp)
+        raise
@@ -24,11 +24,13 @@ FIXON = False
 
 def fix(args):
     global FIXON
-    if len(args) == 4 and (args[1] == '-r' or args[1] == '--recover-object'):
-         if args[3].startswith('-'):
-              logger.debug("Fixing version-id to avoid '-' bug : {}".format(args[3]))
-              args[3] = 'x' + args[3]
-              FIXON = True
+    for i in range(1, len(args) - 2):
+         if args[i] == '-r' or args[i] == '--recover-object':
+              if args[i + 2].startswith('-'):
+                   logger.debug("Fixing version-id to avoid '-' bug : {}".format(args[i + 2]))
+                   args[i + 2] = 'x' + args[i + 2]
+                   FIXON = True
+              break
     return args
 
 def unfix(s3_cmd_params):
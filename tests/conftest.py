@@ -0,0 +1,141 @@
+# Copyright (c) 2018 Javier M. Mellid <jmunhoz@igalia.com>
+#
+# Permission is hereby granted, free of charge, to any person obtaining a copy
+# of this software and associated documentation files (the "Software"), to deal
+# in the Software without restriction, including without limitation the rights
+# to use, copy, modify, merge, publish, distribute, sublicense, and/or sell
+# copies of the Software, and to permit persons to whom the Software is
+# furnished to do so, subject to the following conditions:
+#
+# The above copyright notice and this permission notice shall be included in all
+# copies or substantial portions of the Software.
+#
+# THE SOFTWARE IS PROVIDED "AS IS", WITHOUT WARRANTY OF ANY KIND, EXPRESS OR
+# IMPLIED, INCLUDING BUT NOT LIMITED TO THE WARRANTIES OF MERCHANTABILITY,
+# FITNESS FOR A PARTICULAR PURPOSE AND NONINFRINGEMENT. IN NO EVENT SHALL THE
+# AUTHORS OR COPYRIGHT HOLDERS BE LIABLE FOR ANY CLAIM, DAMAGES OR OTHER
+# LIABILITY, WHETHER IN AN ACTION OF CONTRACT, TORT OR OTHERWISE, ARISING FROM,
+# OUT OF OR IN CONNECTION WITH THE SOFTWARE OR THE USE OR OTHER DEALINGS IN THE
+# SOFTWARE.
+
+# The tests run caz against two mock RGW zones, master and archive, sharing
+# one in-memory store, each test with its own db in a temporary directory.
+
+import os
+import subprocess
+import sys
+import time
+
+import pytest
+
+import pycaz.lib.config as config
+import pycaz.lib.stats as stats
+import pycaz.lib.wks as wks
+
+from pycaz.caz import run_project
+from pycaz.lib.db import SQLiteAccess, close_default_db
+from pycaz.lib.mock_rgw import MockRGW, MockStore
+from pycaz.lib.options import Options
+
+ROOT = os.path.dirname(os.path.dirname(os.path.abspath(__file__)))
+
+OWNER = {'ID': 'ak', 'DisplayName': 'Test User'}
+
+# caz in a child process, configured from the environment
+CAZ_MAIN = """
+import os, sys
+import pycaz.lib.config as config
+config.DEBUG_FLAG = False
+config.DATA_SOURCE = 'native'
+config.AWS_ACCESS_KEY_ID = 'ak'
+config.AWS_SECRET_ACCESS_KEY = 'sk'
+config.MASTER_GATEWAY = os.environ['CAZ_MASTER_GATEWAY']
+config.ARCHIVE_GATEWAY = os.environ['CAZ_ARCHIVE_GATEWAY']
+from pycaz.caz import run_project
+sys.argv[0] = 'caz'
+run_project(sys.argv)
+"""
+
+class Caz:
+
+    def __init__(self, store, master, archive, path, capsys, monkeypatch):
+        self.store = store
+        self.master = master
+        self.archive = archive
+        self.path = path
+        self.capsys = capsys
+        self.monkeypatch = monkeypatch
+
+    def __call__(self, *args):
+        # Options parses sys.argv and keeps its commands in the class
+        argv = ['caz'] + list(args)
+        sys.argv = argv
+        Options.cmds = {}
+        wks.FIXON = False
+        # every caz run is a process of its own
+        stats.reset()
+        self.capsys.readouterr()
+        run_project(argv)
+        captured = self.capsys.readouterr()
+        self.err = captured.err
+        return captured.out
+
+    def put(self, key, data, owner=OWNER, bucket='b'):
+        return self.store.put(bucket, key, data, owner)
+
+    def lag(self, seconds):
+        # an archive zone getting the new versions seconds late
+        self.archive.stop()
+        self.archive = MockRGW(self.store, lag=seconds).start()
+        self.monkeypatch.setattr(config, 'ARCHIVE_GATEWAY', self.archive.endpoint)
+
+    def delete(self, key, bucket='b'):
+        return self.store.add_delete_marker(bucket, key, OWNER)
+
+    def versions(self, key, bucket='b'):
+        return self.store.buckets[bucket].get(key, [])
+
+    def env(self):
+        return dict(os.environ,
+                    PYTHONPATH=ROOT,
+                    CAZ_MASTER_GATEWAY=self.master.endpoint,
+                    CAZ_ARCHIVE_GATEWAY=self.archive.endpoint)
+
+    def popen(self, *args, **kwargs):
+        return subprocess.Popen([sys.executable, '-c', CAZ_MAIN] + list(args),
+                                env=self.env(), cwd=str(self.path),
+                                stdout=subprocess.PIPE, stderr=subprocess.PIPE,
+                                universal_newlines=True, **kwargs)
+
+    def run(self, *args):
+        p = self.popen(*args)
+        out, err = p.communicate(timeout=120)
+        return p.returncode, out, err
+
+    def wait_for(self, name, timeout=30):
+        deadline = time.time() + timeout
+        while not (self.path / name).exists():
+            if time.time() > deadline:
+                raise TimeoutError(name)
+            time.sleep(0.05)
+
+@pytest.fixture
+def caz(tmp_path, monkeypatch, capsys):
+    store = MockStore()
+    store.create_bucket('b')
+    master = MockRGW(store).start()
+    archive = MockRGW(store).start()
+    monkeypatch.chdir(tmp_path)
+    monkeypatch.setattr(sys, 'argv', list(sys.argv))
+    monkeypatch.setattr(SQLiteAccess, 'db_name', str(tmp_path / config.DB_FILE))
+    monkeypatch.setattr(config, 'DEBUG_FLAG', False)
+    monkeypatch.setattr(config, 'DATA_SOURCE', 'native')
+    monkeypatch.setattr(config, 'AWS_ACCESS_KEY_ID', 'ak')
+    monkeypatch.setattr(config, 'AWS_SECRET_ACCESS_KEY', 'sk')
+    monkeypatch.setattr(config, 'MASTER_GATEWAY', master.endpoint)
+    monkeypatch.setattr(config, 'ARCHIVE_GATEWAY', archive.endpoint)
+    caz = Caz(store, master, archive, tmp_path, capsys, monkeypatch)
+    yield caz
+    close_default_db()
+    caz.master.stop()
+    caz.archive.stop()
@@ -0,0 +1,138 @@
+# Copyright (c) 2018 Javier M. Mellid <jmunhoz@igalia.com>
+#
+# Permission is hereby granted, free of charge, to any person obtaining a copy
+# of this software and associated documentation files (the "Software"), to deal
+# in the Software without restriction, including without limitation the rights
+# to use, copy, modify, merge, publish, distribute, sublicense, and/or sell
+# copies of the Software, and to permit persons to whom the Software is
+# furnished to do so, subject to the following conditions:
+#
+# The above copyright notice and this permission notice shall be included in all
+# copies or substantial portions of the Software.
+#
+# THE SOFTWARE IS PROVIDED "AS IS", WITHOUT WARRANTY OF ANY KIND, EXPRESS OR
+# IMPLIED, INCLUDING BUT NOT LIMITED TO THE WARRANTIES OF MERCHANTABILITY,
+# FITNESS FOR A PARTICULAR PURPOSE AND NONINFRINGEMENT. IN NO EVENT SHALL THE
+# AUTHORS OR COPYRIGHT HOLDERS BE LIABLE FOR ANY CLAIM, DAMAGES OR OTHER
+# LIABILITY, WHETHER IN AN ACTION OF CONTRACT, TORT OR OTHERWISE, ARISING FROM,
+# OUT OF OR IN CONNECTION WITH THE SOFTWARE OR THE USE OR OTHER DEALINGS IN THE
+# SOFTWARE.
+
+import pytest
+
+import pycaz.lib.config as config
+
+from pycaz.lib.mock_rgw import MockRGWHandler
+
+DATA = bytes(range(256)) * 40
+
+def _headers(v):
+    return dict((h.lower(), value) for h, value in v['Headers'].items())
+
+def _old_version(caz):
+    old = caz.store.put('b', 'k', DATA, {'ID': 'ak', 'DisplayName': 'Test User'},
+                        {'Content-Type': 'image/png', 'x-amz-meta-color': 'blue'})
+    caz.put('k', b'new')
+    caz('-i')
+    caz('-f', 'b')
+    return old['VersionId']
+
+def _parts(caz, monkeypatch):
+    # sizes of the multipart parts uploaded from now on
+    sizes = []
+    put_part = caz.store.put_part
+    def recording_put_part(upload_id, part_number, data):
+        sizes.append(len(data))
+        return put_part(upload_id, part_number, data)
+    monkeypatch.setattr(caz.store, 'put_part', recording_put_part)
+    return sizes
+
+def test_recover_object_streamed(caz, monkeypatch):
+    old = _old_version(caz)
+    sizes = _parts(caz, monkeypatch)
+    assert 'recover-object ok' in caz('-r', 'k', old)
+    latest = caz.versions('k')[0]
+    assert latest['Data'] == DATA
+    assert sizes == []
+    assert _headers(latest) == {'content-type': 'image/png', 'x-amz-meta-color': 'blue'}
+
+def test_recover_object_multipart(caz, monkeypatch):
+    old = _old_version(caz)
+    monkeypatch.setattr(config, 'MULTIPART_THRESHOLD', 4096)
+    monkeypatch.setattr(config, 'MULTIPART_CHUNK_SIZE', 3000)
+    sizes = _parts(caz, monkeypatch)
+    assert 'recover-object ok' in caz('-r', 'k', old)
+    latest = caz.versions('k')[0]
+    assert latest['Data'] == DATA
+    assert sizes == [3000, 3000, 3000, 1240]
+    assert latest['ETag'].endswith('-4"')
+    assert _headers(latest) == {'content-type': 'image/png', 'x-amz-meta-color': 'blue'}
+    assert caz.store.uploads == {}
+
+def test_recover_object_multipart_aborted(caz, monkeypatch):
+    old = _old_version(caz)
+    monkeypatch.setattr(config, 'MULTIPART_THRESHOLD', 4096)
+    monkeypatch.setattr(config, 'MULTIPART_CHUNK_SIZE', 3000)
+    put_part = caz.store.put_part
+    def failing_put_part(upload_id, part_number, data):
+        if part_number == 3:
+            return None
+        return put_part(upload_id, part_number, data)
+    monkeypatch.setattr(caz.store, 'put_part', failing_put_part)
+    with pytest.raises(SystemExit):
+        caz('-r', 'k', old)
+    # the upload is aborted, no version is added
+    assert caz.store.uploads == {}
+    assert [v['Data'] for v in caz.versions('k')] == [b'new', DATA]
+
+def _gets(monkeypatch):
+    # GET object requests served from now on
+    gets = []
+    get = MockRGWHandler._get
+    def recording_get(handler, bucket, key, query):
+        # HEAD requests are answered by _get too
+        if handler.command == 'GET':
+            gets.append(key)
+        return get(handler, bucket, key, query)
+    monkeypatch.setattr(MockRGWHandler, '_get', recording_get)
+    return gets
+
+def test_recover_object_server_side_copy(caz, monkeypatch):
+    old = _old_version(caz)
+    gets = _gets(monkeypatch)
+    assert 'recover-object ok' in caz('-r', 'k', old, '--server-side-copy')
+    latest = caz.versions('k')[0]
+    assert latest['Data'] == DATA
+    assert _headers(latest) == {'content-type': 'image/png', 'x-amz-meta-color': 'blue'}
+    # the payload never left the gateway
+    assert gets == []
+
+def test_recover_object_server_side_copy_config(caz, monkeypatch):
+    old = _old_version(caz)
+    monkeypatch.setattr(config, 'SERVER_SIDE_COPY', True)
+    gets = _gets(monkeypatch)
+    assert 'recover-object ok' in caz('-r', 'k', old)
+    assert caz.versions('k')[0]['Data'] == DATA
+    assert gets == []
+
+def test_recover_object_server_side_copy_parts(caz, monkeypatch):
+    old = _old_version(caz)
+    monkeypatch.setattr(config, 'COPY_OBJECT_MAX_SIZE', 4096)
+    monkeypatch.setattr(config, 'MULTIPART_CHUNK_SIZE', 3000)
+    sizes = _parts(caz, monkeypatch)
+    gets = _gets(monkeypatch)
+    assert 'recover-object ok' in caz('-r', 'k', old, '--server-side-copy')
+    latest = caz.versions('k')[0]
+    assert latest['Data'] == DATA
+    assert sizes == [3000, 3000, 3000, 1240]
+    assert _headers(latest) == {'content-type': 'image/png', 'x-amz-meta-color': 'blue'}
+    assert gets == []
+
+def test_recover_object_server_side_copy_fallback(caz, monkeypatch):
+    old = _old_version(caz)
+    # the gateway refuses the copy, the object goes through get/put
+    monkeypatch.setattr(MockRGWHandler, '_copy_source', lambda handler: None)
+    gets = _gets(monkeypatch)
+    assert 'recover-object ok' in caz('-r', 'k', old, '--server-side-copy')
+    assert caz.versions('k')[0]['Data'] == DATA
+    assert gets == ['k']
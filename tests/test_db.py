@@ -0,0 +1,83 @@
+# Copyright (c) 2018 Javier M. Mellid <jmunhoz@igalia.com>
+#
+# Permission is hereby granted, free of charge, to any person obtaining a copy
+# of this software and associated documentation files (the "Software"), to deal
+# in the Software without restriction, including without limitation the rights
+# to use, copy, modify, merge, publish, distribute, sublicense, and/or sell
+# copies of the Software, and to permit persons to whom the Software is
+# furnished to do so, subject to the following conditions:
+#
+# The above copyright notice and this permission notice shall be included in all
+# copies or substantial portions of the Software.
+#
+# THE SOFTWARE IS PROVIDED "AS IS", WITHOUT WARRANTY OF ANY KIND, EXPRESS OR
+# IMPLIED, INCLUDING BUT NOT LIMITED TO THE WARRANTIES OF MERCHANTABILITY,
+# FITNESS FOR A PARTICULAR PURPOSE AND NONINFRINGEMENT. IN NO EVENT SHALL THE
+# AUTHORS OR COPYRIGHT HOLDERS BE LIABLE FOR ANY CLAIM, DAMAGES OR OTHER
+# LIABILITY, WHETHER IN AN ACTION OF CONTRACT, TORT OR OTHERWISE, ARISING FROM,
+# OUT OF OR IN CONNECTION WITH THE SOFTWARE OR THE USE OR OTHER DEALINGS IN THE
+# SOFTWARE.
+
+import json
+import sqlite3
+
+import pytest
+
+from pycaz.lib.db import SCHEMA_VERSION, SQLiteAccess, close_default_db, get_default_db
+
+# the schema of a db created before the migrations, at user_version 0
+BASELINE_SCHEMA = """
+CREATE TABLE BUCKET (NAME TEXT PRIMARY KEY);
+CREATE TABLE OWNERS (XID INTEGER PRIMARY KEY AUTOINCREMENT, DISPLAY_NAME TEXT, ID TEXT);
+CREATE TABLE OBJECTS (XID INTEGER PRIMARY KEY AUTOINCREMENT, LAST_MODIFIED TEXT, VERSION_ID TEXT,
+                      ETAG TEXT, STORAGE_CLASS TEXT, KEY TEXT, OWNER_XID INTEGER, IS_LATEST INTEGER,
+                      SIZE INTEGER, TYPE CHAR, FOREIGN KEY(OWNER_XID) REFERENCES OWNERS(XID));
+INSERT INTO BUCKET (NAME) VALUES ('b');
+INSERT INTO OWNERS (DISPLAY_NAME, ID) VALUES ('Test User', 'ak');
+INSERT INTO OBJECTS (LAST_MODIFIED, VERSION_ID, ETAG, STORAGE_CLASS, KEY, OWNER_XID, IS_LATEST, SIZE, TYPE)
+     VALUES ('2018-06-22T10:55:36.186Z', 'v1', '"e1"', 'STANDARD', 'k', 1, 0, 1, 'V'),
+            ('2018-06-22T11:22:31.955Z', 'v2', '"e2"', 'STANDARD', 'k', 1, 1, 2, 'V'),
+            ('2018-06-22T11:22:31.955Z', 'v2', '"e2"', 'STANDARD', 'k', 1, 1, 2, 'V'),
+            ('2018-06-23T00:00:00.000Z', 'd1', '', '', 'gone', 1, 1, 0, 'D');
+"""
+
+def _baseline_db(path):
+    db = sqlite3.connect(str(path))
+    db.executescript(BASELINE_SCHEMA)
+    db.close()
+
+def test_migrate_baseline_db(caz):
+    _baseline_db(caz.path / 'caz.db')
+    db = get_default_db()
+    assert db.get_schema_version() == SCHEMA_VERSION
+    # the duplicated (key, version-id) row is gone, the rest moved to bucket b
+    bucket_xid = db.get_bucket_xid('b')
+    rows = db.database.execute('SELECT BUCKET_XID, KEY, VERSION_ID, LAST_MODIFIED_US FROM OBJECTS ORDER BY XID').fetchall()
+    assert [tuple(r) for r in rows] == [(bucket_xid, 'k', 'v1', 1529664936186000),
+                                        (bucket_xid, 'k', 'v2', 1529666551955000),
+                                        (bucket_xid, 'gone', 'd1', 1529712000000000)]
+    indexes = {r[0]: r[1] for r in db.database.execute("SELECT NAME, SQL FROM SQLITE_MASTER WHERE TYPE = 'index' AND SQL IS NOT NULL")}
+    assert set(indexes) == {'OWNERS_ID',
+                            'OBJECTS_BUCKET_KEY_VERSION_ID',
+                            'OBJECTS_BUCKET_KEY_LAST_MODIFIED',
+                            'OBJECTS_BUCKET_LAST_MODIFIED',
+                            'TRIM_JOB_VERSIONS_JOB_STATE'}
+    assert '(BUCKET_XID, LAST_MODIFIED_US)' in indexes['OBJECTS_BUCKET_LAST_MODIFIED']
+    # and caz works on it
+    objs = [json.loads(l) for l in caz('-l', '--output', 'jsonl').splitlines()]
+    assert [(o['key'], o['version_id']) for o in objs] == [('gone', 'd1'), ('k', 'v2'), ('k', 'v1')]
+
+def test_init_db_is_current(caz):
+    caz('-i')
+    assert get_default_db().get_schema_version() == SCHEMA_VERSION
+
+def test_newer_db_is_refused(caz):
+    caz('-i')
+    db = get_default_db()
+    db.database.execute('PRAGMA user_version = {}'.format(SCHEMA_VERSION + 1))
+    close_default_db()
+    db = SQLiteAccess()
+    db.open_default()
+    with pytest.raises(SystemExit):
+        db.health_or_die()
+    db.close()
@@ -0,0 +1,149 @@
+# Copyright (c) 2018 Javier M. Mellid <jmunhoz@igalia.com>
+#
+# Permission is hereby granted, free of charge, to any person obtaining a copy
+# of this software and associated documentation files (the "Software"), to deal
+# in the Software without restriction, including without limitation the rights
+# to use, copy, modify, merge, publish, distribute, sublicense, and/or sell
+# copies of the Software, and to permit persons to whom the Software is
+# furnished to do so, subject to the following conditions:
+#
+# The above copyright notice and this permission notice shall be included in all
+# copies or substantial portions of the Software.
+#
+# THE SOFTWARE IS PROVIDED "AS IS", WITHOUT WARRANTY OF ANY KIND, EXPRESS OR
+# IMPLIED, INCLUDING BUT NOT LIMITED TO THE WARRANTIES OF MERCHANTABILITY,
+# FITNESS FOR A PARTICULAR PURPOSE AND NONINFRINGEMENT. IN NO EVENT SHALL THE
+# AUTHORS OR COPYRIGHT HOLDERS BE LIABLE FOR ANY CLAIM, DAMAGES OR OTHER
+# LIABILITY, WHETHER IN AN ACTION OF CONTRACT, TORT OR OTHERWISE, ARISING FROM,
+# OUT OF OR IN CONNECTION WITH THE SOFTWARE OR THE USE OR OTHER DEALINGS IN THE
+# SOFTWARE.
+
+import io
+import json
+import sqlite3
+import sys
+
+import pytest
+
+from pycaz.lib.s3_commands import s3_delete_marker_from_json, s3_version_from_json
+
+def _listing(caz, *args):
+    return [json.loads(l) for l in caz('-l', '--output', 'jsonl', *args).splitlines()]
+
+def test_fetch_bucket(caz):
+    for i in range(7):
+        for n in range(3):
+            caz.put('k{}'.format(i), b'v' * n)
+    caz.delete('k0')
+    assert 'init-db ok' in caz('-i')
+    assert 'fetch-bucket ok' in caz('-f', 'b', '--page-size', '2')
+    objs = _listing(caz)
+    assert len(objs) == 22
+    assert sum(o['type'] == 'D' for o in objs) == 1
+    assert {o['version_id'] for o in objs} == {v['VersionId'] for k in caz.store.buckets['b'] for v in caz.versions(k)}
+    latest = [o for o in objs if o['is_latest']]
+    assert {o['version_id'] for o in latest} == {caz.versions(o['key'])[0]['VersionId'] for o in latest}
+
+def test_fetch_bucket_refresh(caz):
+    v = caz.put('k', b'one')
+    caz('-i')
+    caz('-f', 'b')
+    caz.put('k', b'two')
+    caz.store.delete_version('b', 'k', v['VersionId'])
+    with pytest.raises(SystemExit):
+        caz('-f', 'b')
+    caz('-f', 'b', '--refresh')
+    assert [o['version_id'] for o in _listing(caz)] == [caz.versions('k')[0]['VersionId']]
+
+def test_fetch_bucket_without_owner(caz):
+    caz.put('anonymous', b'x', owner=None)
+    caz.put('owned', b'x')
+    caz('-i')
+    assert 'fetch-bucket ok' in caz('-f', 'b')
+    owners = {o['key']: o['owner_id'] for o in _listing(caz)}
+    assert owners == {'anonymous': None, 'owned': 'ak'}
+
+def test_aws_cli_json_without_owner():
+    v = s3_version_from_json({'LastModified': '2020-01-01T00:00:00.000Z', 'VersionId': 'v', 'ETag': '"e"',
+                              'StorageClass': 'STANDARD', 'Key': 'k', 'IsLatest': True, 'Size': 1})
+    assert (v.owner.id, v.owner.display_name) == (None, None)
+    d = s3_delete_marker_from_json({'LastModified': '2020-01-01T00:00:00.000Z', 'VersionId': 'd',
+                                    'Key': 'k', 'IsLatest': True, 'Owner': {'ID': 'ak'}})
+    assert (d.owner.id, d.owner.display_name) == ('ak', None)
+
+def test_fetch_buckets_from_several_processes(caz):
+    # each process writes its pages in its own transactions to one db
+    buckets = ['b0', 'b1', 'b2']
+    for b in buckets:
+        caz.store.create_bucket(b)
+        for i in range(300):
+            caz.put('k{:04d}'.format(i), b'x', bucket=b)
+    assert caz.run('-i')[0] == 0
+    ps = [caz.popen('-f', b, '--page-size', '5') for b in buckets]
+    for p in ps:
+        out, err = p.communicate(timeout=120)
+        assert p.returncode == 0, err
+        assert 'fetch-bucket ok' in out
+    db = sqlite3.connect(str(caz.path / 'caz.db'))
+    try:
+        counts = db.execute('SELECT NAME, COUNT(*) FROM OBJECTS JOIN BUCKET ON BUCKET.XID = OBJECTS.BUCKET_XID '
+                            'GROUP BY NAME ORDER BY NAME').fetchall()
+    finally:
+        db.close()
+    assert counts == [(b, 300) for b in buckets]
+
+def _listed(caz, monkeypatch):
+    # (prefix, delimiter) of the list-object-versions requests served from now on
+    requests = []
+    list_versions = caz.store.list_versions
+    def recording_list_versions(bucket, prefix='', key_marker='', version_id_marker='',
+                                max_keys=1000, delimiter='', *args):
+        requests.append((prefix, delimiter))
+        return list_versions(bucket, prefix, key_marker, version_id_marker, max_keys, delimiter, *args)
+    monkeypatch.setattr(caz.store, 'list_versions', recording_list_versions)
+    return requests
+
+def _tree(caz):
+    keys = ['top', 'a/1', 'a/x/2', 'b/3', 'c/4', 'c/5']
+    for key in keys:
+        caz.put(key, b'1')
+        caz.put(key, b'2')
+    caz('-i')
+    return keys
+
+def test_fetch_bucket_split(caz, monkeypatch):
+    keys = _tree(caz)
+    requests = _listed(caz, monkeypatch)
+    assert 'fetch-bucket ok' in caz('-f', 'b', '--split', '--jobs', '3', '--page-size', '1')
+    assert sorted(set(requests)) == [('', '/'), ('a/', ''), ('b/', ''), ('c/', '')]
+    objs = _listing(caz)
+    assert sorted(o['key'] for o in objs) == sorted(keys * 2)
+    # a refresh split the same way drops the versions gone from storage
+    caz.store.delete_version('b', 'c/4', caz.versions('c/4')[1]['VersionId'])
+    caz.store.delete_version('b', 'top', caz.versions('top')[1]['VersionId'])
+    caz('-f', 'b', '--split', '--refresh')
+    objs = _listing(caz)
+    assert len(objs) == 10
+    assert {o['version_id'] for o in objs} == {v['VersionId'] for k in keys for v in caz.versions(k)}
+
+def test_fetch_bucket_prefixes(caz, monkeypatch):
+    _tree(caz)
+    (caz.path / 'prefixes').write_text('a/\na/x/\n\nc/\n')
+    requests = _listed(caz, monkeypatch)
+    assert 'fetch-bucket ok' in caz('-f', 'b', '--prefixes', 'prefixes')
+    # a/x/ is listed with a/
+    assert sorted(requests) == [('a/', ''), ('c/', '')]
+    assert sorted({o['key'] for o in _listing(caz)}) == ['a/1', 'a/x/2', 'c/4', 'c/5']
+
+def test_fetch_bucket_prefixes_stdin(caz, monkeypatch):
+    _tree(caz)
+    monkeypatch.setattr(sys, 'stdin', io.StringIO('b/\n'))
+    caz('-f', 'b', '--prefixes', '-')
+    assert sorted({o['key'] for o in _listing(caz)}) == ['b/3']
+
+def test_fetch_bucket_prefix_and_prefixes(caz):
+    _tree(caz)
+    (caz.path / 'prefixes').write_text('a/\n')
+    with pytest.raises(SystemExit):
+        caz('-f', 'b', '--prefixes', 'prefixes', '--prefix', 'c/')
+    assert '--prefix and --prefixes can not be used together' in caz.capsys.readouterr().out
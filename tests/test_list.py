@@ -0,0 +1,151 @@
+# Copyright (c) 2018 Javier M. Mellid <jmunhoz@igalia.com>
+#
+# Permission is hereby granted, free of charge, to any person obtaining a copy
+# of this software and associated documentation files (the "Software"), to deal
+# in the Software without restriction, including without limitation the rights
+# to use, copy, modify, merge, publish, distribute, sublicense, and/or sell
+# copies of the Software, and to permit persons to whom the Software is
+# furnished to do so, subject to the following conditions:
+#
+# The above copyright notice and this permission notice shall be included in all
+# copies or substantial portions of the Software.
+#
+# THE SOFTWARE IS PROVIDED "AS IS", WITHOUT WARRANTY OF ANY KIND, EXPRESS OR
+# IMPLIED, INCLUDING BUT NOT LIMITED TO THE WARRANTIES OF MERCHANTABILITY,
+# FITNESS FOR A PARTICULAR PURPOSE AND NONINFRINGEMENT. IN NO EVENT SHALL THE
+# AUTHORS OR COPYRIGHT HOLDERS BE LIABLE FOR ANY CLAIM, DAMAGES OR OTHER
+# LIABILITY, WHETHER IN AN ACTION OF CONTRACT, TORT OR OTHERWISE, ARISING FROM,
+# OUT OF OR IN CONNECTION WITH THE SOFTWARE OR THE USE OR OTHER DEALINGS IN THE
+# SOFTWARE.
+
+import csv
+import io
+import json
+import re
+
+import pytest
+
+# key, size, last modified of the versions, oldest first
+VERSIONS = [('a/1', 10, '2020-01-01T00:00:00.000Z'),
+            ('a/1', 20, '2020-06-01T00:00:00.000Z'),
+            ('a%_', 30, '2020-03-01T00:00:00.000Z'),
+            ('ab', 40, '2021-01-01T00:00:00.000Z'),
+            ('b', 50, '2022-01-01T00:00:00.000Z')]
+
+@pytest.fixture
+def catalog(caz):
+    for (key, size, date) in VERSIONS:
+        caz.put(key, b'x' * size)['LastModified'] = date
+    caz.delete('b')['LastModified'] = '2023-01-01T00:00:00.000Z'
+    caz('-i')
+    caz('-f', 'b')
+    return caz
+
+def _rows(caz, *args):
+    return [json.loads(l) for l in caz(*(args + ('--output', 'jsonl'))).splitlines()]
+
+def _sizes(caz, *args):
+    return [o['size'] for o in _rows(caz, '-l', *args)]
+
+def test_list_objects(catalog):
+    assert _sizes(catalog) == [None, 50, 40, 20, 30, 10]
+
+def test_list_objects_prefix(catalog):
+    assert _sizes(catalog, '--prefix', 'a') == [40, 20, 30, 10]
+    # LIKE wildcards are plain characters
+    assert _sizes(catalog, '--prefix', 'a%') == [30]
+    assert _sizes(catalog, '--prefix', 'a/') == [20, 10]
+    assert _sizes(catalog, '--prefix', 'z') == []
+
+def test_list_objects_dates(catalog):
+    assert _sizes(catalog, '--since', '2020-06-01') == [None, 50, 40, 20]
+    assert _sizes(catalog, '--until', '2020-03-01') == [30, 10]
+    assert _sizes(catalog, '--since', '2020-02-01', '--until', '2021-01-01T00:00:00Z') == [40, 20, 30]
+    # dates with a time zone
+    assert _sizes(catalog, '--until', '2020-03-01T01:00:00+02:00') == [10]
+
+def test_list_objects_type_and_latest(catalog):
+    assert _sizes(catalog, '--type', 'D') == [None]
+    assert _sizes(catalog, '--type', 'V') == [50, 40, 20, 30, 10]
+    assert _sizes(catalog, '--latest-only') == [None, 40, 20, 30]
+    assert _sizes(catalog, '--latest-only', '--type', 'V') == [40, 20, 30]
+
+def test_list_objects_sizes_and_limit(catalog):
+    assert _sizes(catalog, '--min-size', '20', '--max-size', '40') == [40, 20, 30]
+    # delete markers have no size, 0 for the filters
+    assert _sizes(catalog, '--max-size', '0') == [None]
+    assert _sizes(catalog, '--limit', '2') == [None, 50]
+    assert _sizes(catalog, '--prefix', 'a', '--limit', '1', '--min-size', '25') == [40]
+
+def test_list_objects_by_key_and_keys(catalog):
+    assert [o['size'] for o in _rows(catalog, '-k', 'a/1')] == [20, 10]
+    assert [o['size'] for o in _rows(catalog, '-k', 'a/1', '--until', '2020-01-01')] == [10]
+    assert catalog('-a', '--prefix', 'a').split() == ['a%_', 'a/1', 'ab', 'list-keys', 'ok']
+
+def test_list_objects_bad_filters(catalog):
+    for args in (('--limit', '0'), ('--min-size', '-1'), ('--since', 'not a date')):
+        with pytest.raises(SystemExit):
+            catalog('-l', *args)
+
+# keys with the characters each format has to escape
+ODD_KEYS = ['plain', 'comma,key', 'quote"key', 'tab\tkey', 'new\nline', 'back\\slash']
+
+@pytest.fixture
+def odd_catalog(caz):
+    for key in ODD_KEYS:
+        caz.put(key, b'x')
+    caz.put('anonymous', b'xy', owner=None)
+    caz.delete('plain')
+    caz('-i')
+    caz('-f', 'b')
+    return caz
+
+def _expected(caz):
+    return {o['version_id']: o for o in _rows(caz, '-l')}
+
+def test_list_objects_csv(odd_catalog):
+    expected = _expected(odd_catalog)
+    out = odd_catalog('-l', '--output', 'csv')
+    rows = list(csv.reader(io.StringIO(out, newline='')))
+    assert rows[0] == ['type', 'is_latest', 'last_modified', 'version_id', 'key', 'owner_display_name',
+                       'owner_id', 'size', 'etag', 'storage_class']
+    assert len(rows) == len(expected) + 1
+    for row in rows[1:]:
+        o = expected[row[3]]
+        # NULLs are empty fields
+        assert row == [o['type'], 'true' if o['is_latest'] else 'false', o['last_modified'], o['version_id'],
+                       o['key'], o['owner_display_name'] or '', o['owner_id'] or '',
+                       '' if o['size'] is None else str(o['size']), o['etag'] or '', o['storage_class'] or '']
+
+def _tsv_unescape(field):
+    return re.sub(r'\\(.)', lambda m: {'t': '\t', 'n': '\n', 'r': '\r', '\\': '\\'}[m.group(1)], field)
+
+def test_list_objects_tsv(odd_catalog):
+    expected = _expected(odd_catalog)
+    lines = odd_catalog('-l', '--output', 'tsv').split('\n')
+    assert lines[-1] == ''
+    # one record per line, escaped tabs and newlines included
+    assert len(lines) == len(expected) + 2
+    assert lines[0].split('\t')[4] == 'key'
+    for line in lines[1:-1]:
+        row = line.split('\t')
+        assert len(row) == 10
+        o = expected[row[3]]
+        assert _tsv_unescape(row[4]) == o['key']
+        assert row[5] == (o['owner_display_name'] or '')
+        assert row[7] == ('' if o['size'] is None else str(o['size']))
+
+def test_list_objects_null(odd_catalog):
+    expected = _expected(odd_catalog)
+    out = odd_catalog('-l', '--output', 'null')
+    fields = out.split('\0')
+    assert fields[-1] == ''
+    assert len(fields) - 1 == 10 * len(expected)
+    for i in range(0, len(fields) - 1, 10):
+        row = fields[i:i + 10]
+        o = expected[row[3]]
+        assert row[4] == o['key']
+        assert row[6] == (o['owner_id'] or '')
+
+def test_list_keys_null(odd_catalog):
+    assert sorted(odd_catalog('-a', '--output', 'null').split('\0')[:-1]) == sorted(ODD_KEYS + ['anonymous'])
@@ -0,0 +1,178 @@
+# Copyright (c) 2018 Javier M. Mellid <jmunhoz@igalia.com>
+#
+# Permission is hereby granted, free of charge, to any person obtaining a copy
+# of this software and associated documentation files (the "Software"), to deal
+# in the Software without restriction, including without limitation the rights
+# to use, copy, modify, merge, publish, distribute, sublicense, and/or sell
+# copies of the Software, and to permit persons to whom the Software is
+# furnished to do so, subject to the following conditions:
+#
+# The above copyright notice and this permission notice shall be included in all
+# copies or substantial portions of the Software.
+#
+# THE SOFTWARE IS PROVIDED "AS IS", WITHOUT WARRANTY OF ANY KIND, EXPRESS OR
+# IMPLIED, INCLUDING BUT NOT LIMITED TO THE WARRANTIES OF MERCHANTABILITY,
+# FITNESS FOR A PARTICULAR PURPOSE AND NONINFRINGEMENT. IN NO EVENT SHALL THE
+# AUTHORS OR COPYRIGHT HOLDERS BE LIABLE FOR ANY CLAIM, DAMAGES OR OTHER
+# LIABILITY, WHETHER IN AN ACTION OF CONTRACT, TORT OR OTHERWISE, ARISING FROM,
+# OUT OF OR IN CONNECTION WITH THE SOFTWARE OR THE USE OR OTHER DEALINGS IN THE
+# SOFTWARE.
+
+import json
+
+import pytest
+
+import pycaz.lib.config as config
+
+def test_recover_object(caz):
+    old = caz.put('k', b'one')
+    caz.put('k', b'two')
+    caz('-i')
+    caz('-f', 'b')
+    assert 'recover-object ok' in caz('-r', 'k', old['VersionId'])
+    latest = caz.versions('k')[0]
+    assert latest['Data'] == b'one'
+    assert len(caz.versions('k')) == 3
+    # the new version is in db without a refresh
+    objs = [json.loads(l) for l in caz('-k', 'k', '--output', 'jsonl').splitlines()]
+    assert latest['VersionId'] in {o['version_id'] for o in objs}
+
+def test_recover_object_version_id_with_dash(caz):
+    caz.put('k', b'one')['VersionId'] = '-abc'
+    caz.put('k', b'two')
+    caz('-i')
+    caz('-f', 'b')
+    assert 'recover-object ok' in caz('-r', 'k', '-abc')
+    assert caz.versions('k')[0]['Data'] == b'one'
+
+def test_recover_object_through_server(caz):
+    # the server gets the version id as typed, without the '-' fix
+    caz.put('k', b'one')['VersionId'] = '-abc'
+    caz.put('k', b'two')
+    caz('-i')
+    caz('-f', 'b')
+    server = caz.popen('--serve', 'caz.sock')
+    try:
+        caz.wait_for('caz.sock')
+        code, out, err = caz.run('-r', 'k', '-abc', '--connect', 'caz.sock')
+        assert code == 0, err
+        assert 'recover-object ok' in out
+    finally:
+        server.terminate()
+        server.communicate(timeout=30)
+    assert caz.versions('k')[0]['Data'] == b'one'
+
+def _listed_prefixes(caz, monkeypatch):
+    # prefixes of the list-object-versions requests served from now on
+    prefixes = []
+    list_versions = caz.store.list_versions
+    def recording_list_versions(bucket, prefix='', *args, **kwargs):
+        prefixes.append(prefix)
+        return list_versions(bucket, prefix, *args, **kwargs)
+    monkeypatch.setattr(caz.store, 'list_versions', recording_list_versions)
+    return prefixes
+
+def test_recover_objects_refreshes_the_recovered_keys(caz, monkeypatch):
+    pairs = []
+    for key in ('a/x', 'z/y', 'a/xx'):
+        pairs.append((key, caz.put(key, b'old')['VersionId']))
+        caz.put(key, b'new')
+    for i in range(20):
+        caz.put('m/{}'.format(i), b'x')
+    caz('-i')
+    caz('-f', 'b')
+    (caz.path / 'pairs').write_text(''.join('{}\t{}\n'.format(*p) for p in pairs))
+    prefixes = _listed_prefixes(caz, monkeypatch)
+    out = caz('--recover-objects', 'pairs')
+    assert out.count('RECOVERED') == 3
+    assert 'recover-objects ok' in out
+    # a/xx is listed with a/x
+    assert sorted(prefixes) == ['a/x', 'z/y']
+    for key, _ in pairs:
+        assert caz.versions(key)[0]['Data'] == b'old'
+
+def test_recover_objects_at(caz):
+    for key, dates in (('changed', ['2022-01-01T00:00:00.000Z', '2020-01-01T00:00:00.000Z']),
+                       ('same', ['2020-01-01T00:00:00.000Z']),
+                       ('deleted', ['2022-01-01T00:00:00.000Z', '2020-01-01T00:00:00.000Z']),
+                       ('other/changed', ['2022-01-01T00:00:00.000Z', '2020-01-01T00:00:00.000Z'])):
+        for n in range(len(dates)):
+            caz.put(key, b'v%d' % n)
+        for v, date in zip(caz.versions(key), dates):
+            v['LastModified'] = date
+    caz.store.delete_version('b', 'deleted', caz.versions('deleted')[1]['VersionId'])
+    caz.delete('deleted')
+    caz.versions('deleted')[0]['LastModified'] = '2019-01-01T00:00:00.000Z'
+    caz('-i')
+    caz('-f', 'b')
+    out = caz('--recover-objects-at', '2021-01-01', '--prefix', '')
+    assert 'key = changed' in out and 'RECOVERED' in out
+    assert 'key = same, version-id = {} ... SKIPPED (latest version)'.format(caz.versions('same')[0]['VersionId']) in out
+    assert 'SKIPPED (delete marker)' in out
+    assert 'recover-objects-at ok' in out
+    assert caz.versions('changed')[0]['Data'] == b'v0'
+    assert caz.versions('other/changed')[0]['Data'] == b'v0'
+    assert len(caz.versions('same')) == 1
+
+def test_recover_objects_at_prefix(caz):
+    for key in ('a/k', 'b/k'):
+        caz.put(key, b'old')
+        caz.put(key, b'new')
+        for v, date in zip(caz.versions(key), ['2022-01-01T00:00:00.000Z', '2020-01-01T00:00:00.000Z']):
+            v['LastModified'] = date
+    caz('-i')
+    caz('-f', 'b')
+    out = caz('--recover-objects-at', '2021-01-01', '--prefix', 'a/')
+    assert out.count('RECOVERED') == 1
+    assert caz.versions('a/k')[0]['Data'] == b'old'
+    assert caz.versions('b/k')[0]['Data'] == b'new'
+
+def test_recover_objects_failed_pair(caz):
+    old = caz.put('k', b'old')['VersionId']
+    caz.put('k', b'new')
+    caz('-i')
+    caz('-f', 'b')
+    (caz.path / 'pairs').write_text('k {}\nk missing\n'.format(old))
+    with pytest.raises(SystemExit):
+        caz('--recover-objects', 'pairs', '--jobs', '2')
+    out = caz.capsys.readouterr().out
+    assert 'key = k, version-id = {} ... RECOVERED'.format(old) in out
+    assert 'key = k, version-id = missing ... FAILED' in out
+    assert 'recover-objects failed : 1 objects recovered, 1 failed' in out
+    assert caz.versions('k')[0]['Data'] == b'old'
+
+def _replicated_versions(caz, key):
+    # versions written long ago, in the archive zone whatever its lag
+    for v in caz.versions(key):
+        v['Created'] -= 3600
+
+def test_recover_object_waits_for_replication(caz, monkeypatch):
+    old = caz.put('k', b'one')['VersionId']
+    caz.put('k', b'two')
+    _replicated_versions(caz, 'k')
+    caz.lag(0.5)
+    monkeypatch.setattr(config, 'SYNC_POLL_INTERVAL', 0.05)
+    caz('-i')
+    caz('-f', 'b')
+    out = caz('-r', 'k', old)
+    assert 'recover-object ok' in out
+    assert 'not replicated yet' not in out
+    wait = float(out.split('replication wait : ')[1].split('s')[0])
+    assert 0.4 <= wait < 5
+    # the refresh after the wait finds the new version in the archive zone
+    objs = [json.loads(l) for l in caz('-k', 'k', '--output', 'jsonl').splitlines()]
+    assert caz.versions('k')[0]['VersionId'] in {o['version_id'] for o in objs}
+
+def test_recover_object_replication_timeout(caz, monkeypatch):
+    old = caz.put('k', b'one')['VersionId']
+    caz.put('k', b'two')
+    _replicated_versions(caz, 'k')
+    caz.lag(30)
+    monkeypatch.setattr(config, 'SYNC_WINDOW_TIMEOUT', 0.3)
+    monkeypatch.setattr(config, 'SYNC_POLL_INTERVAL', 0.05)
+    caz('-i')
+    caz('-f', 'b')
+    out = caz('-r', 'k', old)
+    assert '1 versions not replicated yet' in out
+    assert 'recover-object ok' in out
+    assert caz.versions('k')[0]['Data'] == b'one'
@@ -0,0 +1,117 @@
+# Copyright (c) 2018 Javier M. Mellid <jmunhoz@igalia.com>
+#
+# Permission is hereby granted, free of charge, to any person obtaining a copy
+# of this software and associated documentation files (the "Software"), to deal
+# in the Software without restriction, including without limitation the rights
+# to use, copy, modify, merge, publish, distribute, sublicense, and/or sell
+# copies of the Software, and to permit persons to whom the Software is
+# furnished to do so, subject to the following conditions:
+#
+# The above copyright notice and this permission notice shall be included in all
+# copies or substantial portions of the Software.
+#
+# THE SOFTWARE IS PROVIDED "AS IS", WITHOUT WARRANTY OF ANY KIND, EXPRESS OR
+# IMPLIED, INCLUDING BUT NOT LIMITED TO THE WARRANTIES OF MERCHANTABILITY,
+# FITNESS FOR A PARTICULAR PURPOSE AND NONINFRINGEMENT. IN NO EVENT SHALL THE
+# AUTHORS OR COPYRIGHT HOLDERS BE LIABLE FOR ANY CLAIM, DAMAGES OR OTHER
+# LIABILITY, WHETHER IN AN ACTION OF CONTRACT, TORT OR OTHERWISE, ARISING FROM,
+# OUT OF OR IN CONNECTION WITH THE SOFTWARE OR THE USE OR OTHER DEALINGS IN THE
+# SOFTWARE.
+
+import http.client
+import json
+import os
+import socket
+import stat
+import threading
+import time
+
+import pytest
+
+from pycaz.lib.db import get_default_db
+from pycaz.lib.s3_commands import S3CommandServe
+
+def _free_port():
+    s = socket.socket()
+    try:
+        s.bind(('127.0.0.1', 0))
+        return s.getsockname()[1]
+    finally:
+        s.close()
+
+@pytest.fixture
+def tcp_server(caz):
+    caz.put('k', b'x')
+    caz('-i')
+    caz('-f', 'b')
+    address = '127.0.0.1:{}'.format(_free_port())
+    server = caz.popen('--serve', address)
+    try:
+        # the token is written once bound, the port listens right after
+        caz.wait_for('caz.token')
+        for _ in range(100):
+            try:
+                socket.create_connection(('127.0.0.1', int(address.split(':')[1])), timeout=1).close()
+                break
+            except OSError:
+                time.sleep(0.05)
+        yield address
+    finally:
+        server.terminate()
+        server.communicate(timeout=30)
+
+def _post(address, headers, command='list-keys'):
+    host, port = address.split(':')
+    conn = http.client.HTTPConnection(host, int(port), timeout=30)
+    try:
+        conn.request('POST', '/commands/' + command, json.dumps({'params': None, 'modifiers': {}}), headers)
+        response = conn.getresponse()
+        return response.status, response.read()
+    finally:
+        conn.close()
+
+def test_serve_tcp_token_file(caz, tcp_server):
+    assert stat.S_IMODE(os.stat(str(caz.path / 'caz.token')).st_mode) == 0o600
+    code, out, err = caz.run('-a', '--connect', tcp_server)
+    assert code == 0, err
+    assert 'k' in out
+
+def test_serve_tcp_refuses_foreign_requests(caz, tcp_server):
+    token = (caz.path / 'caz.token').read_text()
+    ok = {'Content-Type': 'application/json', 'Authorization': 'Bearer ' + token}
+    assert _post(tcp_server, ok)[0] == 200
+    assert _post(tcp_server, dict(ok, Authorization='Bearer 0'))[0] == 403
+    assert _post(tcp_server, {'Content-Type': 'application/json'})[0] == 403
+    assert _post(tcp_server, dict(ok, Origin='http://evil.example'))[0] == 403
+    assert _post(tcp_server, dict(ok, Host='evil.example'))[0] == 403
+    assert _post(tcp_server, dict(ok, **{'Content-Type': 'text/plain'}))[0] == 415
+    # nothing was trimmed
+    assert len(caz.versions('k')) == 1
+    assert _post(tcp_server, dict(ok, Origin='http://evil.example', **{'Content-Type': 'text/plain'}),
+                 'trim-objects')[0] == 403
+    assert len(caz.versions('k')) == 1
+
+def test_serve_listings_read_committed_rows(caz):
+    caz.put('k', b'x')
+    caz('-i')
+    caz('-f', 'b')
+    serve = S3CommandServe()
+    serve.lock = threading.Lock()
+    serve.readers = []
+    serve.readers_lock = threading.Lock()
+    db = get_default_db()
+    caz.capsys.readouterr()
+    with db.lock:
+        # a writer in the middle of its transaction
+        db._begin_tx()
+        db.database.execute("INSERT INTO OBJECTS (BUCKET_XID, LAST_MODIFIED, LAST_MODIFIED_US, VERSION_ID, KEY, "
+                            "IS_LATEST, SIZE, TYPE) VALUES (?, '2020-01-01T00:00:00.000Z', 0, 'v', 'uncommitted', 1, 0, 'V')",
+                            (db.get_bucket_xid('b'),))
+        serve._run('list-keys', None, {})
+        db.database.rollback()
+    out = caz.capsys.readouterr().out
+    assert 'k' in out.split()
+    assert 'uncommitted' not in out
+    assert len(serve.readers) == 1
+    for reader in serve.readers:
+        reader.close()
@@ -0,0 +1,56 @@
+# Copyright (c) 2018 Javier M. Mellid <jmunhoz@igalia.com>
+#
+# Permission is hereby granted, free of charge, to any person obtaining a copy
+# of this software and associated documentation files (the "Software"), to deal
+# in the Software without restriction, including without limitation the rights
+# to use, copy, modify, merge, publish, distribute, sublicense, and/or sell
+# copies of the Software, and to permit persons to whom the Software is
+# furnished to do so, subject to the following conditions:
+#
+# The above copyright notice and this permission notice shall be included in all
+# copies or substantial portions of the Software.
+#
+# THE SOFTWARE IS PROVIDED "AS IS", WITHOUT WARRANTY OF ANY KIND, EXPRESS OR
+# IMPLIED, INCLUDING BUT NOT LIMITED TO THE WARRANTIES OF MERCHANTABILITY,
+# FITNESS FOR A PARTICULAR PURPOSE AND NONINFRINGEMENT. IN NO EVENT SHALL THE
+# AUTHORS OR COPYRIGHT HOLDERS BE LIABLE FOR ANY CLAIM, DAMAGES OR OTHER
+# LIABILITY, WHETHER IN AN ACTION OF CONTRACT, TORT OR OTHERWISE, ARISING FROM,
+# OUT OF OR IN CONNECTION WITH THE SOFTWARE OR THE USE OR OTHER DEALINGS IN THE
+# SOFTWARE.
+
+import json
+
+def _snapshot(caz, date):
+    return {o['key']: o for o in map(json.loads, caz('--snapshot-at', date, '--output', 'jsonl').splitlines())}
+
+def test_snapshot_at(caz):
+    caz.put('k', b'one')
+    caz.put('k', b'two')
+    caz.put('gone', b'x')
+    caz.delete('gone')
+    for key, dates in (('k', ['2022-01-01T00:00:00.000Z', '2020-01-01T00:00:00.000Z']),
+                       ('gone', ['2021-01-01T00:00:00.000Z', '2020-01-01T00:00:00.000Z'])):
+        for v, date in zip(caz.versions(key), dates):
+            v['LastModified'] = date
+    caz('-i')
+    caz('-f', 'b')
+    snap = _snapshot(caz, '2020-06-01')
+    assert snap['k']['version_id'] == caz.versions('k')[1]['VersionId']
+    assert snap['gone']['version_id'] == caz.versions('gone')[1]['VersionId']
+    snap = _snapshot(caz, '2023-01-01')
+    assert snap['k']['version_id'] == caz.versions('k')[0]['VersionId']
+    assert snap['gone']['type'] == 'D'
+    assert _snapshot(caz, '2019-01-01') == {}
+
+def test_snapshot_at_same_last_modified(caz):
+    # versions written within one LAST_MODIFIED tick, the newest one wins
+    for key in ('a/2', 'b/x y'):
+        for n in range(3):
+            caz.put(key, b'v%d' % n)
+        for v in caz.versions(key):
+            v['LastModified'] = '2020-01-01T00:00:00.000Z'
+    caz('-i')
+    caz('-f', 'b')
+    snap = _snapshot(caz, '2021-01-01')
+    assert {k: o['version_id'] for k, o in snap.items()} == \
+           {k: caz.versions(k)[0]['VersionId'] for k in ('a/2', 'b/x y')}
@@ -0,0 +1,76 @@
+# Copyright (c) 2018 Javier M. Mellid <jmunhoz@igalia.com>
+#
+# Permission is hereby granted, free of charge, to any person obtaining a copy
+# of this software and associated documentation files (the "Software"), to deal
+# in the Software without restriction, including without limitation the rights
+# to use, copy, modify, merge, publish, distribute, sublicense, and/or sell
+# copies of the Software, and to permit persons to whom the Software is
+# furnished to do so, subject to the following conditions:
+#
+# The above copyright notice and this permission notice shall be included in all
+# copies or substantial portions of the Software.
+#
+# THE SOFTWARE IS PROVIDED "AS IS", WITHOUT WARRANTY OF ANY KIND, EXPRESS OR
+# IMPLIED, INCLUDING BUT NOT LIMITED TO THE WARRANTIES OF MERCHANTABILITY,
+# FITNESS FOR A PARTICULAR PURPOSE AND NONINFRINGEMENT. IN NO EVENT SHALL THE
+# AUTHORS OR COPYRIGHT HOLDERS BE LIABLE FOR ANY CLAIM, DAMAGES OR OTHER
+# LIABILITY, WHETHER IN AN ACTION OF CONTRACT, TORT OR OTHERWISE, ARISING FROM,
+# OUT OF OR IN CONNECTION WITH THE SOFTWARE OR THE USE OR OTHER DEALINGS IN THE
+# SOFTWARE.
+
+import json
+import re
+
+def _fetched(caz):
+    for i in range(5):
+        caz.put('k{}'.format(i), b'x' * i)
+    caz('-i')
+
+def _summary(err):
+    # (spans, counters) of a --stats summary, spans first then counters
+    spans = {}
+    counters = {}
+    table = None
+    for line in err.splitlines():
+        fields = line.split()
+        if fields[0] in ('span', 'counter'):
+            table = spans if fields[0] == 'span' else counters
+            continue
+        table[fields[0]] = fields[1:]
+    return spans, counters
+
+def test_stats(caz):
+    _fetched(caz)
+    out = caz('-f', 'b', '--page-size', '2', '--stats')
+    # stdout keeps the command output only
+    assert out == 'fetch-bucket ok\n'
+    (spans, counters) = _summary(caz.err)
+    assert spans['command.fetch-bucket'][0] == '1'
+    assert spans['s3.list-object-versions-page'][0] == '3'
+    assert counters['fetch.pages'] == ['3']
+    assert counters['fetch.versions'] == ['5']
+    assert counters['db.rows_inserted'] == ['5']
+
+def test_stats_file_json(caz):
+    _fetched(caz)
+    caz('-f', 'b', '--page-size', '2', '--stats-file', 'stats.json')
+    snap = json.loads((caz.path / 'stats.json').read_text())
+    assert snap['command'] == 'fetch-bucket'
+    assert snap['spans']['command.fetch-bucket']['calls'] == 1
+    assert snap['spans']['db.add_objects']['calls'] == 3
+    assert snap['spans']['command.fetch-bucket']['seconds'] >= snap['spans']['db.add_objects']['seconds']
+    assert snap['counters']['fetch.versions'] == 5
+    assert snap['counters']['s3_client.requests'] == 3
+    # one run, not the init-db before it
+    assert 'command.init-db' not in snap['spans']
+
+def test_stats_file_prometheus(caz):
+    _fetched(caz)
+    caz('-f', 'b')
+    caz('-l', '--output', 'null', '--stats-file', 'stats.prom', '--stats-format', 'prometheus')
+    text = (caz.path / 'stats.prom').read_text()
+    samples = [l for l in text.splitlines() if not l.startswith('#')]
+    for sample in samples:
+        assert re.match(r'^[a-zA-Z_:][a-zA-Z0-9_:]*\{[^}]*\} [0-9.e+-]+$', sample), sample
+    assert 'caz_span_calls_total{span="command.list-objects",command="list-objects"} 1' in samples
+    assert '# TYPE caz_span_seconds_total counter' in text
@@ -0,0 +1,59 @@
+# Copyright (c) 2018 Javier M. Mellid <jmunhoz@igalia.com>
+#
+# Permission is hereby granted, free of charge, to any person obtaining a copy
+# of this software and associated documentation files (the "Software"), to deal
+# in the Software without restriction, including without limitation the rights
+# to use, copy, modify, merge, publish, distribute, sublicense, and/or sell
+# copies of the Software, and to permit persons to whom the Software is
+# furnished to do so, subject to the following conditions:
+#
+# The above copyright notice and this permission notice shall be included in all
+# copies or substantial portions of the Software.
+#
+# THE SOFTWARE IS PROVIDED "AS IS", WITHOUT WARRANTY OF ANY KIND, EXPRESS OR
+# IMPLIED, INCLUDING BUT NOT LIMITED TO THE WARRANTIES OF MERCHANTABILITY,
+# FITNESS FOR A PARTICULAR PURPOSE AND NONINFRINGEMENT. IN NO EVENT SHALL THE
+# AUTHORS OR COPYRIGHT HOLDERS BE LIABLE FOR ANY CLAIM, DAMAGES OR OTHER
+# LIABILITY, WHETHER IN AN ACTION OF CONTRACT, TORT OR OTHERWISE, ARISING FROM,
+# OUT OF OR IN CONNECTION WITH THE SOFTWARE OR THE USE OR OTHER DEALINGS IN THE
+# SOFTWARE.
+
+import pytest
+
+from pycaz.lib.timestamps import to_epoch_us
+
+@pytest.mark.parametrize('value, us', [
+    # listings: RGW milliseconds, aws cli microseconds with an offset
+    ('2018-06-22T10:55:36.186Z', 1529664936186000),
+    ('2018-06-22T10:55:36.186000+00:00', 1529664936186000),
+    ('2018-06-22T12:55:36.186+02:00', 1529664936186000),
+    ('1970-01-01T00:00:00.000001Z', 1),
+    ('1969-12-31T23:59:59.999999Z', -1),
+    # user dates, UTC unless they carry a time zone
+    ('2020-01-01', 1577836800000000),
+    ('2020-01-01T00:00:00', 1577836800000000),
+    ('2020-01-01 01:00:00+01:00', 1577836800000000),
+    ('2020-01-01T00:00:00Z', 1577836800000000),
+    # the dateutil fallback
+    ('Jan 1 2020', 1577836800000000),
+    ('2020/01/01 00:00 UTC', 1577836800000000),
+])
+def test_to_epoch_us(value, us):
+    assert to_epoch_us(value) == us
+
+@pytest.mark.parametrize('value', ['', 'not a date', '2020-13-01', '99999999999999999999'])
+def test_to_epoch_us_invalid(value):
+    with pytest.raises(ValueError):
+        to_epoch_us(value)
+
+def test_dates_ordered_at_microseconds(caz):
+    # versions one millisecond apart, at the edges of --since and --until
+    for (i, date) in enumerate(('2020-01-01T00:00:00.999Z', '2020-01-01T00:00:01.000Z', '2020-01-01T00:00:01.001Z')):
+        caz.put('k', b'x' * (i + 1))['LastModified'] = date
+    caz('-i')
+    caz('-f', 'b')
+    out = caz('-l', '--since', '2020-01-01T00:00:01Z', '--until', '2020-01-01T01:00:01.000+01:00', '--output', 'csv')
+    assert [l.split(',')[7] for l in out.splitlines()[1:]] == ['2']
+    with pytest.raises(SystemExit):
+        caz('-l', '--since', 'yesterday-ish')
+    assert 'Error invalid date' in caz.capsys.readouterr().out
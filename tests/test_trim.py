@@ -0,0 +1,158 @@
+# Copyright (c) 2018 Javier M. Mellid <jmunhoz@igalia.com>
+#
+# Permission is hereby granted, free of charge, to any person obtaining a copy
+# of this software and associated documentation files (the "Software"), to deal
+# in the Software without restriction, including without limitation the rights
+# to use, copy, modify, merge, publish, distribute, sublicense, and/or sell
+# copies of the Software, and to permit persons to whom the Software is
+# furnished to do so, subject to the following conditions:
+#
+# The above copyright notice and this permission notice shall be included in all
+# copies or substantial portions of the Software.
+#
+# THE SOFTWARE IS PROVIDED "AS IS", WITHOUT WARRANTY OF ANY KIND, EXPRESS OR
+# IMPLIED, INCLUDING BUT NOT LIMITED TO THE WARRANTIES OF MERCHANTABILITY,
+# FITNESS FOR A PARTICULAR PURPOSE AND NONINFRINGEMENT. IN NO EVENT SHALL THE
+# AUTHORS OR COPYRIGHT HOLDERS BE LIABLE FOR ANY CLAIM, DAMAGES OR OTHER
+# LIABILITY, WHETHER IN AN ACTION OF CONTRACT, TORT OR OTHERWISE, ARISING FROM,
+# OUT OF OR IN CONNECTION WITH THE SOFTWARE OR THE USE OR OTHER DEALINGS IN THE
+# SOFTWARE.
+
+import pytest
+
+import pycaz.lib.config as config
+
+from pycaz.lib.mock_rgw import MockRGWHandler
+
+def _age(caz, key, *dates):
+    # dates of the versions of key, newest first
+    for v, date in zip(caz.versions(key), dates):
+        v['LastModified'] = date
+
+def _catalog(caz):
+    caz.put('old', b'1')
+    caz.put('old', b'22')
+    _age(caz, 'old', '2020-02-01T00:00:00.000Z', '2020-01-01T00:00:00.000Z')
+    caz.put('mixed', b'333')
+    caz.put('mixed', b'4444')
+    _age(caz, 'mixed', '2030-01-01T00:00:00.000Z', '2020-01-01T00:00:00.000Z')
+    caz.put('new', b'55555')
+    _age(caz, 'new', '2030-01-01T00:00:00.000Z')
+    caz('-i')
+    caz('-f', 'b')
+
+def test_trim_plan(caz):
+    _catalog(caz)
+    out = caz('-t', '2025-01-01', '--plan')
+    assert 'versions : 3 (6 bytes)' in out
+    assert 'keys losing every version : 1' in out
+    assert 'key : old' in out
+    # a plan deletes nothing
+    assert len(caz.versions('old')) == 2
+
+def test_trim_plan_keys(caz, monkeypatch):
+    for i in range(5):
+        caz.put('k{}'.format(i), b'x')
+        _age(caz, 'k{}'.format(i), '2020-01-01T00:00:00.000Z')
+    caz('-i')
+    caz('-f', 'b')
+    out = caz('-t', '2025-01-01', '--plan', '--limit', '2')
+    assert 'keys losing every version : 5' in out
+    assert out.count('key : ') == 2
+    assert '... 3 more keys (see --limit)' in out
+    out = caz('-t', '2025-01-01', '--plan')
+    assert out.count('key : ') == 5
+    assert 'more keys' not in out
+    # the list is bounded without --limit too
+    monkeypatch.setattr(config, 'TRIM_PLAN_KEYS', 4)
+    out = caz('-t', '2025-01-01', '--plan')
+    assert out.count('key : ') == 4
+    assert '... 1 more keys (see --limit)' in out
+
+def test_trim_objects(caz):
+    _catalog(caz)
+    out = caz('-t', '2025-01-01')
+    assert out.count('DELETED') == 3
+    assert 'trim-objects ok' in out
+    assert caz.versions('old') == []
+    assert [v['Data'] for v in caz.versions('mixed')] == [b'4444']
+    assert len(caz.versions('new')) == 1
+    assert 'versions : 0 (0 bytes)' in caz('-t', '2025-01-01', '--plan')
+
+def test_trim_objects_resume(caz, monkeypatch):
+    _catalog(caz)
+    delete_version = caz.store.delete_version
+    def failing_delete_version(bucket, key, version_id):
+        if key == 'old':
+            raise RuntimeError('delete refused')
+        return delete_version(bucket, key, version_id)
+    monkeypatch.setattr(caz.store, 'delete_version', failing_delete_version)
+    with pytest.raises(SystemExit):
+        caz('-t', '2025-01-01')
+    assert len(caz.versions('old')) == 2
+    assert len(caz.versions('mixed')) == 1
+    monkeypatch.setattr(caz.store, 'delete_version', delete_version)
+    out = caz('--resume', '1')
+    assert 'trim job 1 resumed : 2 of 3 versions' in out
+    assert out.count('DELETED') == 2
+    assert caz.versions('old') == []
+    # a finished job is not resumed again
+    with pytest.raises(SystemExit):
+        caz('--resume', '1')
+
+def _old_versions(caz, n):
+    for i in range(n):
+        caz.put('k{:02d}'.format(i), b'x')
+        _age(caz, 'k{:02d}'.format(i), '2020-01-01T00:00:00.000Z')
+    caz('-i')
+    caz('-f', 'b')
+
+def _batch_sizes(monkeypatch):
+    # objects per DeleteObjects request served from now on
+    sizes = []
+    delete_objects = MockRGWHandler._delete_objects
+    def recording_delete_objects(handler, bucket, body):
+        sizes.append(body.count(b'<Object>'))
+        return delete_objects(handler, bucket, body)
+    monkeypatch.setattr(MockRGWHandler, '_delete_objects', recording_delete_objects)
+    return sizes
+
+def test_trim_objects_batches(caz, monkeypatch):
+    _old_versions(caz, 30)
+    sizes = _batch_sizes(monkeypatch)
+    out = caz('-t', '2025-01-01', '--jobs', '4', '--batch-size', '7')
+    assert out.count('DELETED') == 30
+    assert 'trim-objects ok' in out
+    assert sorted(sizes) == [2, 7, 7, 7, 7]
+    assert caz.store.buckets['b'] == {}
+    assert 'versions : 0 (0 bytes)' in caz('-t', '2025-01-01', '--plan')
+
+def test_trim_objects_batch_partial_failure(caz, monkeypatch):
+    _old_versions(caz, 10)
+    delete_version = caz.store.delete_version
+    def failing_delete_version(bucket, key, version_id):
+        if key == 'k03':
+            raise RuntimeError('delete refused')
+        return delete_version(bucket, key, version_id)
+    monkeypatch.setattr(caz.store, 'delete_version', failing_delete_version)
+    with pytest.raises(SystemExit):
+        caz('-t', '2025-01-01', '--jobs', '2', '--batch-size', '4')
+    out = caz.capsys.readouterr().out
+    assert out.count('DELETED') == 9
+    assert 'key = k03' in out and 'FAILED' in out
+    assert list(caz.store.buckets['b']) == ['k03']
+    monkeypatch.setattr(caz.store, 'delete_version', delete_version)
+    out = caz('--resume', '1', '--batch-size', '4')
+    assert out.count('DELETED') == 1
+    assert caz.store.buckets['b'] == {}
+
+def test_trim_objects_batch_size_bounds(caz):
+    _old_versions(caz, 1)
+    for size in ('0', '1001'):
+        with pytest.raises(SystemExit):
+            caz('-t', '2025-01-01', '--batch-size', size)
+    assert 'Batch size must be between 1 and 1000' in caz.capsys.readouterr().out
+    with pytest.raises(SystemExit):
+        caz('-t', '2025-01-01', '--jobs', '0')
+    assert 'Jobs must be at least 1' in caz.capsys.readouterr().out
+    assert len(caz.versions('k00')) == 1